@@ -17,7 +17,11 @@ use utf8 ;
 use POSIX ;
 use CGI ;
 use JSON::PP ;
+use Digest::SHA ;
+use Fcntl qw(:flock) ;
 use File::Path qw(make_path remove_tree) ;
+use IO::Select ;
+use IO::Socket::UNIX ;
 use Time::HiRes qw(time) ;
 
 # フォーム送信先URL。DIFFF_BASE_URLがあればそれを優先し、なければ実行環境から自動判定する
@@ -27,6 +31,7 @@ my $diffcmd = '/usr/bin/diff' ;  # diffコマンドのパスを指定
 my $fifodir = '/tmp' ;           # FIFOを作成するディレクトリを指定
 my $datadir = 'data' ;
 my $tmpdir  = "$datadir/tmp" ;
+my $result_cache_dir = "$datadir/result-cache" ;
 
 my $pdf_max_mb                = get_env_int('DIFFF_PDF_MAX_MB', 50) ;
 my $text_max_chars            = get_env_int('DIFFF_TEXT_MAX_CHARS', 5000000) ;
@@ -34,11 +39,43 @@ my $tmp_ttl_minutes           = get_env_int('DIFFF_TMP_TTL_MINUTES', 120) ;
 my $pdftotext_timeout_sec     = get_env_int('DIFFF_PDFTOTEXT_TIMEOUT_SEC', 60) ;
 my $uv_timeout_sec            = get_env_int('DIFFF_UV_TIMEOUT_SEC', 60) ;
 my $diff_bridge_chars         = get_env_int('DIFFF_DIFF_BRIDGE_CHARS', 2) ;
+my $annotate_jobs             = get_env_int('DIFFF_ANNOTATE_JOBS', 1) ;
+my $extract_cache_max_mb      = get_env_int('DIFFF_EXTRACT_CACHE_MAX_MB', 256) ;
+my $result_cache_max_mb       = get_env_int('DIFFF_RESULT_CACHE_MAX_MB', 512) ;
+my $result_cache_ttl_minutes  = get_env_int('DIFFF_RESULT_CACHE_TTL_MINUTES', 1440) ;
+# 直近に使われた結果（別のリクエストがヒットした・注釈PDFを作っている）は削除しない。作る処理の時間切れより長くとる
+my $result_cache_busy_sec     = ($uv_timeout_sec * 2 > 600) ? $uv_timeout_sec * 2 : 600 ;
+my $pdf_profile               = get_env_int('DIFFF_PDF_PROFILE', 0) ;
+my $pdf_trace_memory          = get_env_int('DIFFF_PDF_TRACE_MEMORY', 0) ;
+my $page_prefilter            = get_env_int('DIFFF_PAGE_PREFILTER', 0) ;
+my $page_window               = get_env_int('DIFFF_PAGE_WINDOW', 0) ;
+my $optimize_output           = get_env_int('DIFFF_OPTIMIZE_OUTPUT', 0) ;
 my $pdftotext_cmd             = $ENV{'DIFFF_PDFTOTEXT_CMD'} // '/opt/homebrew/bin/pdftotext' ;
+my $pdf_extractor             = ($ENV{'DIFFF_PDF_EXTRACTOR'} // '') eq 'pypdf' ? 'pypdf' : 'pdftotext' ;
+my $diff_engine               = ($ENV{'DIFFF_DIFF_ENGINE'} // '') =~ /^(builtin|external)$/ ? $1 : 'auto' ;
+my $ann_output_mode           = ($ENV{'DIFFF_ANN_OUTPUT_MODE'} // '') eq 'incremental' ? 'incremental' : 'full' ;
+my $annotation_style          = ($ENV{'DIFFF_ANNOTATION_STYLE'} // '') eq 'native' ? 'native' : 'overlay' ;
 my $uv_cmd                    = $ENV{'DIFFF_UV_CMD'} // '/opt/homebrew/bin/uv' ;
+# tools/pyproject.toml の optional-dependencies をカンマ区切りで指定する（例: fast で numpy を使う）
+my @uv_extras                 = grep { /^[\w-]+$/ } map { s/^\s+|\s+$//gr } split /,/, ($ENV{'DIFFF_UV_EXTRAS'} // '') ;
+my $worker_socket             = $ENV{'DIFFF_WORKER_SOCKET'} // "$datadir/annotate.sock" ;
+my $worker_wait_sec           = get_env_int('DIFFF_WORKER_WAIT_SEC', 2) ;
+my $extract_cache_dir         = $ENV{'DIFFF_EXTRACT_CACHE_DIR'} // "$datadir/extract-cache" ;
+# 比較時に作る注釈PDF。ここにないものは描画計画だけ保存し、リンクが初めて開かれたときに作る
+# 同じ名前が重なっても1つとして数える（重複があると作らない出力があると誤判定するため）
+my @pdf_outputs               = do { my %seen ; grep { !$seen{$_}++ }
+                                grep { my $name = $_ ; grep { $_ eq $name } ('annA', 'annB', 'annComment') }
+                                split /\s*,\s*/, ($ENV{'DIFFF_PDF_OUTPUTS'} // 'annA,annB,annComment') } ;
 my $data_url                  = build_data_url($url) ;
 my $static_url                = build_static_url($url) ;
 
+# 注釈PDFの名前 → (成果物のファイル名, pdf_annotate_diff.py の出力引数)
+my %ann_outputs = (
+	annA       => ['annotatedA.pdf', '--output-ann-a'],
+	annB       => ['annotatedB.pdf', '--output-ann-b'],
+	annComment => ['annotatedComment.pdf', '--output-ann-comment'],
+) ;
+
 binmode STDOUT, ':utf8' ;        # 標準出力をUTF-8エンコード
 binmode STDERR, ':utf8' ;        # 標準エラー出力をUTF-8エンコード
 
@@ -47,6 +84,7 @@ my $sequenceB = '' ;
 my $cgi = CGI->new ;
 
 cleanup_tmp_artifacts() ;
+cleanup_result_cache() ;
 
 $sequenceA = $cgi->param('sequenceA') // '' ;
 $sequenceB = $cgi->param('sequenceB') // '' ;
@@ -64,6 +102,12 @@ my $has_text  = ($sequenceA ne '' or $sequenceB ne '') ;
 (length($sequenceB) <= $text_max_chars)
 	or print_html("ERROR : input too large (B > $text_max_chars)") ;
 
+# 比較時に作らなかった注釈PDFのリンク（?render=annA&job=...）
+if (($cgi->param('render') // '') ne ''){
+	process_render_request($cgi) ;
+	exit ;
+}
+
 if (($has_pdf_a and not $has_pdf_b) or (not $has_pdf_a and $has_pdf_b)){
 	print_html('ERROR : 2つのPDFを指定してください') ;
 }
@@ -105,7 +149,7 @@ sub process_pdf_request {
 		or print_html('ERROR : 2つのPDFを指定してください') ;
 	($upload_a and $upload_b) or print_html('ERROR : PDFが指定されていません') ;
 
-	(-x $pdftotext_cmd) or print_html("ERROR : $pdftotext_cmd : not executable") ;
+	($pdf_extractor eq 'pypdf' or -x $pdftotext_cmd) or print_html("ERROR : $pdftotext_cmd : not executable") ;
 	(-x $uv_cmd) or print_html("ERROR : $uv_cmd : not executable") ;
 
 	my $token = generate_token() ;
@@ -120,117 +164,110 @@ sub process_pdf_request {
 	$size_a <= $max_bytes or print_html("ERROR : pdfA too large (max ${pdf_max_mb}MB)") ;
 	$size_b <= $max_bytes or print_html("ERROR : pdfB too large (max ${pdf_max_mb}MB)") ;
 
-	my $xhtml_a = "$workdir/sourceA.xhtml" ;
-	my $xhtml_b = "$workdir/sourceB.xhtml" ;
-	my $stderr_log = "$workdir/pipeline.stderr.log" ;
-
-	my ($ok_pdftotext_a, $msg_a) = run_command_timeout(
-		[$pdftotext_cmd, '-bbox-layout', '-enc', 'UTF-8', $src_a, $xhtml_a],
-		$pdftotext_timeout_sec,
-		$stderr_log,
-	) ;
-	$ok_pdftotext_a or print_html("ERROR : pdftotext failed (A): $msg_a") ;
-
-	my ($ok_pdftotext_b, $msg_b) = run_command_timeout(
-		[$pdftotext_cmd, '-bbox-layout', '-enc', 'UTF-8', $src_b, $xhtml_b],
-		$pdftotext_timeout_sec,
-		$stderr_log,
-	) ;
-	$ok_pdftotext_b or print_html("ERROR : pdftotext failed (B): $msg_b") ;
-
-	my $recon_a_json = "$workdir/reconstructA.json" ;
-	my $recon_b_json = "$workdir/reconstructB.json" ;
-	my @uv_base = get_uv_base_cmd() ;
-	my ($ok_recon_a, $recon_msg_a) = run_command_timeout(
-		[
-			@uv_base, 'python', 'tools/pdf_annotate_diff.py',
-			'--phase', 'reconstruct',
-			'--input-xhtml', $xhtml_a,
-			'--output-json', $recon_a_json,
-		],
-		$uv_timeout_sec,
-		$stderr_log,
-	) ;
-	$ok_recon_a or print_html("ERROR : reconstruct failed (A): $recon_msg_a") ;
-
-	my ($ok_recon_b, $recon_msg_b) = run_command_timeout(
-		[
-			@uv_base, 'python', 'tools/pdf_annotate_diff.py',
-			'--phase', 'reconstruct',
-			'--input-xhtml', $xhtml_b,
-			'--output-json', $recon_b_json,
-		],
-		$uv_timeout_sec,
-		$stderr_log,
-	) ;
-	$ok_recon_b or print_html("ERROR : reconstruct failed (B): $recon_msg_b") ;
-
-	my $recon_a = load_json_file($recon_a_json) ;
-	my $recon_b = load_json_file($recon_b_json) ;
-
-	my $sequence_a = $recon_a->{'reconstructed_text'} // '' ;
-	my $sequence_b = $recon_b->{'reconstructed_text'} // '' ;
-	(length($sequence_a) <= $text_max_chars)
-		or print_html("ERROR : extracted text too large (A > $text_max_chars)") ;
-	(length($sequence_b) <= $text_max_chars)
-		or print_html("ERROR : extracted text too large (B > $text_max_chars)") ;
-
-	my @a_tokens = split_text( escape_char($sequence_a) ) ;
-	my @b_tokens = split_text( escape_char($sequence_b) ) ;
-
-	my $map_a = build_token_bbox_map_from_words($recon_a->{'words'} // []) ;
-	my $map_b = build_token_bbox_map_from_words($recon_b->{'words'} // []) ;
-	if (@$map_a != @a_tokens){
-		print STDERR "WARN : map_a token size mismatch map=@{[scalar @$map_a]} seq=@{[scalar @a_tokens]}\\n" ;
-		append_impl_log("WARN map_a token size mismatch map=@{[scalar @$map_a]} seq=@{[scalar @a_tokens]} token=$token") ;
+	# 同じPDFの組・同じ設定の比較は、前回の成果物をそのまま使う（pipelineを実行しない）
+	my $cache_key = ($result_cache_max_mb > 0) ? build_result_cache_key($src_a, $src_b) : '' ;
+	my $cached_dir = ($cache_key ne '') ? "$result_cache_dir/$cache_key" : '' ;
+	my $cache_hit = 0 ;
+	if ($cached_dir ne ''){
+		# 削除と重ならないよう、共有ロック中に確かめて更新時刻を新しくする
+		my $lock = lock_result_cache(LOCK_SH) ;
+		$cache_hit = (-f "$cached_dir/annotate_summary.json" and utime(undef, undef, $cached_dir)) ;
 	}
-	if (@$map_b != @b_tokens){
-		print STDERR "WARN : map_b token size mismatch map=@{[scalar @$map_b]} seq=@{[scalar @b_tokens]}\\n" ;
-		append_impl_log("WARN map_b token size mismatch map=@{[scalar @$map_b]} seq=@{[scalar @b_tokens]} token=$token") ;
+	if ($cache_hit){
+		remove_tree($workdir) ;
+		render_pdf_result($cached_dir, "${data_url}result-cache/$cache_key", load_json_file("$cached_dir/annotate_summary.json"), $token) ;
+		return ;
 	}
-	$map_a = normalize_token_map_size($map_a, scalar @a_tokens) ;
-	$map_b = normalize_token_map_size($map_b, scalar @b_tokens) ;
-
-	my $ctx = build_diff_context($sequence_a, $sequence_b) ;
-	my ($deleted_ranges, $added_ranges, $ops) = parse_diff_ranges($ctx->{'diffsummary'}) ;
-
-	my $annotate_input = {
-		map_a          => $map_a,
-		map_b          => $map_b,
-		deleted_ranges => $deleted_ranges,
-		added_ranges   => $added_ranges,
-		deleted_bridge_chars => $diff_bridge_chars,
-		ops            => $ops,
-	} ;
-	my $annotate_input_json = "$workdir/annotate_input.json" ;
-	write_json_file($annotate_input_json, $annotate_input) ;
 
-	my $ann_a = "$workdir/annotatedA.pdf" ;
-	my $ann_b = "$workdir/annotatedB.pdf" ;
-	my $ann_comment = "$workdir/annotatedComment.pdf" ;
+	my $stderr_log = "$workdir/pipeline.stderr.log" ;
+	my $text_a_path = "$workdir/reconstructA.txt" ;
+	my $text_b_path = "$workdir/reconstructB.txt" ;
 	my $annotate_summary = "$workdir/annotate_summary.json" ;
-	my ($ok_annotate, $annotate_msg) = run_command_timeout(
+	my $diff_table_path = "$workdir/diff_table.html" ;
+	my $draw_plans_path = "$workdir/draw_plans.json" ;
+	my $deferred = (@pdf_outputs < keys %ann_outputs) ;
+
+	# pdftotext → 再構成 → 差分 → 注釈 を1プロセスで実行し、中間JSONを書かない
+	# 比較表も同じ差分結果から組み立てるので、FIFO + diff を再実行しない
+	my ($ok_pipeline, $pipeline_msg) = run_python_tool(
 		[
-			@uv_base, 'python', 'tools/pdf_annotate_diff.py',
-			'--phase', 'annotate',
+			'--phase', 'pipeline',
 			'--source-a', $src_a,
 			'--source-b', $src_b,
-			'--input-json', $annotate_input_json,
-			'--output-ann-a', $ann_a,
-			'--output-ann-b', $ann_b,
-			'--output-ann-comment', $ann_comment,
+			'--extractor', $pdf_extractor,
+			'--pdftotext-cmd', $pdftotext_cmd,
+			'--pdftotext-timeout', $pdftotext_timeout_sec,
+			'--diff-cmd', $diffcmd,
+			'--diff-engine', $diff_engine,
+			'--deleted-bridge-chars', $diff_bridge_chars,
+			'--max-chars', $text_max_chars,
+			'--jobs', $annotate_jobs,
+			'--ann-output-mode', $ann_output_mode,
+			'--annotation-style', $annotation_style,
+			# 同じPDF（sha256）の抽出結果を再利用する。空文字でキャッシュを使わない
+			($extract_cache_dir ne '' ? ('--extract-cache-dir', $extract_cache_dir, '--extract-cache-max-mb', $extract_cache_max_mb) : ()),
+			# 調査用。pipeline.prof / pipeline.tracemalloc を作業ディレクトリに出力する
+			($pdf_profile ? ('--profile') : ()),
+			($pdf_trace_memory ? ('--trace-memory') : ()),
+			# ページ内容の指紋が一致するページを差分から外す。内容が同じなら注釈PDFを作らない
+			($page_prefilter ? ('--page-prefilter') : ()),
+			# 巨大なPDF向け。token_map と注釈PDFを N ページずつ作り、部分PDFをつないで出力する
+			($page_window > 0 ? ('--page-window', $page_window) : ()),
+			# 注釈PDFの内容ストリームを圧縮し、ページごとに複製されたフォント等をまとめる
+			($optimize_output ? ('--optimize-output') : ()),
+			'--output-text-a', $text_a_path,
+			'--output-text-b', $text_b_path,
+			'--output-table', $diff_table_path,
+			# ページごとの変更件数・外接矩形・コメント番号と op → ページの対応（注釈PDFを開かずにページへ移動するため）
+			'--changes-index', "$workdir/changes_index.json",
+			(map { ($ann_outputs{$_}[1], "$workdir/$ann_outputs{$_}[0]") } @pdf_outputs),
+			# 作らなかった注釈PDFは、保存した描画計画から --phase render で後から作る
+			($deferred ? ('--outputs', join(',', @pdf_outputs), '--save-plans', $draw_plans_path) : ()),
 			'--summary-json', $annotate_summary,
 		],
-		$uv_timeout_sec,
+		$uv_timeout_sec + (2 * $pdftotext_timeout_sec),
 		$stderr_log,
 	) ;
-	$ok_annotate or print_html("ERROR : annotate failed: $annotate_msg") ;
 
 	my $summary = {} ;
 	(-f $annotate_summary) and $summary = load_json_file($annotate_summary) ;
+	if (not $ok_pipeline){
+		if (($summary->{'error_kind'} // '') eq 'text_too_large'){
+			print_html("ERROR : extracted text too large ($summary->{'side'} > $text_max_chars)") ;
+		}
+		print_html('ERROR : pipeline failed: ' . ($summary->{'error'} // $pipeline_msg)) ;
+	}
+
+	my $artifact_dir = $workdir ;
+	my $asset_root = "${data_url}tmp/$token" ;
+	if ($cached_dir ne '' and publish_result_cache($workdir, $cached_dir)){
+		$artifact_dir = $cached_dir ;
+		$asset_root = "${data_url}result-cache/$cache_key" ;
+	}
+	render_pdf_result($artifact_dir, $asset_root, $summary, $token) ;
+} ;
+# ====================
+sub render_pdf_result {
+	my ($artifact_dir, $asset_root, $summary, $token) = @_ ;
+
+	my $sequence_a = read_text_file("$artifact_dir/reconstructA.txt") ;
+	my $sequence_b = read_text_file("$artifact_dir/reconstructB.txt") ;
+	# 内容が同じ場合は token_map を作っていないので確認しない
+	foreach my $side ($summary->{'identical'} ? () : ('a', 'b')){
+		my $map_size = $summary->{"map_${side}_tokens"} // 0 ;
+		my $seq_size = $summary->{"seq_${side}_tokens"} // 0 ;
+		($map_size == $seq_size) and next ;
+		print STDERR "WARN : map_$side token size mismatch map=$map_size seq=$seq_size\n" ;
+		append_impl_log("WARN map_$side token size mismatch map=$map_size seq=$seq_size token=$token") ;
+	}
+
+	my $diff_table = read_text_file("$artifact_dir/diff_table.html") ;
+
+	# 結果キャッシュから表示した場合も、時間は成果物を作ったときの値
+	my $timings = (ref $summary->{'timings'} eq 'HASH') ? $summary->{'timings'} : {} ;
 	append_impl_log(
 		sprintf(
-			"%s PDF annotate summary token=%s skipped_duplicates=%d map_a_miss=%d map_b_miss=%d comment_pages_extended=%d comment_min_font_used=%.1f comment_continuation_pages=%d comment_merged_groups=%d deleted_ranges_input=%d deleted_ranges_output=%d deleted_bridge_merges=%d",
+			"%s PDF annotate summary token=%s skipped_duplicates=%d map_a_miss=%d map_b_miss=%d comment_pages_extended=%d comment_min_font_used=%.1f comment_continuation_pages=%d comment_merged_groups=%d deleted_ranges_input=%d deleted_ranges_output=%d deleted_bridge_merges=%d wall_ms=%d rss_peak_mb=%.1f steps=%s",
 			scalar localtime(),
 			$token,
 				$summary->{'skipped_duplicates'} // 0,
@@ -243,21 +280,96 @@ sub process_pdf_request {
 				$summary->{'deleted_ranges_input'} // 0,
 				$summary->{'deleted_ranges_output'} // 0,
 				$summary->{'deleted_bridge_merges'} // 0,
+				$timings->{'wall_ms'} // 0,
+				$timings->{'rss_peak_mb'} // 0,
+				format_step_timings($timings->{'steps'}),
 			)
 	) ;
 
-	my $table = append_count_row($ctx->{'table'}, $sequence_a, $sequence_b) ;
+	# 作っていない注釈PDFは、描画計画があれば ?render= のリンクにする
+	(my $job = $artifact_dir) =~ s{^\Q$datadir\E/}{} ;
+	my @ann_links ;
+	foreach my $name ('annA', 'annB', 'annComment'){
+		if (-f "$artifact_dir/$ann_outputs{$name}[0]"){
+			push @ann_links, [$name, "$asset_root/$ann_outputs{$name}[0]"] ;
+		} elsif (-f "$artifact_dir/draw_plans.json"){
+			push @ann_links, [$name, "${url}?render=$name&amp;job=$job"] ;
+		}
+	}
+
+	my $table = append_count_row($diff_table, $sequence_a, $sequence_b) ;
 	$sequenceA = $sequence_a ;
 	$sequenceB = $sequence_b ;
-	my $asset_root = "${data_url}tmp/$token" ;
 	my $message = build_result_section(
 		mode      => 'pdf',
 		table     => $table,
 		asset_root => $asset_root,
+		ann_links  => \@ann_links,
+		identical  => ($summary->{'identical'} ? 1 : 0),
 	) ;
 	print_html($message) ;
 } ;
 # ====================
+sub process_render_request {  # 比較時に作らなかった注釈PDFを保存済みの描画計画から作り、PDFをそのまま返す
+	my $cgi = $_[0] // CGI->new ;
+	my $name = $cgi->param('render') // '' ;
+	my $job = $cgi->param('job') // '' ;
+	exists $ann_outputs{$name} or print_html('ERROR : unknown output') ;
+	$job =~ m{^(tmp/[a-z2-9]{12}|result-cache/[0-9a-f]{64})$} or print_html('ERROR : invalid job') ;
+	my $job_dir = "$datadir/$1" ;
+	my ($file, $output_arg) = @{$ann_outputs{$name}} ;
+	my $path = "$job_dir/$file" ;
+	{
+		# 作っている間に削除されないよう、先に更新時刻を新しくする
+		my $lock = lock_result_cache(LOCK_SH) ;
+		utime(undef, undef, $job_dir) ;
+	}
+
+	if (not -f $path){
+		(-f "$job_dir/draw_plans.json") or print_html('ERROR : result expired') ;
+		(-x $uv_cmd) or print_html("ERROR : $uv_cmd : not executable") ;
+		# 同時に開かれても書きかけのPDFを返さないよう、一時ファイルに書いてから置き換える
+		my $part = "$path.$$.part" ;
+		my ($ok_render, $render_msg) = run_python_tool(
+			[
+				'--phase', 'render',
+				'--input-plans', "$job_dir/draw_plans.json",
+				'--source-a', "$job_dir/sourceA.pdf",
+				'--source-b', "$job_dir/sourceB.pdf",
+				'--jobs', $annotate_jobs,
+				'--ann-output-mode', $ann_output_mode,
+				'--annotation-style', $annotation_style,
+				($page_window > 0 ? ('--page-window', $page_window) : ()),
+				($optimize_output ? ('--optimize-output') : ()),
+				'--outputs', $name,
+				$output_arg, $part,
+			],
+			$uv_timeout_sec,
+			"$job_dir/render.stderr.log",
+		) ;
+		($ok_render and -f $part) or print_html("ERROR : render failed: $render_msg") ;
+		rename($part, $path) or print_html("ERROR : render failed: $!") ;
+	}
+	utime(undef, undef, $job_dir) ;
+
+	# Electron の CGI サーバはリダイレクトを扱わないので、PDFをそのまま返す
+	open my $fh, '<:raw', $path or print_html("ERROR : cannot read $file") ;
+	binmode STDOUT, ':raw' ;
+	print "Content-type: application/pdf\nContent-Disposition: inline; filename=\"$file\"\n\n" ;
+	local $/ = \65536 ;
+	print while <$fh> ;
+	close $fh ;
+} ;
+# ====================
+sub format_step_timings {
+	# 段階名:経過ms を時間の長い順に並べる（例 ann_comment:512,extract_b:377,...）
+	my $steps = $_[0] ;
+	ref $steps eq 'HASH' or return '-' ;
+	my @names = sort { ($steps->{$b}{'wall_ms'} // 0) <=> ($steps->{$a}{'wall_ms'} // 0) } keys %$steps ;
+	@names or return '-' ;
+	return join ',', map { sprintf('%s:%d', $_, $steps->{$_}{'wall_ms'} // 0) } @names ;
+} ;
+# ====================
 sub append_count_row {
 	my ($table, $seq_a, $seq_b) = @_ ;
 	$table //= '' ;
@@ -285,19 +397,23 @@ sub build_result_section {
 	my $mode = $args{'mode'} // 'text' ;
 	my $table = $args{'table'} // '' ;
 	my $asset_root = $args{'asset_root'} // '' ;
+	my $ann_links = $args{'ann_links'} // [] ;
+	my $identical = $args{'identical'} // 0 ;
 	my $mode_label = ($mode eq 'pdf') ? 'PDF' : 'Text' ;
 
 	my $pdf_tools_html = '' ;
 	if ($mode eq 'pdf' and $asset_root ne ''){
+		# 内容が同じ場合（--page-prefilter）は注釈PDFを作っていない
+		my $ann_links_html = $identical ?
+			"<span>差分なし</span>" :
+			join("\n\t\t\t", map { "<a href='$_->[1]' target='_blank' rel='noopener'>$_->[0]</a>" } @$ann_links) ;
 		$pdf_tools_html = <<"--EOS--" ;
 	<div class='pdf-tools' aria-label='PDF成果物'>
 		<div class='pdf-tools-title'><svg class='i'><use href='${static_url}icons.svg#icon-folder'></use></svg> pdf</div>
 		<div class='pdf-tools-links'>
 			<a href='$asset_root/sourceA.pdf' target='_blank' rel='noopener'>srcA</a>
 			<a href='$asset_root/sourceB.pdf' target='_blank' rel='noopener'>srcB</a>
-			<a href='$asset_root/annotatedA.pdf' target='_blank' rel='noopener'>annA</a>
-			<a href='$asset_root/annotatedB.pdf' target='_blank' rel='noopener'>annB</a>
-			<a href='$asset_root/annotatedComment.pdf' target='_blank' rel='noopener'>annComment</a>
+			$ann_links_html
 		</div>
 	</div>
 --EOS--
@@ -406,129 +522,6 @@ sub build_diff_context {
 	} ;
 } ;
 # ====================
-sub parse_diff_ranges {
-	my $diffsummary = $_[0] // [] ;
-	my @deleted ;
-	my @added ;
-	my @ops ;
-	foreach my $line (@$diffsummary){
-		if ($line =~ /^((\d+),)?(\d+)c(\d+)(,(\d+))?$/){
-			my $a_end   = $3 || 0 ;
-			my $a_start = $2 || $a_end ;
-			my $b_start = $4 || 0 ;
-			my $b_end   = $6 || $b_start ;
-			push @deleted, [$a_start - 1, $a_end - 1] ;
-			push @added,   [$b_start - 1, $b_end - 1] ;
-			push @ops, {
-				type    => 'c',
-				a_start => $a_start - 1,
-				a_end   => $a_end - 1,
-				b_start => $b_start - 1,
-				b_end   => $b_end - 1,
-			} ;
-		} elsif ($line =~ /^((\d+),)?(\d+)d(\d+)(,(\d+))?$/){
-			my $a_end   = $3 || 0 ;
-			my $a_start = $2 || $a_end ;
-			my $b_start = $4 || 0 ;
-			push @deleted, [$a_start - 1, $a_end - 1] ;
-			push @ops, {
-				type    => 'd',
-				a_start => $a_start - 1,
-				a_end   => $a_end - 1,
-				b_start => $b_start - 1,
-				b_end   => $b_start - 1,
-			} ;
-		} elsif ($line =~ /^((\d+),)?(\d+)a(\d+)(,(\d+))?$/){
-			my $a_end   = $3 || 0 ;
-			my $a_start = $2 || $a_end ;
-			my $b_start = $4 || 0 ;
-			my $b_end   = $6 || $b_start ;
-			push @added, [$b_start - 1, $b_end - 1] ;
-			push @ops, {
-				type    => 'a',
-				a_start => $a_start - 1,
-				a_end   => $a_end - 1,
-				b_start => $b_start - 1,
-				b_end   => $b_end - 1,
-			} ;
-		}
-	}
-	return (\@deleted, \@added, \@ops) ;
-} ;
-# ====================
-sub split_bbox_by_token_count {
-	my ($bbox, $count) = @_ ;
-	my @boxes ;
-	($count and $count > 0) or return @boxes ;
-	(ref $bbox eq 'HASH') or return @boxes ;
-	(defined $bbox->{'x_min'} and defined $bbox->{'x_max'} and
-	 defined $bbox->{'y_min'} and defined $bbox->{'y_max'}) or return @boxes ;
-
-	my $x_min = 0 + $bbox->{'x_min'} ;
-	my $x_max = 0 + $bbox->{'x_max'} ;
-	my $y_min = 0 + $bbox->{'y_min'} ;
-	my $y_max = 0 + $bbox->{'y_max'} ;
-	my $width = $x_max - $x_min ;
-	$width > 0 or return @boxes ;
-
-	my $step = $width / $count ;
-	foreach my $i (0..$count-1){
-		my $left = $x_min + ($step * $i) ;
-		my $right = ($i == $count - 1) ? $x_max : ($x_min + ($step * ($i + 1))) ;
-		push @boxes, {
-			x_min => $left,
-			y_min => $y_min,
-			x_max => $right,
-			y_max => $y_max,
-		} ;
-	}
-	return @boxes ;
-} ;
-# ====================
-sub build_token_bbox_map_from_words {
-	my $words = $_[0] // [] ;
-	my @map ;
-	my $size = scalar @$words ;
-	foreach my $i (0..$size-1){
-		my $word = $words->[$i] ;
-		my @tokens = split_text( escape_char($word->{'text'} // '') ) ;
-		my @token_boxes = split_bbox_by_token_count($word->{'bbox'}, scalar @tokens) ;
-		foreach my $ti (0..$#tokens){
-			my $token = $tokens[$ti] ;
-			my $token_bbox = ($ti <= $#token_boxes) ? $token_boxes[$ti] : $word->{'bbox'} ;
-			push @map, {
-				page     => $word->{'page'},
-				line_seq => $word->{'line_seq'},
-				word_seq => $word->{'word_seq'},
-				token_index => scalar(@map),
-				bbox     => $word->{'bbox'},
-				token_bbox => $token_bbox,
-				token    => $token,
-			} ;
-		}
-		if ($i < $size - 1){
-			my $next_word = $words->[$i + 1] ;
-			my $same_page = (($word->{'page'} // '') eq ($next_word->{'page'} // '')) ? 1 : 0 ;
-			my $line_changed = (($word->{'line_seq'} // '') ne ($next_word->{'line_seq'} // '')) ? 1 : 0 ;
-			($same_page and $line_changed) and push @map, undef ;  # 改行トークンはbboxを持たない
-		}
-	}
-	return \@map ;
-} ;
-# ====================
-sub normalize_token_map_size {
-	my $map = $_[0] // [] ;
-	my $target_size = $_[1] // 0 ;
-	my @normalized = @$map ;
-	while (@normalized < $target_size){
-		push @normalized, undef ;
-	}
-	if (@normalized > $target_size){
-		@normalized = @normalized[0..$target_size-1] ;
-	}
-	return \@normalized ;
-} ;
-# ====================
 sub save_upload_file {
 	my ($fh, $path) = @_ ;
 	open my $out, '>', $path or print_html("ERROR : cannot write $path") ;
@@ -571,8 +564,65 @@ sub run_command_timeout {
 	return ($? == 0, "exit=$?") ;
 } ;
 # ====================
+sub run_python_tool {  # 常駐workerがあれば委譲し、なければ uv run で起動する
+	my ($args_ref, $timeout, $stderr_path) = @_ ;
+	my ($handled, $ok, $msg) = run_worker_job($args_ref, $timeout, $stderr_path) ;
+	$handled and return ($ok, $msg) ;
+	return run_command_timeout(
+		[get_uv_base_cmd(), 'python', 'tools/pdf_annotate_diff.py', @$args_ref],
+		$timeout,
+		$stderr_path,
+	) ;
+} ;
+# ====================
+sub run_worker_job {
+	my ($args_ref, $timeout, $stderr_path) = @_ ;
+	($worker_socket ne '' and -S $worker_socket) or return (0) ;
+	my $sock = IO::Socket::UNIX->new(Peer => $worker_socket) or return (0) ;
+	# 受付の応答がなければ（workerが止まっている・子プロセスの上限に達しているなど）通常起動で実行する
+	my $ready ;
+	if (IO::Select->new($sock)->can_read($worker_wait_sec)){
+		$ready = <$sock> ;
+	}
+	unless (defined $ready and $ready eq "ready\n"){
+		close $sock ;
+		return (0) ;
+	}
+	my $request = JSON::PP->new->utf8->canonical->encode({
+		argv    => [map { "$_" } @$args_ref],  # 数値の引数も文字列で渡す
+		cwd     => getcwd(),
+		timeout => $timeout + 0,  # worker側で時間切れのジョブを止める
+		($stderr_path ? (stderr => $stderr_path) : ()),
+	}) ;
+	my $line ;
+	my $finished = eval {
+		local $SIG{ALRM} = sub { die "timeout\n" } ;
+		alarm($timeout + 10) ;  # 時間切れはworkerが止めて応答する。応答がないときだけここで諦める
+		print {$sock} "$request\n" ;
+		$sock->flush ;
+		$line = <$sock> ;
+		alarm(0) ;
+		1 ;
+	} ;
+	alarm(0) ;
+	close $sock ;
+	$finished or return (1, 0, 'timeout') ;
+	defined $line or return (0) ;  # 応答前にworkerが落ちた場合は通常起動で再実行する
+	my $response = eval { decode_json($line) } ;
+	(ref $response eq 'HASH') or return (0) ;
+	$response->{'timeout'} and return (1, 0, 'timeout') ;
+	my $status = $response->{'status'} // 1 ;
+	if (defined $response->{'error'} and $stderr_path){
+		if (open my $err, '>>:utf8', $stderr_path){
+			print {$err} "$response->{'error'}\n" ;
+			close $err ;
+		}
+	}
+	return (1, $status == 0, "worker exit=$status") ;
+} ;
+# ====================
 sub get_uv_base_cmd {
-	my @cmd = ($uv_cmd, 'run', '--project', 'tools', '--offline', '--no-python-downloads') ;
+	my @cmd = ($uv_cmd, 'run', '--project', 'tools', (map { ('--extra', $_) } @uv_extras), '--offline', '--no-python-downloads') ;
 	if (defined $ENV{'UV_PYTHON'} and $ENV{'UV_PYTHON'} ne ''){
 		push @cmd, '--no-managed-python' ;
 	}
@@ -588,11 +638,13 @@ sub load_json_file {
 	return decode_json($json) ;
 } ;
 # ====================
-sub write_json_file {
-	my ($path, $data) = @_ ;
-	open my $fh, '>', $path or print_html("ERROR : cannot write $path") ;
-	print {$fh} JSON::PP->new->utf8->canonical->encode($data) ;
+sub read_text_file {
+	my $path = $_[0] // '' ;
+	open my $fh, '<:encoding(UTF-8)', $path or print_html("ERROR : cannot read $path") ;
+	local $/ = undef ;
+	my $text = <$fh> // '' ;
 	close $fh ;
+	return $text ;
 } ;
 # ====================
 sub cleanup_tmp_artifacts {
@@ -610,6 +662,86 @@ sub cleanup_tmp_artifacts {
 	closedir $dh ;
 } ;
 # ====================
+sub build_result_cache_key {  # 2つのPDFの内容・出力や成否に効く設定・ツールの版から結果キャッシュのキーを作る
+	my ($src_a, $src_b) = @_ ;
+	my @parts = (
+		Digest::SHA->new(256)->addfile($src_a, 'b')->hexdigest,
+		Digest::SHA->new(256)->addfile($src_b, 'b')->hexdigest,
+		$diff_bridge_chars,
+		$pdf_extractor,
+		$diff_engine,
+		$ann_output_mode,
+		$annotation_style,
+		($page_prefilter ? 'page-prefilter' : ()),
+		($page_window > 0 ? "page-window=$page_window" : ()),
+		($optimize_output ? 'optimize-output' : ()),
+		'outputs=' . join(',', @pdf_outputs),
+		# 上限や時間切れで失敗する設定で作られた結果を、より厳しい設定のときに返さない
+		"max-chars=$text_max_chars",
+		"pdftotext-timeout=$pdftotext_timeout_sec",
+		"uv-timeout=$uv_timeout_sec",
+		"diff-cmd=$diffcmd",
+	) ;
+	# ツールの版は Python側ソースと pdftotext の実体のサイズ・更新時刻で区別する
+	foreach my $path (sort(glob('tools/*.py')), $pdftotext_cmd){
+		my @st = stat($path) ;
+		push @parts, join(':', $path, $st[7] // 0, $st[9] // 0) ;
+	}
+	return Digest::SHA::sha256_hex(join("\0", @parts)) ;
+} ;
+# ====================
+sub publish_result_cache {  # 成果物ディレクトリをキャッシュへ移す（同じキーが先に作られていれば移さない）
+	my ($workdir, $cached_dir) = @_ ;
+	make_path($result_cache_dir) ;
+	return rename($workdir, $cached_dir) ;
+} ;
+# ====================
+sub cleanup_result_cache {  # TTLを過ぎた結果を消し、合計サイズが上限を超えたら使われていない順に消す（直近に使われたものは残す）
+	($result_cache_max_mb > 0 and -d $result_cache_dir) or return ;
+	my $lock = lock_result_cache(LOCK_EX) or return ;
+	my $threshold = time - ($result_cache_ttl_minutes * 60) ;
+	my $busy_since = time - $result_cache_busy_sec ;
+	$threshold = $busy_since if $threshold > $busy_since ;
+	my @entries ;
+	my $total = 0 ;
+	opendir my $dh, $result_cache_dir or return ;
+	while (my $entry = readdir $dh){
+		next if $entry =~ /^\./ ;
+		my $path = "$result_cache_dir/$entry" ;
+		next unless -d $path ;
+		my $mtime = (stat($path))[9] // time ;
+		if ($mtime < $threshold){
+			remove_tree($path) ;
+			next ;
+		}
+		my $size = 0 ;
+		if (opendir my $files, $path){
+			while (my $file = readdir $files){
+				next if $file =~ /^\./ ;
+				$size += (-s "$path/$file") // 0 ;
+			}
+			closedir $files ;
+		}
+		push @entries, [$mtime, $size, $path] if $mtime < $busy_since ;
+		$total += $size ;
+	}
+	closedir $dh ;
+	my $max_bytes = $result_cache_max_mb * 1024 * 1024 ;
+	foreach my $entry (sort { $a->[0] <=> $b->[0] } @entries){
+		last if $total <= $max_bytes ;
+		remove_tree($entry->[2]) ;
+		$total -= $entry->[1] ;
+	}
+} ;
+# ====================
+sub lock_result_cache {  # 結果キャッシュの削除（LOCK_EX）と利用（LOCK_SH）を排他する。ハンドルを手放すと解除
+	my $mode = $_[0] ;
+	make_path($result_cache_dir) ;
+	open my $fh, '>>', "$result_cache_dir/.lock" or return undef ;
+	flock($fh, $mode) or return undef ;
+	return $fh ;
+} ;
+# ====================
 sub append_impl_log {
 	my $line = $_[0] // '' ;
 	my $dir = 'docs' ;
@@ -21,7 +21,14 @@ const READY_TIMEOUT_MS = Math.max(
 );
 const UV_SYNC_TIMEOUT_MS = Math.max(10_000, readEnvInt('DIFFF_DESKTOP_UV_SYNC_TIMEOUT_SEC', 180) * 1000);
 const HTTP_TIMEOUT_MS = 1500;
+const WORKER_SOCKET_RELATIVE = path.join('data', 'annotate.sock');
 const READY_MARKER_RE = /id=['"]compare-form['"]/;
+// tools/pyproject.toml の optional-dependencies（例: fast = numpy）。sync と run の両方に同じ --extra を渡す
+const UV_EXTRA_ARGS = (process.env.DIFFF_UV_EXTRAS || '')
+  .split(',')
+  .map((name) => name.trim())
+  .filter((name) => /^[A-Za-z0-9_-]+$/.test(name))
+  .flatMap((name) => ['--extra', name]);
 
 function resolveSourceRoot() {
   if (process.env.DIFFF_DESKTOP_ROOT && process.env.DIFFF_DESKTOP_ROOT.trim() !== '') {
@@ -250,7 +257,7 @@ function ensureProjectEnvironment(uvCmd, runtimeRoot, logger) {
 
   let result = runUvSync(
     uvCmd,
-    ['sync', '--project', 'tools', '--offline', '--no-python-downloads'],
+    ['sync', '--project', 'tools', ...UV_EXTRA_ARGS, '--offline', '--no-python-downloads'],
     runtimeRoot,
     syncEnv
   );
@@ -263,7 +270,7 @@ function ensureProjectEnvironment(uvCmd, runtimeRoot, logger) {
     logger.warn('uv.sync.offline.failed', {
       detail: summarizeRunResult(result),
     });
-    result = runUvSync(uvCmd, ['sync', '--project', 'tools'], runtimeRoot, syncEnv);
+    result = runUvSync(uvCmd, ['sync', '--project', 'tools', ...UV_EXTRA_ARGS], runtimeRoot, syncEnv);
     if (isTimedOut(result)) {
       throw new Error(`uv sync timed out. ${summarizeRunResult(result)}`);
     }
@@ -470,6 +477,65 @@ async function resolveListenPort(preferredPort, logger) {
   return { port: randomPort, fallback: true };
 }
 
+function startAnnotateWorker(uvCmd, runtimeRoot, projectEnv, logger) {
+  // CGI側 (difff.pl) は既定で data/annotate.sock を参照し、未起動なら uv run にフォールバックする
+  const args = [
+    'run', '--project', 'tools', ...UV_EXTRA_ARGS, 'python', 'tools/pdf_annotate_diff.py',
+    '--phase', 'serve',
+    '--socket', WORKER_SOCKET_RELATIVE,
+  ];
+  const worker = spawn(uvCmd, args, {
+    cwd: runtimeRoot,
+    env: {
+      ...process.env,
+      UV_PROJECT_ENVIRONMENT: projectEnv,
+    },
+    stdio: ['ignore', 'ignore', 'pipe'],
+  });
+
+  let workerError = '';
+  worker.stderr.on('data', (chunk) => {
+    workerError += String(chunk);
+    if (workerError.length > 8000) {
+      workerError = workerError.slice(-8000);
+    }
+  });
+  worker.once('error', (err) => {
+    logger.warn('worker.error', {
+      error: err && err.message ? err.message : String(err),
+    });
+  });
+  worker.once('exit', (code, signal) => {
+    logger.warn('worker.exit', {
+      code,
+      signal,
+      stderr: workerError.trim().slice(-2000),
+    });
+  });
+
+  logger.info('worker.start', {
+    socket: path.join(runtimeRoot, WORKER_SOCKET_RELATIVE),
+    command: `${uvCmd} ${args.join(' ')}`,
+  });
+  return worker;
+}
+
+async function stopChild(proc) {
+  if (!proc || proc.killed || proc.exitCode !== null) return;
+
+  proc.kill('SIGTERM');
+
+  await Promise.race([
+    new Promise((resolve) => proc.once('exit', () => resolve())),
+    new Promise((resolve) => {
+      setTimeout(() => {
+        if (!proc.killed) proc.kill('SIGKILL');
+        resolve();
+      }, 3000);
+    }),
+  ]);
+}
+
 async function startServer(options = {}) {
   const buildId = options.buildId || 'unknown';
   const logger = createLogger(buildId);
@@ -486,6 +552,7 @@ async function startServer(options = {}) {
       ready_timeout_ms: READY_TIMEOUT_MS,
       uv_sync_timeout_ms: UV_SYNC_TIMEOUT_MS,
       uv_cmd: uvCmd,
+      uv_extra_args: UV_EXTRA_ARGS,
     });
 
     if (!fs.existsSync(uvCmd)) {
@@ -493,10 +560,11 @@ async function startServer(options = {}) {
     }
 
     const projectEnv = ensureProjectEnvironment(uvCmd, runtimeRoot, logger);
+    const worker = startAnnotateWorker(uvCmd, runtimeRoot, projectEnv, logger);
     const portInfo = await resolveListenPort(DEFAULT_PORT, logger);
     const port = portInfo.port;
 
-    const args = ['run', '--project', 'tools', 'python', '-m', 'http.server', '--cgi', String(port)];
+    const args = ['run', '--project', 'tools', ...UV_EXTRA_ARGS, 'python', '-m', 'http.server', '--cgi', String(port)];
     const child = spawn(uvCmd, args, {
       cwd: runtimeRoot,
       env: {
@@ -543,6 +611,7 @@ async function startServer(options = {}) {
       ]);
     } catch (err) {
       if (!child.killed) child.kill('SIGTERM');
+      if (!worker.killed) worker.kill('SIGTERM');
       throw err;
     }
 
@@ -555,6 +624,7 @@ async function startServer(options = {}) {
 
     return {
       child,
+      worker,
       port,
       appUrl,
       root: runtimeRoot,
@@ -575,18 +645,7 @@ async function startServer(options = {}) {
 async function stopServer(server) {
   if (!server || !server.child || server.child.killed) return;
 
-  const proc = server.child;
-  proc.kill('SIGTERM');
-
-  await Promise.race([
-    new Promise((resolve) => proc.once('exit', () => resolve())),
-    new Promise((resolve) => {
-      setTimeout(() => {
-        if (!proc.killed) proc.kill('SIGKILL');
-        resolve();
-      }, 3000);
-    }),
-  ]);
+  await Promise.all([stopChild(server.child), stopChild(server.worker)]);
 
   if (server.startupLogPath) {
     try {
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import functools
+import hashlib
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable
+
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+from reportlab.pdfgen import canvas
+
+import pdf_annotate_diff as pad
+
+
+# 合成PDFで --phase pipeline 相当の処理を測り、基準値（以前の結果JSON）より遅くなった段階があれば失敗にする。
+# 各ケースは毎回新しい子プロセス（spawn）で1回ずつ実行し、段階ごとの時間は中央値、メモリは ru_maxrss を取る。
+#   python tools/bench_annotate.py --extractor pypdf --output-json bench.json
+#   python tools/bench_annotate.py --baseline bench_baseline.json --save-baseline   # 基準値を作る/更新する
+#   python tools/bench_annotate.py --baseline bench_baseline.json                   # 比較（退行があれば終了コード 1）
+
+PAGE_W = 595.27
+PAGE_H = 841.89
+PAGE_MARGIN = 56.0
+FONT_SIZE = 10.0
+LINE_HEIGHT = 16.0
+CJK_FONT = "HeiseiMin-W3"
+LATIN_FONT = "Helvetica"
+CJK_LINE_CHARS = (28, 36)
+LATIN_LINE_WORDS = (8, 12)
+INSERT_CHARS = (3, 8)
+
+CJK_CHARS = (
+    "日本語文書比較差分変更追加削除条項規定契約当事者甲乙本件対象期間更新通知書面合意解除責任損害賠償"
+    "秘密情報開示目的範囲管理義務違反場合相手方前項各号定次第以下同様履行期限支払金額請求費用負担"
+    "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん"
+)
+LATIN_WORDS = (
+    "agreement party shall notice term section clause provided that such other any all each "
+    "within days written consent liability damages information purpose scope obligation breach "
+    "payment amount request cost period renewal termination effective date version draft"
+).split()
+
+DEFAULT_CASES: list[dict[str, Any]] = [
+    {"name": "mixed-20p", "pages": 20, "cjk_ratio": 0.5, "edit_density": 0.05, "delete_run": 4, "comments_per_page": 2},
+    {"name": "cjk-100p", "pages": 100, "cjk_ratio": 1.0, "edit_density": 0.02, "delete_run": 6, "comments_per_page": 1},
+    {"name": "dense-edits-10p", "pages": 10, "cjk_ratio": 0.7, "edit_density": 0.4, "delete_run": 2, "comments_per_page": 6},
+    {"name": "many-comments-5p", "pages": 5, "cjk_ratio": 0.5, "edit_density": 0.1, "delete_run": 8, "comments_per_page": 30},
+]
+CASE_DEFAULTS: dict[str, Any] = {
+    "pages": 10,
+    "cjk_ratio": 0.5,
+    "edit_density": 0.05,
+    "delete_run": 4,
+    "comments_per_page": 2,
+    "seed": 1,
+}
+
+# 段階名 -> 計測する関数（モジュール属性またはクラスのメソッド）。入れ子になった計測対象の時間は外側から差し引く
+PHASES: dict[str, list[tuple[Any, str]]] = {
+    "extract": [(pad, "reconstruct_words")],
+    "reconstruct": [
+        (pad, "reconstruct_text_from_words"),
+        (pad, "split_text_ids"),
+        (pad, "build_token_bbox_map_from_words"),
+        (pad, "token_word_index"),
+        (pad, "normalize_token_map_size"),
+        (pad, "token_map_arrays"),
+    ],
+    "diff": [
+        (pad, "diff_sequences"),
+        (pad, "run_diff_command"),
+        (pad, "hunks_from_diff_lines"),
+        (pad, "ranges_from_hunks"),
+    ],
+    "ranges": [
+        (pad, "bridge_deleted_ranges"),
+        (pad, "dedupe_draw_entries"),
+        (pad.TokenMapArrays, "draw_entries"),
+        (pad.DeletedGroupLookup, "__init__"),
+        (pad, "build_comment_annotations"),
+        (pad, "bucket_draw_entries"),
+    ],
+    "overlay_render": [
+        (pad, "merge_overlay_pages"),
+        (pad, "merge_comment_pages"),
+        (pad, "merge_overlay_incremental"),
+        (pad, "write_native_annotations"),
+        (pad, "add_native_pages"),
+    ],
+    "comment_layout": [(pad, "build_comment_layout_pages")],
+    "write": [(pad, "write_pdf"), (pad, "write_pdf_bytes"), (pad, "optimize_pdf_writer"), (pad, "concat_pdf_parts")],
+}
+
+
+class PhaseTimer:
+    def __init__(self) -> None:
+        self.seconds: dict[str, float] = defaultdict(float)
+        # 実行中の計測対象ごとの「子の計測対象に使われた秒数」
+        self.stack: list[list[float]] = []
+
+    def wrap(self, phase: str, func: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(func)
+        def timed(*args: Any, **kwargs: Any) -> Any:
+            frame = [0.0]
+            self.stack.append(frame)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.stack.pop()
+                self.seconds[phase] += elapsed - frame[0]
+                if self.stack:
+                    self.stack[-1][0] += elapsed
+
+        return timed
+
+    def install(self) -> None:
+        for phase, targets in PHASES.items():
+            for owner, name in targets:
+                setattr(owner, name, self.wrap(phase, getattr(owner, name)))
+
+
+def case_params(case: dict[str, Any]) -> dict[str, Any]:
+    params = dict(CASE_DEFAULTS)
+    params.update({k: v for k, v in case.items() if k != "name"})
+    return params
+
+
+def random_line(rng: random.Random, cjk_ratio: float) -> tuple[str, str]:
+    if rng.random() < cjk_ratio:
+        return CJK_FONT, "".join(rng.choice(CJK_CHARS) for _ in range(rng.randint(*CJK_LINE_CHARS)))
+    return LATIN_FONT, " ".join(rng.choice(LATIN_WORDS) for _ in range(rng.randint(*LATIN_LINE_WORDS)))
+
+
+def generate_pair(params: dict[str, Any]) -> tuple[list[list[tuple[str, str]]], list[list[tuple[str, str]]]]:
+    # 各ページで edit_density の割合の行から delete_run 文字を消し、別の comments_per_page 行に語句を挿入する
+    rng = random.Random(params["seed"])
+    lines_per_page = int((PAGE_H - 2.0 * PAGE_MARGIN) // LINE_HEIGHT)
+    pages_a: list[list[tuple[str, str]]] = []
+    pages_b: list[list[tuple[str, str]]] = []
+    for _ in range(int(params["pages"])):
+        lines = [random_line(rng, float(params["cjk_ratio"])) for _ in range(lines_per_page)]
+        order = rng.sample(range(lines_per_page), lines_per_page)
+        inserts = set(order[: min(lines_per_page, int(params["comments_per_page"]))])
+        rest = order[len(inserts) :]
+        deletes = set(rest[: round(len(rest) * float(params["edit_density"]))])
+        revised: list[tuple[str, str]] = []
+        for k, (font, text) in enumerate(lines):
+            if k in deletes:
+                run = min(int(params["delete_run"]), len(text) - 1)
+                pos = rng.randrange(len(text) - run + 1)
+                text = text[:pos] + text[pos + run :]
+            elif k in inserts:
+                pos = rng.randrange(len(text) + 1)
+                if font == CJK_FONT:
+                    added = "".join(rng.choice(CJK_CHARS) for _ in range(rng.randint(*INSERT_CHARS)))
+                else:
+                    added = " " + " ".join(rng.choice(LATIN_WORDS) for _ in range(2)) + " "
+                text = text[:pos] + added + text[pos:]
+            revised.append((font, text))
+        pages_a.append(lines)
+        pages_b.append(revised)
+    return pages_a, pages_b
+
+
+def write_corpus_pdf(path: Path, pages: list[list[tuple[str, str]]]) -> None:
+    pdfmetrics.registerFont(UnicodeCIDFont(CJK_FONT))
+    c = canvas.Canvas(str(path), pagesize=(PAGE_W, PAGE_H), invariant=1)
+    for lines in pages:
+        y = PAGE_H - PAGE_MARGIN - FONT_SIZE
+        for font, text in lines:
+            c.setFont(font, FONT_SIZE)
+            c.drawString(PAGE_MARGIN, y, text)
+            y -= LINE_HEIGHT
+        c.showPage()
+    c.save()
+
+
+def corpus_paths(corpus_dir: Path, params: dict[str, Any]) -> tuple[Path, Path]:
+    # 同じパラメータなら同じPDFになるので、パラメータのハッシュで作り置きを使い回す
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    path_a = corpus_dir / f"{digest}-A.pdf"
+    path_b = corpus_dir / f"{digest}-B.pdf"
+    if not (path_a.exists() and path_b.exists()):
+        corpus_dir.mkdir(parents=True, exist_ok=True)
+        pages_a, pages_b = generate_pair(params)
+        write_corpus_pdf(path_a, pages_a)
+        write_corpus_pdf(path_b, pages_b)
+    return path_a, path_b
+
+
+def run_case_once(path_a: Path, path_b: Path, options: dict[str, Any]) -> dict[str, Any]:
+    # spawn された子プロセスで呼ばれる。起動直後の最大RSSを差し引けるように記録しておく
+    rss_start_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timer = PhaseTimer()
+    timer.install()
+    with tempfile.TemporaryDirectory(prefix="bench-") as out_dir:
+        out = Path(out_dir)
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        result = pad.run_pipeline(
+            path_a,
+            path_b,
+            out / "annotatedA.pdf",
+            out / "annotatedB.pdf",
+            out / "annotatedComment.pdf",
+            pdftotext_cmd=options["pdftotext_cmd"],
+            extractor=options["extractor"],
+            diff_engine=options["diff_engine"],
+            jobs=1,
+            ann_output_mode=options["ann_output_mode"],
+            annotation_style=options["annotation_style"],
+            page_window=options.get("page_window", 0),
+            optimize_output=options.get("optimize_output", False),
+        )
+        total = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        # 出力の大きさ（--optimize-output の有無で比べる）。差分が無いときは出力されない
+        output_bytes = sum(path.stat().st_size for path in out.glob("*.pdf"))
+    phases = {phase: timer.seconds.get(phase, 0.0) for phase in PHASES}
+    phases["other"] = max(0.0, total - sum(phases.values()))
+    summary = result["summary"]
+    return {
+        "phases": phases,
+        "total": total,
+        "cpu": cpu,
+        "rss_start_kb": rss_start_kb,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "output_bytes": output_bytes,
+        "counts": {
+            k: summary.get(k)
+            for k in (
+                "seq_a_tokens",
+                "seq_b_tokens",
+                "unique_deleted_draw_units",
+                "unique_added_draw_units",
+                "comment_count",
+                "comment_continuation_pages",
+            )
+        },
+    }
+
+
+def run_case(case: dict[str, Any], corpus_dir: Path, options: dict[str, Any], repeat: int) -> dict[str, Any]:
+    params = case_params(case)
+    path_a, path_b = corpus_paths(corpus_dir, params)
+    runs: list[dict[str, Any]] = []
+    context = multiprocessing.get_context("spawn")
+    for _ in range(max(1, repeat)):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            runs.append(pool.submit(run_case_once, path_a, path_b, options).result())
+
+    def median_ms(values: list[float]) -> float:
+        return round(statistics.median(values) * 1000.0, 1)
+
+    return {
+        "name": case["name"],
+        "params": params,
+        "pdf_bytes": {"a": path_a.stat().st_size, "b": path_b.stat().st_size},
+        "output_bytes": runs[0]["output_bytes"],
+        "phases_ms": {phase: median_ms([r["phases"][phase] for r in runs]) for phase in runs[0]["phases"]},
+        "total_ms": median_ms([r["total"] for r in runs]),
+        "cpu_ms": median_ms([r["cpu"] for r in runs]),
+        "peak_rss_mb": round(max(r["peak_rss_kb"] for r in runs) / 1024.0, 1),
+        "peak_rss_delta_mb": round(max(r["peak_rss_kb"] - r["rss_start_kb"] for r in runs) / 1024.0, 1),
+        "counts": runs[0]["counts"],
+    }
+
+
+def find_regressions(
+    cases: list[dict[str, Any]],
+    baseline: dict[str, Any],
+    threshold: float,
+    min_delta_ms: float,
+    memory_threshold: float,
+) -> list[dict[str, Any]]:
+    # 短い段階は揺れが大きいので、比率と絶対差（ms）の両方を超えたときだけ退行とみなす
+    base_cases = {c["name"]: c for c in baseline.get("cases", [])}
+    regressions: list[dict[str, Any]] = []
+    for case in cases:
+        base = base_cases.get(case["name"])
+        if base is None:
+            continue
+        if base.get("params") != case["params"]:
+            regressions.append({"case": case["name"], "metric": "params", "detail": "baseline params differ"})
+            continue
+        metrics = [(f"phases_ms.{k}", v, base.get("phases_ms", {}).get(k)) for k, v in case["phases_ms"].items()]
+        metrics.append(("total_ms", case["total_ms"], base.get("total_ms")))
+        for metric, now, before in metrics:
+            if before is None:
+                continue
+            if now > before * (1.0 + threshold) and now - before > min_delta_ms:
+                regressions.append({"case": case["name"], "metric": metric, "baseline": before, "current": now})
+        before_mb = base.get("peak_rss_delta_mb")
+        now_mb = case["peak_rss_delta_mb"]
+        if before_mb is not None and now_mb > before_mb * (1.0 + memory_threshold) and now_mb - before_mb > 1.0:
+            regressions.append({"case": case["name"], "metric": "peak_rss_delta_mb", "baseline": before_mb, "current": now_mb})
+    return regressions
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser()
+    p.add_argument("--cases", help="JSON list of cases; keys: name, pages, cjk_ratio, edit_density, delete_run, comments_per_page, seed")
+    p.add_argument("--only", action="append", default=[])
+    p.add_argument("--corpus-dir", default=str(Path(tempfile.gettempdir()) / "difff-bench-corpus"))
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--extractor", choices=pad.EXTRACTORS, default="pdftotext")
+    p.add_argument("--pdftotext-cmd", default=pad.DEFAULT_PDFTOTEXT_CMD)
+    p.add_argument("--diff-engine", choices=pad.DIFF_ENGINES, default="auto")
+    p.add_argument("--ann-output-mode", choices=pad.ANN_OUTPUT_MODES, default="full")
+    p.add_argument("--annotation-style", choices=pad.ANNOTATION_STYLES, default="overlay")
+    p.add_argument("--page-window", type=int, default=0)
+    p.add_argument("--optimize-output", action="store_true")
+
+    p.add_argument("--output-json")
+    p.add_argument("--baseline")
+    p.add_argument("--save-baseline", action="store_true")
+    p.add_argument("--threshold", type=float, default=0.25)
+    p.add_argument("--min-delta-ms", type=float, default=50.0)
+    p.add_argument("--memory-threshold", type=float, default=0.25)
+    return p.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    cases = DEFAULT_CASES
+    if args.cases:
+        cases = json.loads(Path(args.cases).read_text(encoding="utf-8"))
+    if args.only:
+        cases = [c for c in cases if c["name"] in args.only]
+    if not cases:
+        print("no benchmark cases selected", file=sys.stderr)
+        return 2
+    options = {
+        "extractor": args.extractor,
+        "pdftotext_cmd": args.pdftotext_cmd,
+        "diff_engine": args.diff_engine,
+        "ann_output_mode": args.ann_output_mode,
+        "annotation_style": args.annotation_style,
+        "page_window": max(0, args.page_window),
+        "optimize_output": args.optimize_output,
+    }
+
+    results: list[dict[str, Any]] = []
+    for case in cases:
+        result = run_case(case, Path(args.corpus_dir), options, args.repeat)
+        phases = " ".join(f"{k}={v:.0f}" for k, v in result["phases_ms"].items())
+        print(f"{result['name']}: total={result['total_ms']:.0f}ms rss={result['peak_rss_mb']:.0f}MB {phases}", file=sys.stderr)
+        results.append(result)
+
+    report: dict[str, Any] = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "pypdf": pad.PYPDF_VERSION,
+            "numpy": pad.np is not None,
+        },
+        "options": options,
+        "repeat": args.repeat,
+        "cases": results,
+    }
+
+    regressions: list[dict[str, Any]] = []
+    baseline_path = Path(args.baseline) if args.baseline else None
+    if baseline_path is not None and baseline_path.exists() and not args.save_baseline:
+        baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+        if baseline.get("options") != report["options"]:
+            print("warning: baseline was recorded with different options", file=sys.stderr)
+        regressions = find_regressions(results, baseline, args.threshold, args.min_delta_ms, args.memory_threshold)
+        report["baseline"] = str(baseline_path)
+        report["regressions"] = regressions
+        for r in regressions:
+            print(f"REGRESSION {r['case']} {r['metric']}: {r.get('baseline')} -> {r.get('current', r.get('detail'))}", file=sys.stderr)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        if baseline_path is None:
+            print("--save-baseline requires --baseline", file=sys.stderr)
+            return 2
+        baseline_path.write_text(text + "\n", encoding="utf-8")
+    if args.output_json:
+        Path(args.output_json).write_text(text + "\n", encoding="utf-8")
+    elif not args.save_baseline:
+        print(text)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
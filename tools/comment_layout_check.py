@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Any
+
+from pdf_annotate_diff import (
+    COMMENT_BOX_GAP,
+    COMMENT_BOX_PAD_X,
+    COMMENT_FONT_MIN,
+    COMMENT_FONT_START,
+    COMMENT_FONT_STEP,
+    COMMENT_MARGIN_PAD_X,
+    COMMENT_MARGIN_PAD_Y,
+    COMMENT_MARGIN_WIDTH,
+    build_comment_layout_pages,
+    build_comment_queue,
+    ensure_fonts,
+    iter_font_sizes,
+    place_comment_queue_on_page,
+    sort_comments_by_anchor,
+)
+
+
+# 1ページに大量のコメントがあるときのコメント余白レイアウトを確かめる。
+#   - 結果が「全フォントサイズを順に折り返して配置してみる」素直な方法と一致すること
+#   - 各コメントの行が欠けず重複せず順に載り、同じページのボックスが重ならず余白に収まること
+#   - コメント数を増やしたときの時間の伸びが線形に近いこと（既定 500 → 2,000件で 8 倍まで。2乗なら 16 倍）
+#   python tools/comment_layout_check.py
+#   python tools/comment_layout_check.py --counts 500,1000,2000 --max-growth 8 --output-json layout.json
+# --fit-counts は1ページに収まるかどうかの境目の件数（既定の seed で 7 / 6.5 / 6 ポイントと続きページが選ばれる）。一致と配置だけを確かめる
+
+PAGE_H = 841.89
+PAGE_W = 595.27
+TEXT_CHARS = (
+    "契約当事者甲乙本件対象期間更新通知書面合意解除責任損害賠償秘密情報開示目的範囲管理義務違反"
+    "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん"
+)
+LATIN_WORDS = "agreement party shall notice term section clause provided written consent liability".split()
+
+
+def make_comments(count: int, seed: int) -> list[dict[str, Any]]:
+    rng = random.Random(seed)
+    comments: list[dict[str, Any]] = []
+    for _ in range(count):
+        y_min = rng.uniform(40.0, PAGE_H - 60.0)
+        x_min = rng.uniform(40.0, PAGE_W - 120.0)
+        if rng.random() < 0.5:
+            text = "".join(rng.choice(TEXT_CHARS) for _ in range(rng.randint(3, 80)))
+        else:
+            text = " ".join(rng.choice(LATIN_WORDS) for _ in range(rng.randint(1, 14)))
+        comments.append(
+            {
+                "anchor": {"bbox": {"x_min": x_min, "y_min": y_min, "x_max": x_min + 40.0, "y_max": y_min + 10.0}},
+                "text": text,
+            }
+        )
+    # 実際の描画と同じく、アンカー順に 1 から番号を振る
+    return [dict(ann, marker_id=i) for i, ann in enumerate(sort_comments_by_anchor(comments, PAGE_H), start=1)]
+
+
+def reference_layout_pages(comments: list[dict[str, Any]], font_name: str) -> tuple[list[dict[str, Any]], float]:
+    # 下限による枝刈りをせず、大きいサイズから全件を折り返して配置してみる
+    inner_w = COMMENT_MARGIN_WIDTH - (2.0 * COMMENT_MARGIN_PAD_X)
+    text_w = inner_w - (2.0 * COMMENT_BOX_PAD_X)
+    for size in iter_font_sizes(COMMENT_FONT_START, COMMENT_FONT_MIN, COMMENT_FONT_STEP):
+        queue = build_comment_queue(comments, PAGE_H, text_w, font_name, size)
+        placements, remaining = place_comment_queue_on_page(queue, PAGE_H, COMMENT_MARGIN_PAD_X, inner_w, font_name, size, True)
+        if not remaining:
+            return [{"placements": placements, "font_size": size, "continuation": False}], size
+
+    size = COMMENT_FONT_MIN
+    queue = build_comment_queue(comments, PAGE_H, text_w, font_name, size)
+    placements, queue = place_comment_queue_on_page(queue, PAGE_H, COMMENT_MARGIN_PAD_X, inner_w, font_name, size, True)
+    layouts = [{"placements": placements, "font_size": size, "continuation": False}]
+    while queue:
+        placements, queue = place_comment_queue_on_page(queue, PAGE_H, COMMENT_MARGIN_PAD_X, inner_w, font_name, size, False)
+        if not placements:
+            raise RuntimeError("reference layout made no progress")
+        layouts.append({"placements": placements, "font_size": size, "continuation": True})
+    return layouts, size
+
+
+def check_layout(comments: list[dict[str, Any]], layouts: list[dict[str, Any]], font_name: str, size: float) -> list[str]:
+    errors: list[str] = []
+    inner_w = COMMENT_MARGIN_WIDTH - (2.0 * COMMENT_MARGIN_PAD_X)
+    text_w = inner_w - (2.0 * COMMENT_BOX_PAD_X)
+    expected = {item["marker_id"]: item["lines"] for item in build_comment_queue(comments, PAGE_H, text_w, font_name, size)}
+    placed: dict[int, list[str]] = {}
+    order: list[int] = []
+    for page_index, layout in enumerate(layouts):
+        boxes = sorted(layout["placements"], key=lambda p: -p["box_y"])
+        for placement in boxes:
+            marker_id = int(placement["marker_id"])
+            if not order or order[-1] != marker_id:
+                order.append(marker_id)
+            placed.setdefault(marker_id, []).extend(placement["lines"])
+            if placement["box_y"] < COMMENT_MARGIN_PAD_Y - 1e-6 or placement["box_y"] + placement["box_h"] > PAGE_H - COMMENT_MARGIN_PAD_Y + 1e-6:
+                errors.append(f"page {page_index}: comment {marker_id} is outside the margin")
+        for upper, lower in zip(boxes, boxes[1:]):
+            if lower["box_y"] + lower["box_h"] > upper["box_y"] - COMMENT_BOX_GAP + 1e-6:
+                errors.append(f"page {page_index}: comments {upper['marker_id']} and {lower['marker_id']} overlap")
+    if order != sorted(expected):
+        errors.append("comments are not placed once each in anchor order")
+    for marker_id, lines in expected.items():
+        if placed.get(marker_id) != lines:
+            errors.append(f"comment {marker_id}: placed lines differ from its wrapped lines")
+    return errors
+
+
+def best_time(func: Any, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def check_count(count: int, seed: int, font_name: str, repeat: int) -> dict[str, Any]:
+    comments = make_comments(count, seed)
+    layouts, size = build_comment_layout_pages(comments, PAGE_H, COMMENT_MARGIN_WIDTH, font_name)
+    ref_layouts, ref_size = reference_layout_pages(comments, font_name)
+    errors = check_layout(comments, layouts, font_name, size)
+    if (layouts, size) != (ref_layouts, ref_size):
+        errors.append("layout differs from the exhaustive font-size search")
+    elapsed = best_time(lambda: build_comment_layout_pages(comments, PAGE_H, COMMENT_MARGIN_WIDTH, font_name), repeat)
+    ref_elapsed = best_time(lambda: reference_layout_pages(comments, font_name), 1)
+    return {
+        "comments": count,
+        "font_size": size,
+        "pages": len(layouts),
+        "seconds": round(elapsed, 4),
+        "reference_seconds": round(ref_elapsed, 4),
+        "errors": errors[:20],
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser()
+    p.add_argument("--counts", default="500,1000,2000")
+    p.add_argument("--fit-counts", default="8,24,28,30")
+    p.add_argument("--seed", type=int, default=12)
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--max-growth", type=float, default=8.0)
+    p.add_argument("--output-json")
+    return p.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    counts = sorted({int(x) for x in args.counts.split(",") if x.strip()})
+    fit_counts = sorted({int(x) for x in args.fit_counts.split(",") if x.strip()})
+    if not counts or counts[0] <= 0 or any(x <= 0 for x in fit_counts):
+        print("--counts and --fit-counts must be positive integers", file=sys.stderr)
+        return 2
+    font_name, _ = ensure_fonts()
+    fit_results = [check_count(count, args.seed + count, font_name, 1) for count in fit_counts]
+    results = [check_count(count, args.seed + count, font_name, args.repeat) for count in counts]
+    growth = None
+    if len(results) > 1 and results[0]["seconds"] > 0:
+        # 最少件数に対する最多件数の時間比。線形なら件数比（既定 4）、2乗ならその2乗に近づく
+        growth = results[-1]["seconds"] / results[0]["seconds"]
+    report = {
+        "font": font_name,
+        "fit_results": fit_results,
+        "results": results,
+        "growth": round(growth, 2) if growth is not None else None,
+        "count_ratio": counts[-1] / counts[0],
+        "max_growth": args.max_growth,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output_json:
+        Path(args.output_json).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+    failed = any(r["errors"] for r in fit_results + results) or (growth is not None and growth > args.max_growth)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
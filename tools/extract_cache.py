@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import fcntl
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+
+# 抽出結果（再構成テキスト＋WordStore）を元PDFの内容で引くディスクキャッシュ。
+# 同じ基準PDF（A側）を多数の改訂版と比べるときに pdftotext と再構成を省く。
+#   キー   : sha256(PDF) + 抽出方式 + 抽出ツールの版（呼び出し側が文字列で渡す）
+#   書き込み: 同じディレクトリの一時ファイルに書いてから os.replace（読み手は書きかけを見ない）
+#   追い出し: 合計サイズが上限を超えたら mtime の古い順に削除（ヒット時に mtime を更新する LRU）
+# 複数のCGIプロセスが同時に使っても、追い出しはロックファイルの flock で1プロセスずつ行う。
+
+ENTRY_SUFFIX = ".bin"
+LOCK_NAME = ".lock"
+HASH_CHUNK = 1 << 20
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as fh:
+        while True:
+            chunk = fh.read(HASH_CHUNK)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(content_hash: str, *parts: str) -> str:
+    # 抽出方式やツールの版はファイル名に使えない文字を含みうるので、まとめてハッシュする
+    digest = hashlib.sha256(content_hash.encode("ascii"))
+    for part in parts:
+        digest.update(b"\0")
+        digest.update(part.encode("utf-8", errors="surrogatepass"))
+    return digest.hexdigest()
+
+
+class ExtractCache:
+    def __init__(self, root: Path, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max(0, int(max_bytes))
+        self.hits = 0
+        self.misses = 0
+
+    def entry_path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}{ENTRY_SUFFIX}"
+
+    def get(self, key: str) -> bytes | None:
+        path = self.entry_path(key)
+        try:
+            with path.open("rb") as fh:
+                data = fh.read()
+        except OSError:
+            # 未作成、または別プロセスの追い出しと行き違った
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        path = self.entry_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp_name, path)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+        with (self.root / LOCK_NAME).open("a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries: list[tuple[int, int, Path]] = []
+            total = 0
+            for path in self.root.glob(f"*/*{ENTRY_SUFFIX}"):
+                try:
+                    st = path.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, path))
+                total += st.st_size
+            if total <= self.max_bytes:
+                return
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                # 読み手が開いた後に消しても、開いたファイルはそのまま読める
+                path.unlink(missing_ok=True)
+                total -= size
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import json
+import subprocess
+import sys
+from difflib import SequenceMatcher
+from pathlib import Path
+from typing import Any
+
+from pdf_annotate_diff import (
+    DEFAULT_PDFTOTEXT_CMD,
+    PipelineError,
+    WordStore,
+    escape_char,
+    extract_words_pypdf,
+    parse_bbox_layout_file,
+    pdftotext_words,
+    reconstruct_text_from_words,
+    split_text,
+)
+
+
+DEFAULT_PDFS = ["public/A-base.pdf", "public/B-mod.pdf"]
+
+
+def bbox_iou(a: dict[str, float] | None, b: dict[str, float] | None) -> float | None:
+    if a is None or b is None:
+        return None
+    ix = min(a["x_max"], b["x_max"]) - max(a["x_min"], b["x_min"])
+    iy = min(a["y_max"], b["y_max"]) - max(a["y_min"], b["y_min"])
+    inter = max(0.0, ix) * max(0.0, iy)
+    area_a = (a["x_max"] - a["x_min"]) * (a["y_max"] - a["y_min"])
+    area_b = (b["x_max"] - b["x_min"]) * (b["y_max"] - b["y_min"])
+    union = area_a + area_b - inter
+    return inter / union if union > 0 else None
+
+
+def bbox_max_delta(a: dict[str, float] | None, b: dict[str, float] | None) -> float | None:
+    if a is None or b is None:
+        return None
+    return max(abs(a[k] - b[k]) for k in ("x_min", "y_min", "x_max", "y_max"))
+
+
+def compare_words(ref: WordStore, got: WordStore) -> dict[str, Any]:
+    text_ref = reconstruct_text_from_words(ref)
+    text_got = reconstruct_text_from_words(got)
+    matcher = SequenceMatcher(None, list(ref.iter_texts()), list(got.iter_texts()), autojunk=False)
+    ious: list[float] = []
+    deltas: list[float] = []
+    matched = 0
+    line_breaks_same = 0
+    for block in matcher.get_matching_blocks():
+        for k in range(block.size):
+            w_ref = ref[block.a + k]
+            w_got = got[block.b + k]
+            matched += 1
+            iou = bbox_iou(w_ref.bbox, w_got.bbox)
+            if iou is not None:
+                ious.append(iou)
+            delta = bbox_max_delta(w_ref.bbox, w_got.bbox)
+            if delta is not None:
+                deltas.append(delta)
+            if k > 0:
+                prev_ref = ref[block.a + k - 1]
+                prev_got = got[block.b + k - 1]
+                if (prev_ref.line_seq == w_ref.line_seq) == (prev_got.line_seq == w_got.line_seq):
+                    line_breaks_same += 1
+    pairs = sum(max(0, b.size - 1) for b in matcher.get_matching_blocks())
+    return {
+        "words": {"pdftotext": len(ref), "pypdf": len(got), "matched": matched},
+        "lines": {
+            "pdftotext": len(set(zip(ref.page, ref.line_seq))),
+            "pypdf": len(set(zip(got.page, got.line_seq))),
+            "break_agreement": round(line_breaks_same / pairs, 4) if pairs else None,
+        },
+        "tokens": {
+            "pdftotext": len(split_text(escape_char(text_ref))),
+            "pypdf": len(split_text(escape_char(text_got))),
+        },
+        "text_identical": text_ref == text_got,
+        "text_similarity": round(SequenceMatcher(None, text_ref, text_got, autojunk=False).ratio(), 4),
+        "bbox_iou_mean": round(sum(ious) / len(ious), 4) if ious else None,
+        "bbox_iou_min": round(min(ious), 4) if ious else None,
+        "bbox_max_delta_pt": round(max(deltas), 3) if deltas else None,
+    }
+
+
+def parity_for_pdf(pdf: Path, pdftotext_cmd: str, timeout: float, xhtml: Path | None) -> dict[str, Any]:
+    got = extract_words_pypdf(pdf)
+    report: dict[str, Any] = {
+        "pdf": str(pdf),
+        "pypdf_words": len(got),
+        "pypdf_text_chars": len(reconstruct_text_from_words(got)),
+    }
+    try:
+        if xhtml is not None:
+            ref = parse_bbox_layout_file(xhtml)
+        else:
+            ref = pdftotext_words(pdf, pdftotext_cmd, timeout)
+    except (OSError, subprocess.SubprocessError, PipelineError) as exc:
+        report["error"] = f"pdftotext unavailable: {exc}"
+        return report
+
+    report["document"] = compare_words(ref, got)
+    pages = sorted(set(ref.page) | set(got.page))
+    report["pages"] = [
+        {
+            "page": page,
+            **compare_words(
+                WordStore.from_words(w for w in ref if w.page == page),
+                WordStore.from_words(w for w in got if w.page == page),
+            ),
+        }
+        for page in pages
+    ]
+    return report
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser()
+    p.add_argument("pdfs", nargs="*", default=DEFAULT_PDFS)
+    p.add_argument("--pdftotext-cmd", default=DEFAULT_PDFTOTEXT_CMD)
+    p.add_argument("--pdftotext-timeout", type=float, default=60.0)
+    p.add_argument("--xhtml", action="append", default=[])
+    p.add_argument("--output-json")
+    return p.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    if args.xhtml and len(args.xhtml) != len(args.pdfs):
+        print("--xhtml must be given once per pdf", file=sys.stderr)
+        return 2
+    xhtmls: list[Path | None] = [Path(x) for x in args.xhtml] or [None] * len(args.pdfs)
+    reports = [
+        parity_for_pdf(Path(pdf), args.pdftotext_cmd, args.pdftotext_timeout, xhtml)
+        for pdf, xhtml in zip(args.pdfs, xhtmls)
+    ]
+    text = json.dumps(reports, ensure_ascii=False, indent=2)
+    if args.output_json:
+        Path(args.output_json).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+    return 0 if all("error" not in r for r in reports) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
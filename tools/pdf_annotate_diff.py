@@ -2,22 +2,65 @@
 from __future__ import annotations
 
 import argparse
+import cProfile
+import hashlib
 import html
 import json
+import math
+import mmap
+import os
+import re
+import resource
+import select
+import shutil
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
 import sys
-from collections import defaultdict
+import tempfile
+import threading
+import time
+import traceback
+import tracemalloc
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
+from functools import lru_cache
 from html.parser import HTMLParser
-from io import BytesIO
+from io import BytesIO, StringIO, TextIOWrapper
 from pathlib import Path
-from typing import Any
-
-from pypdf import PdfReader, PdfWriter
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, TextIO, Union
+
+from pypdf import PdfReader, PdfWriter, __version__ as PYPDF_VERSION
+from pypdf.generic import (
+    ArrayObject,
+    DictionaryObject,
+    FloatObject,
+    IndirectObject,
+    NameObject,
+    NumberObject,
+    create_string_object,
+)
 from reportlab.lib.colors import Color
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.cidfonts import UnicodeCIDFont
 from reportlab.pdfgen import canvas
 
+try:
+    import numpy as np
+except ImportError:  # numpy は任意。無ければ token_map の dict を純Pythonで走査する
+    np = None
+
+from extract_cache import ExtractCache, cache_key, file_sha256
+from pdf_concat import concat_pdf_parts
+from pypdf_words import cid_to_unicode_version, iter_pdf_words
+from token_diff import DiffTooExpensiveError, Hunk, StepBudget, TokenTable, build_diff_table, diff_sequences
+
 
 COMMENT_MARGIN_WIDTH = 180.0
 COMMENT_FONT_START = 7.0
@@ -29,6 +72,45 @@ COMMENT_BOX_PAD_X = 3.0
 COMMENT_BOX_PAD_Y = 2.0
 COMMENT_BOX_GAP = 4.0
 COMMENT_MERGE_GAP_PT = 8.0
+READER_CACHE_SIZE = 8
+PARALLEL_MIN_PAGES = 32
+PARALLEL_MIN_CHUNK_PAGES = 8
+OVERLAY_RESOURCE_CATEGORIES = ("/Font", "/ExtGState")
+MERGE_RESOURCE_CATEGORIES = ("/ExtGState", "/Font", "/XObject", "/ColorSpace", "/Pattern", "/Shading", "/Properties")
+DEFAULT_DIFF_CMD = "/usr/bin/diff"
+DEFAULT_PDFTOTEXT_CMD = "pdftotext"
+EXTRACTORS = ("pdftotext", "pypdf")
+DIFF_ENGINES = ("auto", "builtin", "external")
+ANN_OUTPUT_MODES = ("full", "incremental")
+ANNOTATION_STYLES = ("overlay", "native")
+# --outputs で選ぶ名前と、summary・段階名で使う出力名
+OUTPUT_NAMES = {"annA": "ann_a", "annB": "ann_b", "annComment": "ann_comment"}
+DRAW_PLANS_VERSION = 1
+CHANGES_INDEX_VERSION = 1
+EXTRACT_CACHE_MAX_MB = 256
+# ru_maxrss の単位は Linux では KiB、macOS ではバイト
+RSS_UNITS_PER_MB = 1024 * 1024 if sys.platform == "darwin" else 1024
+ANNOT_FLAG_PRINT = 4
+ANNOT_FLAG_NO_ZOOM = 8
+ANNOT_FLAG_NO_ROTATE = 16
+NOTE_ICON_SIZE = 12.0
+# auto: 組み込み差分が変更量の多さで重くなりすぎたら `diff` コマンドへ切り替える
+DIFF_AUTO_MAX_STEPS = 10_000_000
+XHTML_CHUNK_SIZE = 1 << 20
+
+# 出力先はファイルパスか、ライブラリ利用時の BytesIO などの書き込み可能バッファ
+PdfOutput = Union[Path, BinaryIO]
+
+
+class PipelineError(Exception):
+    pass
+
+
+class TextTooLargeError(PipelineError):
+    def __init__(self, side: str, limit: int) -> None:
+        super().__init__(f"extracted text too large ({side} > {limit})")
+        self.side = side
+        self.limit = limit
 
 
 @dataclass
@@ -40,6 +122,197 @@ class Word:
     bbox: dict[str, float] | None
 
 
+WORD_STORE_MAGIC = b"DWS1"
+WORD_STORE_HEADER = struct.Struct("<4sQQ")
+# 抽出キャッシュの1件: 再構成テキスト(UTF-8) + WordStore(DWS1)。
+# 単語化・再構成の規則を変えたら版を上げて、古いキャッシュを使わないようにする
+EXTRACTION_MAGIC = b"DXC1"
+EXTRACTION_HEADER = struct.Struct("<4sQ")
+# annotate の入力（token_map・範囲・op）: ヘッダ（magic・列数・deleted_bridge_chars）の後に、
+# 下の順で「バイト数(Q) + 列の中身（8バイト境界まで詰め物）」が並ぶ。列は mmap からそのまま読む
+ANNOTATE_INPUT_MAGIC = b"DAI1"
+ANNOTATE_INPUT_HEADER = struct.Struct("<4sIq")
+ANNOTATE_INPUT_SECTION = struct.Struct("<Q")
+# 片側の token_map。単語表は (page, line_seq, word_seq, bbox) が同じ token を1行にまとめ、token は行番号で参照する。
+# token_bbox_kind: 0=なし 1=単語のbbox 2=同じ単語の連続する token 数で単語のbboxを等分したもの 3=explicit_* の値
+ANNOTATE_INPUT_SIDE_COLUMNS = (
+    ("word_page", "i"),
+    ("word_line_seq", "i"),
+    ("word_word_seq", "i"),
+    ("word_has_bbox", "B"),
+    ("word_x_min", "d"),
+    ("word_y_min", "d"),
+    ("word_x_max", "d"),
+    ("word_y_max", "d"),
+    ("token_word", "i"),
+    ("token_index", "i"),
+    ("token_bbox_kind", "B"),
+    ("token_text_end", "q"),
+    ("token_text", "B"),
+    ("explicit_token", "q"),
+    ("explicit_x_min", "d"),
+    ("explicit_y_min", "d"),
+    ("explicit_x_max", "d"),
+    ("explicit_y_max", "d"),
+)
+ANNOTATE_INPUT_COLUMNS = (
+    tuple((f"a_{name}", code) for name, code in ANNOTATE_INPUT_SIDE_COLUMNS)
+    + tuple((f"b_{name}", code) for name, code in ANNOTATE_INPUT_SIDE_COLUMNS)
+    + (
+        ("deleted_ranges", "q"),
+        ("added_ranges", "q"),
+        ("op_type", "B"),
+        ("op_a_start", "q"),
+        ("op_a_end", "q"),
+        ("op_b_start", "q"),
+        ("op_b_end", "q"),
+    )
+)
+
+
+class WordStore:
+    # 単語ごとの Word/bbox dict を作らず、列ごとの配列と1本のテキストで保持する
+    def __init__(self) -> None:
+        self.page = array("i")
+        self.line_seq = array("i")
+        self.word_seq = array("i")
+        self.has_bbox = bytearray()
+        self.x_min = array("d")
+        self.y_min = array("d")
+        self.x_max = array("d")
+        self.y_max = array("d")
+        self.text_end = array("q")
+        self._text_buf = StringIO()
+        self._text_len = 0
+        self._text: str | None = ""
+
+    def __len__(self) -> int:
+        return len(self.page)
+
+    def append_coords(
+        self,
+        page: int,
+        line_seq: int,
+        word_seq: int,
+        text: str,
+        coords: tuple[float, float, float, float] | None,
+    ) -> None:
+        self.page.append(page)
+        self.line_seq.append(line_seq)
+        self.word_seq.append(word_seq)
+        if coords is None:
+            self.has_bbox.append(0)
+            coords = (0.0, 0.0, 0.0, 0.0)
+        else:
+            self.has_bbox.append(1)
+        self.x_min.append(coords[0])
+        self.y_min.append(coords[1])
+        self.x_max.append(coords[2])
+        self.y_max.append(coords[3])
+        self._text_buf.write(text)
+        self._text_len += len(text)
+        self.text_end.append(self._text_len)
+        self._text = None
+
+    def append(self, page: int, line_seq: int, word_seq: int, text: str, bbox: dict[str, float] | None) -> None:
+        coords = None
+        if bbox is not None:
+            coords = (bbox["x_min"], bbox["y_min"], bbox["x_max"], bbox["y_max"])
+        self.append_coords(page, line_seq, word_seq, text, coords)
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self._text_buf.getvalue()
+        return self._text
+
+    def text_at(self, i: int) -> str:
+        start = self.text_end[i - 1] if i > 0 else 0
+        return self.text[start : self.text_end[i]]
+
+    def iter_texts(self) -> Iterator[str]:
+        text = self.text
+        start = 0
+        for end in self.text_end:
+            yield text[start:end]
+            start = end
+
+    def bbox(self, i: int) -> dict[str, float] | None:
+        if not self.has_bbox[i]:
+            return None
+        return {
+            "x_min": self.x_min[i],
+            "y_min": self.y_min[i],
+            "x_max": self.x_max[i],
+            "y_max": self.y_max[i],
+        }
+
+    def __getitem__(self, i: int) -> Word:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("word index out of range")
+        return Word(self.page[i], self.line_seq[i], self.word_seq[i], self.text_at(i), self.bbox(i))
+
+    def __iter__(self) -> Iterator[Word]:
+        for i, text in enumerate(self.iter_texts()):
+            yield Word(self.page[i], self.line_seq[i], self.word_seq[i], text, self.bbox(i))
+
+    def columns(self) -> tuple[Any, ...]:
+        return (
+            self.page,
+            self.line_seq,
+            self.word_seq,
+            self.x_min,
+            self.y_min,
+            self.x_max,
+            self.y_max,
+            self.text_end,
+        )
+
+    def to_bytes(self) -> bytes:
+        text = self.text.encode("utf-8", errors="surrogatepass")
+        parts = [WORD_STORE_HEADER.pack(WORD_STORE_MAGIC, len(self), len(text))]
+        for col in self.columns():
+            if sys.byteorder != "little":
+                col = array(col.typecode, col)
+                col.byteswap()
+            parts.append(col.tobytes())
+        parts.append(bytes(self.has_bbox))
+        parts.append(text)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> WordStore:
+        magic, count, text_size = WORD_STORE_HEADER.unpack_from(data, 0)
+        if magic != WORD_STORE_MAGIC:
+            raise ValueError("not a word store")
+        store = cls()
+        offset = WORD_STORE_HEADER.size
+        for col in store.columns():
+            size = col.itemsize * count
+            col.frombytes(data[offset : offset + size])
+            if sys.byteorder != "little":
+                col.byteswap()
+            offset += size
+        store.has_bbox = bytearray(data[offset : offset + count])
+        offset += count
+        text = data[offset : offset + text_size].decode("utf-8", errors="surrogatepass")
+        if offset + text_size != len(data) or len(store.has_bbox) != count:
+            raise ValueError("truncated word store")
+        store._text_buf.write(text)
+        store._text_len = len(text)
+        store._text = text
+        return store
+
+    @classmethod
+    def from_words(cls, words: Any) -> WordStore:
+        store = cls()
+        for w in words:
+            store.append(w.page, w.line_seq, w.word_seq, w.text, w.bbox)
+        return store
+
+
 class BboxLayoutParser(HTMLParser):
     def __init__(self) -> None:
         super().__init__(convert_charrefs=False)
@@ -49,7 +322,7 @@ class BboxLayoutParser(HTMLParser):
         self.in_word = False
         self.word_attrs: dict[str, str] = {}
         self.word_buf: list[str] = []
-        self.words: list[Word] = []
+        self.words = WordStore()
 
     def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
         attrs_map = {k.lower(): (v if v is not None else "") for k, v in attrs}
@@ -72,60 +345,906 @@ class BboxLayoutParser(HTMLParser):
             return
         self.in_word = False
         text = "".join(self.word_buf)
-        bbox = None
+        coords = None
         keys = ("xmin", "ymin", "xmax", "ymax")
         if all(k in self.word_attrs for k in keys):
             try:
-                bbox = {
-                    "x_min": float(self.word_attrs["xmin"]),
-                    "y_min": float(self.word_attrs["ymin"]),
-                    "x_max": float(self.word_attrs["xmax"]),
-                    "y_max": float(self.word_attrs["ymax"]),
-                }
+                coords = (
+                    float(self.word_attrs["xmin"]),
+                    float(self.word_attrs["ymin"]),
+                    float(self.word_attrs["xmax"]),
+                    float(self.word_attrs["ymax"]),
+                )
             except ValueError:
-                bbox = None
+                coords = None
         page_word_seq = self.word_seq_by_page[self.page_idx]
         self.word_seq_by_page[self.page_idx] += 1
-        self.words.append(
-            Word(
-                page=self.page_idx,
-                line_seq=self.line_seq,
-                word_seq=page_word_seq,
-                text=text,
-                bbox=bbox,
-            )
-        )
+        self.words.append_coords(self.page_idx, self.line_seq, page_word_seq, text, coords)
+
+
+# pdftotext -bbox-layout が出力する素直なタグ・実体参照だけを正規表現で拾う。
+# ここに合わないマークアップが来たら、その位置以降を HTMLParser にまとめて渡す。
+BBOX_START_TAG_RE = re.compile(r'<([a-zA-Z][-.:a-zA-Z0-9_]*)((?:\s+[a-zA-Z_:][-.:a-zA-Z0-9_]*\s*=\s*"[^"]*")*)\s*(/?)>')
+BBOX_ATTR_RE = re.compile(r'([a-zA-Z_:][-.:a-zA-Z0-9_]*)\s*=\s*"([^"]*)"')
+BBOX_END_TAG_RE = re.compile(r"</([a-zA-Z][-.:a-zA-Z0-9_]*)\s*>")
+BBOX_PI_RE = re.compile(r"<\?[^>]*>")
+BBOX_DOCTYPE_RE = re.compile(r"<!doctype[^>]*>", re.IGNORECASE)
+BBOX_REF_RE = re.compile(r"&(?:#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z][-.a-zA-Z0-9]*);")
 
 
-def reconstruct_from_xhtml(input_xhtml: Path) -> dict[str, Any]:
-    parser = BboxLayoutParser()
-    parser.feed(input_xhtml.read_text(encoding="utf-8", errors="replace"))
+class BboxLayoutScanner(BboxLayoutParser):
+    def __init__(self) -> None:
+        super().__init__()
+        self.buf = ""
+        self.fallback_parts: list[str] | None = None
 
+    def feed_chunk(self, chunk: str, final: bool = False) -> None:
+        if self.fallback_parts is not None:
+            self.fallback_parts.append(chunk)
+        else:
+            self.buf += chunk
+            self.scan(final)
+        if final and self.fallback_parts is not None:
+            # 1回の feed と同じ結果にするため、引き継いだ残りは最後にまとめて流す
+            HTMLParser.feed(self, "".join(self.fallback_parts))
+            self.fallback_parts = []
+
+    def hand_off(self, rest: str) -> None:
+        self.fallback_parts = [rest]
+        self.buf = ""
+
+    def scan(self, final: bool) -> None:
+        buf = self.buf
+        pos = 0
+        n = len(buf)
+        while pos < n:
+            lt = buf.find("<", pos)
+            if lt < 0:
+                if not self.in_word and "&" not in buf[pos:]:
+                    pos = n
+                break
+            if lt > pos:
+                data = buf[pos:lt]
+                if "&" in data:
+                    parts = BBOX_REF_RE.split(data)
+                    if any("&" in part for part in parts):
+                        self.hand_off(buf[pos:])
+                        return
+                    if self.in_word:
+                        for part in parts:
+                            self.handle_data(part)
+                elif self.in_word:
+                    self.handle_data(data)
+            pos = lt
+
+            kind = buf[lt + 1 : lt + 2]
+            m = None
+            tag = ""
+            if kind.isascii() and kind.isalpha():
+                m = BBOX_START_TAG_RE.match(buf, lt)
+                if m is not None:
+                    tag = m.group(1).lower()
+                    if tag in self.CDATA_CONTENT_ELEMENTS:
+                        m = None
+            elif kind == "/":
+                m = BBOX_END_TAG_RE.match(buf, lt)
+            elif kind == "?":
+                m = BBOX_PI_RE.match(buf, lt)
+            elif kind == "!":
+                m = BBOX_DOCTYPE_RE.match(buf, lt)
+
+            if m is None:
+                if not final and buf.find(">", lt) < 0:
+                    break
+                self.hand_off(buf[lt:])
+                return
+
+            if kind == "/":
+                self.handle_endtag(m.group(1).lower())
+            elif tag:
+                attrs: list[tuple[str, str | None]] = [
+                    (name.lower(), html.unescape(value) if "&" in value else value)
+                    for name, value in BBOX_ATTR_RE.findall(m.group(2))
+                ]
+                self.handle_starttag(tag, attrs)
+                if m.group(3):
+                    self.handle_endtag(tag)
+            pos = m.end()
+        self.buf = buf[pos:]
+
+
+def read_bbox_layout(stream: TextIO, chunk_size: int = XHTML_CHUNK_SIZE) -> WordStore:
+    scanner = BboxLayoutScanner()
+    while True:
+        chunk = stream.read(chunk_size)
+        scanner.feed_chunk(chunk, final=not chunk)
+        if not chunk:
+            return scanner.words
+
+
+def parse_bbox_layout_file(input_xhtml: Path) -> WordStore:
+    with input_xhtml.open(encoding="utf-8", errors="replace") as fh:
+        return read_bbox_layout(fh)
+
+
+def reconstruct_text_from_words(words: WordStore) -> str:
     parts: list[str] = []
-    prev_page: int | None = None
-    prev_line: int | None = None
-    for word in parser.words:
-        if prev_page is not None:
-            same_page = prev_page == word.page
-            line_changed = prev_line != word.line_seq
-            if same_page and line_changed:
-                parts.append("\n")
-        parts.append(word.text)
-        prev_page = word.page
-        prev_line = word.line_seq
-
-    reconstructed_text = "".join(parts)
-    words_payload = [
-        {
-            "page": w.page,
-            "line_seq": w.line_seq,
-            "word_seq": w.word_seq,
-            "text": w.text,
-            "bbox": w.bbox,
+    pages = words.page
+    lines = words.line_seq
+    for i, text in enumerate(words.iter_texts()):
+        if i > 0 and pages[i - 1] == pages[i] and lines[i - 1] != lines[i]:
+            parts.append("\n")
+        parts.append(text)
+    return "".join(parts)
+
+
+def write_reconstruct_json(words: WordStore, out: TextIO) -> None:
+    # words_payload の dict 列を組み立てず、1語ずつ同じ書式のJSONを書き出す
+    dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+    out.write('{"reconstructed_text":')
+    out.write(dumps(reconstruct_text_from_words(words)))
+    out.write(',"words":[')
+    for i, text in enumerate(words.iter_texts()):
+        if i > 0:
+            out.write(",")
+        out.write(
+            f'{{"page":{words.page[i]},"line_seq":{words.line_seq[i]},"word_seq":{words.word_seq[i]},'
+            f'"text":{dumps(text)},"bbox":{dumps(words.bbox(i))}}}'
+        )
+    out.write("]}")
+
+
+def extract_words_pypdf(source_pdf: Path, stats: dict[str, int] | None = None) -> WordStore:
+    # pdftotext/XHTMLを経由せず、コンテンツストリームから直接単語bboxを取る
+    store = WordStore()
+    for page, line_seq, word_seq, text, bbox in iter_pdf_words(open_pdf_reader(source_pdf), stats):
+        store.append(page, line_seq, word_seq, text, bbox)
+    return store
+
+
+def pdftotext_words(source_pdf: Path, pdftotext_cmd: str, timeout_sec: float) -> WordStore:
+    # 標準出力をそのままスキャナへ流し、XHTML全文を文字列として保持しない
+    cmd = [pdftotext_cmd, "-bbox-layout", "-enc", "UTF-8", str(source_pdf), "-"]
+    with tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err)
+        timed_out = threading.Event()
+
+        def kill() -> None:
+            timed_out.set()
+            proc.kill()
+
+        timer = threading.Timer(timeout_sec, kill)
+        timer.start()
+        try:
+            assert proc.stdout is not None
+            with TextIOWrapper(proc.stdout, encoding="utf-8", errors="replace", newline="") as stream:
+                words = read_bbox_layout(stream)
+            returncode = proc.wait()
+        finally:
+            timer.cancel()
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(cmd, timeout_sec)
+        if returncode != 0:
+            err.seek(0)
+            detail = err.read().decode("utf-8", errors="replace").strip()
+            raise PipelineError(f"pdftotext failed ({source_pdf.name}): exit={returncode} {detail}".rstrip())
+    return words
+
+
+# ---- difff.pl (split_text / escape_char / build_token_bbox_map_from_words) と同一規則のトークン化 ----
+
+SPLIT_TEXT_RE = re.compile(r"[a-z]+|<\$>|&#?\w+;|.")
+SPLIT_CHUNK_CHARS = 1 << 16
+
+
+def escape_char(text: str) -> str:
+    return (
+        text.replace("&", "&amp;")
+        .replace("<", "&lt;")
+        .replace(">", "&gt;")
+        .replace("'", "&#39;")
+        .replace('"', "&quot;")
+    )
+
+
+def split_text(text: str) -> list[str]:
+    return SPLIT_TEXT_RE.findall(text.replace("\n", "<$>"))
+
+
+def split_text_ids(text: str, table: TokenTable, chunk_chars: int = SPLIT_CHUNK_CHARS) -> array:
+    # トークンは改行をまたがないので、改行位置で区切った塊ごとに分割してIDへ置き換える
+    out = array("i")
+    start = 0
+    while start < len(text):
+        end = text.find("\n", start + chunk_chars)
+        end = len(text) if end < 0 else end + 1
+        table.intern_all(split_text(text[start:end]), out)
+        start = end
+    return out
+
+
+def split_bbox_by_token_count(bbox: dict[str, float] | None, count: int) -> list[dict[str, float]]:
+    if count <= 0 or not bbox:
+        return []
+    if any(bbox.get(k) is None for k in ("x_min", "x_max", "y_min", "y_max")):
+        return []
+    x_min = float(bbox["x_min"])
+    x_max = float(bbox["x_max"])
+    y_min = float(bbox["y_min"])
+    y_max = float(bbox["y_max"])
+    width = x_max - x_min
+    if width <= 0:
+        return []
+    step = width / count
+    boxes: list[dict[str, float]] = []
+    for i in range(count):
+        left = x_min + (step * i)
+        right = x_max if i == count - 1 else (x_min + (step * (i + 1)))
+        boxes.append({"x_min": left, "y_min": y_min, "x_max": right, "y_max": y_max})
+    return boxes
+
+
+def token_map_item(
+    words: WordStore,
+    i: int,
+    token_index: int,
+    bbox: dict[str, float] | None,
+    token_bbox: dict[str, float] | None,
+    token: str,
+) -> dict[str, Any]:
+    return {
+        "page": words.page[i],
+        "line_seq": words.line_seq[i],
+        "word_seq": words.word_seq[i],
+        "token_index": token_index,
+        "bbox": bbox,
+        "token_bbox": token_bbox,
+        "token": token,
+    }
+
+
+def build_token_bbox_map_from_words(words: WordStore, word_index: array | None = None) -> list[dict[str, Any] | None]:
+    # word_index を渡すと token ごとの元単語番号（改行トークンは -1）を追記する
+    token_map: list[dict[str, Any] | None] = []
+    size = len(words)
+    pages = words.page
+    lines = words.line_seq
+    for i, text in enumerate(words.iter_texts()):
+        bbox = words.bbox(i)
+        tokens = split_text(escape_char(text))
+        token_boxes = split_bbox_by_token_count(bbox, len(tokens))
+        for ti, token in enumerate(tokens):
+            token_bbox = token_boxes[ti] if ti < len(token_boxes) else bbox
+            token_map.append(token_map_item(words, i, len(token_map), bbox, token_bbox, token))
+            if word_index is not None:
+                word_index.append(i)
+        if i < size - 1 and pages[i] == pages[i + 1] and lines[i] != lines[i + 1]:
+            token_map.append(None)  # 改行トークンはbboxを持たない
+            if word_index is not None:
+                word_index.append(-1)
+    return token_map
+
+
+def normalize_token_map_size(token_map: list[Any], target_size: int) -> list[Any]:
+    if len(token_map) >= target_size:
+        return token_map[:target_size]
+    return token_map + [None] * (target_size - len(token_map))
+
+
+def token_word_index(words: WordStore) -> array:
+    # build_token_bbox_map_from_words が word_index に追記するのと同じ列を、token_map を作らずに求める
+    word_index = array("i")
+    size = len(words)
+    pages = words.page
+    lines = words.line_seq
+    for i, text in enumerate(words.iter_texts()):
+        word_index.extend([i] * len(split_text(escape_char(text))))
+        if i < size - 1 and pages[i] == pages[i + 1] and lines[i] != lines[i + 1]:
+            word_index.append(-1)
+    return word_index
+
+
+class LazyTokenMap:
+    # normalize_token_map_size(build_token_bbox_map_from_words(...)) と同じ要素を、読まれた token の分だけ作る。
+    # 文書全体の dict を持たないので、メモリはページ数ではなく同時に読む単語数に比例する。
+    # 同じ単語の token は続けて読まれることが多いので、直前の単語の分割結果だけを覚えておく
+    def __init__(self, words: WordStore, word_index: array, size: int) -> None:
+        self.words = words
+        self.word_index = word_index
+        self.size = size
+        self.built_size = len(word_index)
+        self.word = -1
+        self.first_token = 0
+        self.bbox: dict[str, float] | None = None
+        self.tokens: list[str] = []
+        self.token_boxes: list[dict[str, float]] = []
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, idx: int) -> dict[str, Any] | None:
+        if idx < 0:
+            idx += self.size
+        if not 0 <= idx < self.size:
+            raise IndexError("token index out of range")
+        if idx >= self.built_size:
+            return None
+        i = self.word_index[idx]
+        if i < 0:
+            return None
+        if i != self.word:
+            first = idx
+            while first > 0 and self.word_index[first - 1] == i:
+                first -= 1
+            self.word = i
+            self.first_token = first
+            self.bbox = self.words.bbox(i)
+            self.tokens = split_text(escape_char(self.words.text_at(i)))
+            self.token_boxes = split_bbox_by_token_count(self.bbox, len(self.tokens))
+        ti = idx - self.first_token
+        token_bbox = self.token_boxes[ti] if ti < len(self.token_boxes) else self.bbox
+        return token_map_item(self.words, i, idx, self.bbox, token_bbox, self.tokens[ti])
+
+
+class MappedTokenMap:
+    # annotate 入力（DAI1）の片側の token_map。読まれた token の dict だけを列から作る（要素は token_map と同じ形）
+    def __init__(self, cols: dict[str, Any]) -> None:
+        self.cols = cols
+        self.size = len(cols["token_word"])
+        self.run_start = 0
+        self.run_end = 0
+        self.run_boxes: list[dict[str, float]] = []
+
+    def __len__(self) -> int:
+        return self.size
+
+    def word_bbox(self, w: int) -> dict[str, float] | None:
+        c = self.cols
+        if not c["word_has_bbox"][w]:
+            return None
+        return {"x_min": c["word_x_min"][w], "y_min": c["word_y_min"][w], "x_max": c["word_x_max"][w], "y_max": c["word_y_max"][w]}
+
+    def split_box(self, idx: int, w: int, bbox: dict[str, float] | None) -> dict[str, float]:
+        # 同じ単語の token は連続して並ぶので、前後に同じ単語行を参照する範囲を等分の個数とする
+        if not self.run_start <= idx < self.run_end:
+            words = self.cols["token_word"]
+            start = idx
+            while start > 0 and words[start - 1] == w:
+                start -= 1
+            end = idx + 1
+            while end < self.size and words[end] == w:
+                end += 1
+            self.run_start, self.run_end = start, end
+            self.run_boxes = split_bbox_by_token_count(bbox, end - start)
+        return self.run_boxes[idx - self.run_start]
+
+    def __getitem__(self, idx: int) -> dict[str, Any] | None:
+        if idx < 0:
+            idx += self.size
+        if not 0 <= idx < self.size:
+            raise IndexError("token index out of range")
+        c = self.cols
+        w = c["token_word"][idx]
+        if w < 0:
+            return None
+        bbox = self.word_bbox(w)
+        kind = c["token_bbox_kind"][idx]
+        token_bbox: dict[str, float] | None = None
+        if kind == 1:
+            token_bbox = bbox
+        elif kind == 2:
+            token_bbox = self.split_box(idx, w, bbox)
+        elif kind == 3:
+            k = bisect_right(c["explicit_token"], idx) - 1
+            token_bbox = {
+                "x_min": c["explicit_x_min"][k],
+                "y_min": c["explicit_y_min"][k],
+                "x_max": c["explicit_x_max"][k],
+                "y_max": c["explicit_y_max"][k],
+            }
+        text_start = c["token_text_end"][idx - 1] if idx > 0 else 0
+        return {
+            "page": c["word_page"][w],
+            "line_seq": c["word_line_seq"][w],
+            "word_seq": c["word_word_seq"][w],
+            "token_index": c["token_index"][idx],
+            "bbox": bbox,
+            "token_bbox": token_bbox,
+            "token": bytes(c["token_text"][text_start : c["token_text_end"][idx]]).decode("utf-8", errors="surrogatepass"),
         }
-        for w in parser.words
+
+
+def bbox_coords(bbox: dict[str, float] | None) -> tuple[float, float, float, float] | None:
+    if not bbox:
+        return None
+    return (float(bbox["x_min"]), float(bbox["y_min"]), float(bbox["x_max"]), float(bbox["y_max"]))
+
+
+def annotate_input_side(token_map: list[Any]) -> list[array]:
+    # token_map を ANNOTATE_INPUT_SIDE_COLUMNS の順の列にする
+    cols = {name: array(code) for name, code in ANNOTATE_INPUT_SIDE_COLUMNS}
+    word_rows: dict[tuple[Any, ...], int] = {}
+    text_size = 0
+    run: list[tuple[int, dict[str, Any]]] = []
+    run_word = -1
+
+    def flush_run() -> None:
+        # 同じ単語の連続する token をまとめて書き、token_bbox が等分の結果と同じなら値を持たない
+        nonlocal text_size
+        if not run:
+            return
+        bbox = run[0][1].get("bbox")
+        boxes = split_bbox_by_token_count(bbox, len(run))
+        for k, (idx, item) in enumerate(run):
+            token_bbox = item.get("token_bbox")
+            if not token_bbox:
+                kind = 0
+            elif k < len(boxes) and bbox_coords(token_bbox) == bbox_coords(boxes[k]):
+                kind = 2
+            elif bbox_coords(token_bbox) == bbox_coords(bbox):
+                kind = 1
+            else:
+                kind = 3
+                cols["explicit_token"].append(idx)
+                for key, value in zip(("x_min", "y_min", "x_max", "y_max"), bbox_coords(token_bbox)):
+                    cols[f"explicit_{key}"].append(value)
+            text = str(item.get("token", "")).encode("utf-8", errors="surrogatepass")
+            text_size += len(text)
+            cols["token_word"].append(run_word)
+            cols["token_index"].append(int(item.get("token_index", idx)))
+            cols["token_bbox_kind"].append(kind)
+            cols["token_text_end"].append(text_size)
+            cols["token_text"].frombytes(text)
+        run.clear()
+
+    for idx in range(len(token_map)):
+        item = token_map[idx]
+        if not item:
+            flush_run()
+            run_word = -1
+            cols["token_word"].append(-1)
+            cols["token_index"].append(idx)
+            cols["token_bbox_kind"].append(0)
+            cols["token_text_end"].append(text_size)
+            continue
+        coords = bbox_coords(item.get("bbox"))
+        key = (int(item.get("page") or 0), int(item.get("line_seq") or 0), int(item.get("word_seq") or 0), coords)
+        w = word_rows.get(key)
+        if w is None:
+            w = word_rows[key] = len(cols["word_page"])
+            cols["word_page"].append(key[0])
+            cols["word_line_seq"].append(key[1])
+            cols["word_word_seq"].append(key[2])
+            cols["word_has_bbox"].append(0 if coords is None else 1)
+            for name, value in zip(("word_x_min", "word_y_min", "word_x_max", "word_y_max"), coords or (0.0, 0.0, 0.0, 0.0)):
+                cols[name].append(value)
+        if w != run_word:
+            flush_run()
+            run_word = w
+        run.append((idx, item))
+    flush_run()
+    return [cols[name] for name, _ in ANNOTATE_INPUT_SIDE_COLUMNS]
+
+
+def write_annotate_input(path: Path, payload: dict[str, Any]) -> None:
+    # annotate_payload の入力を DAI1 で書く（JSON入力の annotate_input.json と同じ内容）
+    try:
+        deleted_bridge_chars = int(payload.get("deleted_bridge_chars", 2))
+    except (TypeError, ValueError):
+        deleted_bridge_chars = 2
+    ops = payload.get("ops", [])
+    columns = annotate_input_side(payload.get("map_a", [])) + annotate_input_side(payload.get("map_b", []))
+    for key in ("deleted_ranges", "added_ranges"):
+        columns.append(array("q", [int(v) for pair in payload.get(key, []) for v in pair[:2]]))
+    columns.append(array("B", [ord(str(op.get("type", "c"))[0]) for op in ops]))
+    for key in ("a_start", "a_end", "b_start", "b_end"):
+        columns.append(array("q", [int(op.get(key, -1)) for op in ops]))
+    with path.open("wb") as fh:
+        fh.write(ANNOTATE_INPUT_HEADER.pack(ANNOTATE_INPUT_MAGIC, len(columns), deleted_bridge_chars))
+        for col in columns:
+            if sys.byteorder != "little":
+                col = array(col.typecode, col)
+                col.byteswap()
+            data = col.tobytes()
+            fh.write(ANNOTATE_INPUT_SECTION.pack(len(data)))
+            fh.write(data)
+            fh.write(bytes(-len(data) % 8))
+
+
+def annotate_input_column(view: memoryview, code: str) -> Any:
+    # little endian ならコピーせずに mmap の範囲をそのまま列として読む
+    if sys.byteorder == "little":
+        return view.cast(code)
+    col = array(code, view.tobytes())
+    col.byteswap()
+    return col
+
+
+def read_annotate_input(path: Path) -> dict[str, Any]:
+    # token_map は MappedTokenMap（読まれた token だけ dict にする）、範囲と op はリストで返す
+    try:
+        with path.open("rb") as fh:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as exc:
+        raise PipelineError(f"cannot read annotate input ({path.name}): {exc}") from exc
+    if len(data) < ANNOTATE_INPUT_HEADER.size:
+        raise PipelineError(f"unsupported annotate input ({path.name})")
+    magic, count, deleted_bridge_chars = ANNOTATE_INPUT_HEADER.unpack_from(data, 0)
+    if magic != ANNOTATE_INPUT_MAGIC or count != len(ANNOTATE_INPUT_COLUMNS):
+        raise PipelineError(f"unsupported annotate input ({path.name})")
+    view = memoryview(data)
+    cols: dict[str, Any] = {}
+    offset = ANNOTATE_INPUT_HEADER.size
+    for name, code in ANNOTATE_INPUT_COLUMNS:
+        if offset + ANNOTATE_INPUT_SECTION.size > len(data):
+            raise PipelineError(f"truncated annotate input ({path.name})")
+        (size,) = ANNOTATE_INPUT_SECTION.unpack_from(data, offset)
+        offset += ANNOTATE_INPUT_SECTION.size
+        if offset + size > len(data) or size % struct.calcsize(code):
+            raise PipelineError(f"truncated annotate input ({path.name})")
+        cols[name] = annotate_input_column(view[offset : offset + size], code)
+        offset += size + (-size % 8)
+
+    def ranges(key: str) -> list[list[int]]:
+        values = cols[key].tolist()
+        return [values[i : i + 2] for i in range(0, len(values), 2)]
+
+    sides = {}
+    for side in ("a", "b"):
+        prefix = f"{side}_"
+        sides[side] = MappedTokenMap({name[len(prefix) :]: col for name, col in cols.items() if name.startswith(prefix)})
+    ops = [
+        {"type": chr(typ), "a_start": a_start, "a_end": a_end, "b_start": b_start, "b_end": b_end}
+        for typ, a_start, a_end, b_start, b_end in zip(
+            cols["op_type"].tolist(),
+            cols["op_a_start"].tolist(),
+            cols["op_a_end"].tolist(),
+            cols["op_b_start"].tolist(),
+            cols["op_b_end"].tolist(),
+        )
     ]
-    return {"reconstructed_text": reconstructed_text, "words": words_payload}
+    return {
+        "map_a": sides["a"],
+        "map_b": sides["b"],
+        "deleted_ranges": ranges("deleted_ranges"),
+        "added_ranges": ranges("added_ranges"),
+        "ops": ops,
+        "deleted_bridge_chars": deleted_bridge_chars,
+    }
+
+
+def int_column(values: array) -> Any:
+    if not len(values):
+        return np.zeros(0, dtype=np.intc)
+    return np.frombuffer(values, dtype=np.intc)
+
+
+class TokenMapArrays:
+    # build_token_bbox_map_from_words の token_map と同じ内容を列ごとの NumPy 配列で持つ
+    # （token_index は位置と同じ、token_bbox は bbox がある token にだけ付く）。
+    # 赤線の行判定・描画単位の重複除去・ページ振り分けを token ごとの dict を見ずにまとめて計算する
+    def __init__(self, words: WordStore, word_index: array, size: int) -> None:
+        src = int_column(word_index)[:size]
+        count = len(src)
+        self.size = size
+        self.present = np.zeros(size, dtype=bool)
+        self.page = np.zeros(size, dtype=np.int64)
+        self.line_seq = np.zeros(size, dtype=np.int64)
+        self.word_seq = np.zeros(size, dtype=np.int64)
+        if count and len(words):
+            found = src >= 0
+            pick = np.where(found, src, 0)
+            has_bbox = np.frombuffer(bytes(words.has_bbox), dtype=np.uint8)[pick] != 0
+            self.present[:count] = found & has_bbox
+            self.page[:count] = int_column(words.page)[pick]
+            self.line_seq[:count] = int_column(words.line_seq)[pick]
+            self.word_seq[:count] = int_column(words.word_seq)[pick]
+
+    def range_positions(self, ranges: list[list[int]]) -> tuple[Any, Any, int]:
+        # 範囲を token_map の内側に切り詰めて連結した index 列、範囲ごとの長さ、範囲外の index 数
+        pairs = list(iter_range_pairs(ranges))
+        starts = np.array([start for start, _ in pairs], dtype=np.int64)
+        ends = np.array([end for _, end in pairs], dtype=np.int64)
+        lo = np.maximum(starts, 0)
+        lengths = np.maximum(np.minimum(ends, self.size - 1) - lo + 1, 0)
+        outside = int((ends - starts + 1).sum() - lengths.sum())
+        offsets = np.cumsum(lengths) - lengths
+        positions = np.arange(int(lengths.sum()), dtype=np.int64) - np.repeat(offsets - lo, lengths)
+        return positions, lengths, outside
+
+    def range_line_keys(self, ranges: list[list[int]]) -> list[tuple[int, int] | None]:
+        # range_line_key を全範囲まとめて求める（bbox のある token がすべて同じ行なら (page, line_seq)）
+        positions, lengths, _ = self.range_positions(ranges)
+        keys: list[tuple[int, int] | None] = [None] * len(lengths)
+        nonempty = np.flatnonzero(lengths)
+        if not len(nonempty):
+            return keys
+        bounds = (np.cumsum(lengths) - lengths)[nonempty]
+        valid = self.present[positions]
+        big = np.iinfo(np.int64).max
+        page = self.page[positions]
+        line = self.line_seq[positions]
+        found = np.add.reduceat(valid.astype(np.int64), bounds)
+        page_lo = np.minimum.reduceat(np.where(valid, page, big), bounds)
+        page_hi = np.maximum.reduceat(np.where(valid, page, -big), bounds)
+        line_lo = np.minimum.reduceat(np.where(valid, line, big), bounds)
+        line_hi = np.maximum.reduceat(np.where(valid, line, -big), bounds)
+        single = (found > 0) & (page_lo == page_hi) & (line_lo == line_hi)
+        for k in np.flatnonzero(single).tolist():
+            keys[int(nonempty[k])] = (int(page_lo[k]), int(line_lo[k]))
+        return keys
+
+    def draw_entries(
+        self,
+        token_map: list[Any],
+        ranges: list[list[int]],
+        stats: dict[str, int],
+        missing_key: str,
+        kind: str,
+        prefer_token_bbox: bool = False,
+    ) -> tuple[list[dict[str, Any]], Any]:
+        # dedupe_draw_entries(iter_range_entries(...)) と同じ結果と、各描画単位のページ番号
+        positions, _, outside = self.range_positions(ranges)
+        valid = self.present[positions]
+        missing = outside + int(len(positions) - valid.sum())
+        if missing:
+            stats[missing_key] = stats.get(missing_key, 0) + missing
+        positions = positions[valid]
+        if kind == "deleted":
+            keys = positions
+        else:
+            keys = (self.page[positions] << 32) | (self.word_seq[positions] & 0xFFFFFFFF)
+        _, first = np.unique(keys, return_index=True)
+        first.sort()
+        if len(positions) > len(first):
+            stats["skipped_duplicates"] = stats.get("skipped_duplicates", 0) + len(positions) - len(first)
+        positions = positions[first]
+        entries: list[dict[str, Any]] = []
+        for idx in positions.tolist():
+            item = token_map[idx]
+            copied = dict(item)
+            if prefer_token_bbox and item.get("token_bbox"):
+                copied["bbox"] = item["token_bbox"]
+            entries.append(copied)
+        return entries, self.page[positions]
+
+
+def token_map_arrays(words: WordStore, word_index: array | None, size: int) -> TokenMapArrays | None:
+    if np is None or word_index is None:
+        return None
+    return TokenMapArrays(words, word_index, size)
+
+
+def bucket_draw_entries(
+    plans: list[dict[int, dict[str, Any]]],
+    key: str,
+    entries: list[dict[str, Any]],
+    pages: Any = None,
+) -> None:
+    if pages is None or not entries:
+        for e in entries:
+            page = int(e.get("page") or 0)
+            for plan in plans:
+                plan[page][key].append(e)
+        return
+    if bool((pages[1:] >= pages[:-1]).all()):
+        # token 順に並んだ描画単位はページ昇順なので、ページの切れ目でリストを切り出すだけで済む
+        bounds = [0] + (np.flatnonzero(pages[1:] != pages[:-1]) + 1).tolist() + [len(entries)]
+        for lo, hi in zip(bounds, bounds[1:]):
+            picked = entries[lo:hi]
+            for plan in plans:
+                plan[int(pages[lo])][key].extend(picked)
+        return
+    # ページごとの index 列を安定ソートで作り、最初に現れた順にページを並べる（1件ずつ振り分けたときと同じ順）
+    order = np.argsort(pages, kind="stable")
+    sorted_pages = pages[order]
+    uniq, first = np.unique(sorted_pages, return_index=True)
+    bounds = first.tolist() + [len(order)]
+    groups = sorted(
+        ((int(order[bounds[k]]), int(uniq[k]), order[bounds[k] : bounds[k + 1]]) for k in range(len(uniq))),
+        key=lambda g: g[0],
+    )
+    for _, page, idx in groups:
+        picked = [entries[i] for i in idx.tolist()]
+        for plan in plans:
+            plan[page][key].extend(picked)
+
+
+DIFF_HEADER_RE = re.compile(r"(?:(\d+),)?(\d+)([acd])(\d+)(?:,(\d+))?")
+
+
+def run_diff_command(a_tokens: list[str], b_tokens: list[str], diff_cmd: str) -> list[str]:
+    # difff.pl の FIFO + `diff -d` と同じ入力を、名前付きFIFOではなく無名パイプで渡す
+    a_data = ("\n".join(a_tokens) + "\n").encode("utf-8")
+    b_data = ("\n".join(b_tokens) + "\n").encode("utf-8")
+    read_fd, write_fd = os.pipe()
+    try:
+        proc = subprocess.Popen(
+            [diff_cmd, "-d", f"/dev/fd/{read_fd}", "-"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            pass_fds=(read_fd,),
+        )
+    except OSError:
+        os.close(write_fd)
+        raise
+    finally:
+        os.close(read_fd)
+
+    def feed_a() -> None:
+        try:
+            with os.fdopen(write_fd, "wb") as f:
+                f.write(a_data)
+        except BrokenPipeError:
+            pass
+
+    feeder = threading.Thread(target=feed_a, daemon=True)
+    feeder.start()
+    out, err = proc.communicate(b_data)
+    feeder.join()
+    if proc.returncode not in (0, 1):
+        detail = err.decode("utf-8", errors="replace").strip()
+        raise PipelineError(f"diff failed: exit={proc.returncode} {detail}".rstrip())
+    return out.decode("utf-8", errors="replace").splitlines()
+
+
+def hunks_from_diff_lines(diff_lines: list[str]) -> list[Hunk]:
+    hunks: list[Hunk] = []
+    for line in diff_lines:
+        m = DIFF_HEADER_RE.fullmatch(line)
+        if not m:
+            continue
+        a_end = int(m.group(2))
+        a_start = int(m.group(1)) if m.group(1) else a_end
+        b_start = int(m.group(4))
+        b_end = int(m.group(5)) if m.group(5) else b_start
+        hunks.append((m.group(3), a_start, a_end, b_start, b_end))
+    return hunks
+
+
+def ranges_from_hunks(hunks: list[Hunk]) -> tuple[list[list[int]], list[list[int]], list[dict[str, Any]]]:
+    deleted: list[list[int]] = []
+    added: list[list[int]] = []
+    ops: list[dict[str, Any]] = []
+    for typ, a_start, a_end, b_start, b_end in hunks:
+        if typ == "d":
+            b_end = b_start
+        if typ in ("c", "d"):
+            deleted.append([a_start - 1, a_end - 1])
+        if typ in ("c", "a"):
+            added.append([b_start - 1, b_end - 1])
+        ops.append(
+            {
+                "type": typ,
+                "a_start": a_start - 1,
+                "a_end": a_end - 1,
+                "b_start": b_start - 1,
+                "b_end": b_end - 1,
+            }
+        )
+    return deleted, added, ops
+
+
+def diff_token_ids(
+    a_ids: array,
+    b_ids: array,
+    table: TokenTable,
+    diff_engine: str,
+    diff_cmd: str,
+    budget: StepBudget | None = None,
+) -> tuple[list[Hunk], str]:
+    # auto の探索量の上限は budget で複数回の呼び出しに共有でき、使い切った後は最初から `diff` を使う
+    if diff_engine == "auto" and budget is None:
+        budget = StepBudget(DIFF_AUTO_MAX_STEPS)
+    if diff_engine == "builtin" or (diff_engine == "auto" and budget is not None and budget.remaining >= 0):
+        try:
+            return diff_sequences(a_ids, b_ids, budget=budget if diff_engine == "auto" else None), "builtin"
+        except DiffTooExpensiveError:
+            pass
+    hunks = hunks_from_diff_lines(
+        run_diff_command(
+            [table.tokens[t] for t in a_ids],
+            [table.tokens[t] for t in b_ids],
+            diff_cmd,
+        )
+    )
+    return hunks, "external"
+
+
+def page_text_spans(words: WordStore) -> list[tuple[int, int]]:
+    # reconstruct_text_from_words の結果でのページごとの文字範囲 [start, end)（改行はページ内の行の間にだけ入る）
+    spans: list[tuple[int, int]] = []
+    pages = words.page
+    lines = words.line_seq
+    ends = words.text_end
+    newlines = 0
+    start = 0
+    for i in range(1, len(pages)):
+        if pages[i] != pages[i - 1]:
+            end = ends[i - 1] + newlines
+            spans.append((start, end))
+            start = end
+        elif lines[i] != lines[i - 1]:
+            newlines += 1
+    if len(pages):
+        spans.append((start, ends[-1] + newlines))
+    return spans
+
+
+def page_token_spans(text: str, char_spans: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    # ページごとの token 範囲 [start, end)。ページの間に区切りは無いので、前のページ末尾から続く英小文字の並びは
+    # 前のページで始まる1つの token になる（そのページの先頭の token は数えない）
+    spans: list[tuple[int, int]] = []
+    pos = 0
+    for start, end in char_spans:
+        count = len(split_text(escape_char(text[start:end])))
+        if count and start > 0 and "a" <= text[start] <= "z" and "a" <= text[start - 1] <= "z":
+            count -= 1
+        spans.append((pos, pos + count))
+        pos += count
+    return spans
+
+
+def page_fingerprints(ids: array, spans: list[tuple[int, int]]) -> list[bytes]:
+    return [hashlib.blake2b(ids[start:end].tobytes(), digest_size=16).digest() for start, end in spans]
+
+
+def prefiltered_hunks(
+    a_ids: array,
+    b_ids: array,
+    spans_a: list[tuple[int, int]],
+    spans_b: list[tuple[int, int]],
+    table: TokenTable,
+    diff_engine: str,
+    diff_cmd: str,
+) -> tuple[list[Hunk], str, dict[str, int]]:
+    # ページ内容（トークン列）の指紋でページ同士を揃え、揃わなかったページの範囲だけを細かく差分して位置を戻す。
+    # 一致したページをまたいで hunk が動くことはないので、全体を差分した結果と hunk の境界が異なる場合がある
+    fingerprint_ids: dict[bytes, int] = {}
+    pages_a = array("i", (fingerprint_ids.setdefault(fp, len(fingerprint_ids)) for fp in page_fingerprints(a_ids, spans_a)))
+    pages_b = array("i", (fingerprint_ids.setdefault(fp, len(fingerprint_ids)) for fp in page_fingerprints(b_ids, spans_b)))
+    stats = {
+        "pages_a": len(spans_a),
+        "pages_b": len(spans_b),
+        "matched_pages": len(spans_a),
+        "diffed_tokens_a": 0,
+        "diffed_tokens_b": 0,
+    }
+    hunks: list[Hunk] = []
+    used_engine = "builtin"
+    # auto の探索量の上限はページ範囲ごとではなく、比較全体で1つ
+    budget = StepBudget(DIFF_AUTO_MAX_STEPS) if diff_engine == "auto" else None
+    for typ, pa_start, pa_end, pb_start, pb_end in diff_sequences(pages_a, pages_b):
+        # ページ単位の hunk を token 範囲 [start, end) へ。追加/削除の相手側は直前ページの末尾の位置になる
+        if typ == "a":
+            ta_start = ta_end = spans_a[pa_start - 1][1] if pa_start > 0 else 0
+        else:
+            ta_start, ta_end = spans_a[pa_start - 1][0], spans_a[pa_end - 1][1]
+            stats["matched_pages"] -= pa_end - pa_start + 1
+        if typ == "d":
+            tb_start = tb_end = spans_b[pb_start - 1][1] if pb_start > 0 else 0
+        else:
+            tb_start, tb_end = spans_b[pb_start - 1][0], spans_b[pb_end - 1][1]
+        stats["diffed_tokens_a"] += ta_end - ta_start
+        stats["diffed_tokens_b"] += tb_end - tb_start
+        if ta_start == ta_end:
+            hunks.append(("a", ta_start, ta_start, tb_start + 1, tb_end))
+            continue
+        if tb_start == tb_end:
+            hunks.append(("d", ta_start + 1, ta_end, tb_start, tb_start))
+            continue
+        span_hunks, engine = diff_token_ids(
+            a_ids[ta_start:ta_end], b_ids[tb_start:tb_end], table, diff_engine, diff_cmd, budget
+        )
+        if engine != "builtin":
+            used_engine = engine
+        for sub_typ, sa_start, sa_end, sb_start, sb_end in span_hunks:
+            hunks.append((sub_typ, sa_start + ta_start, sa_end + ta_start, sb_start + tb_start, sb_end + tb_start))
+    return hunks, used_engine, stats
 
 
 def quantize_bbox_key(page: int, bbox: dict[str, float] | None) -> str:
@@ -138,7 +1257,7 @@ def quantize_bbox_key(page: int, bbox: dict[str, float] | None) -> str:
     )
 
 
-def dedupe_draw_entries(entries: list[dict[str, Any]], kind: str, stats: dict[str, int]) -> list[dict[str, Any]]:
+def dedupe_draw_entries(entries: Iterable[dict[str, Any]], kind: str, stats: dict[str, int]) -> list[dict[str, Any]]:
     seen: set[str] = set()
     uniq: list[dict[str, Any]] = []
     for e in entries:
@@ -162,16 +1281,18 @@ def dedupe_draw_entries(entries: list[dict[str, Any]], kind: str, stats: dict[st
     return uniq
 
 
-def range_to_indices(ranges: list[list[int]]) -> list[int]:
-    out: list[int] = []
+def iter_range_pairs(ranges: list[list[int]]) -> Iterator[tuple[int, int]]:
     for pair in ranges:
         if not isinstance(pair, list) or len(pair) != 2:
             continue
         start, end = int(pair[0]), int(pair[1])
         if end < start:
             continue
-        out.extend(range(start, end + 1))
-    return out
+        yield start, end
+
+
+def count_range_indices(ranges: list[list[int]]) -> int:
+    return sum(end - start + 1 for start, end in iter_range_pairs(ranges))
 
 
 def normalize_ranges(ranges: list[Any]) -> list[list[int]]:
@@ -216,20 +1337,26 @@ def bridge_deleted_ranges(
     deleted_ranges: list[Any],
     map_a: list[Any],
     bridge_chars: int,
+    arrays_a: TokenMapArrays | None = None,
 ) -> tuple[list[list[int]], int]:
     normalized = normalize_ranges(deleted_ranges)
     if bridge_chars <= 0 or len(normalized) <= 1:
         return normalized, 0
 
+    if arrays_a is not None:
+        line_keys = arrays_a.range_line_keys(normalized)
+    else:
+        line_keys = [range_line_key(pair, map_a) for pair in normalized]
+
     bridged: list[list[int]] = []
     merges = 0
 
     current = [normalized[0][0], normalized[0][1]]
-    current_line_key = range_line_key(current, map_a)
+    current_line_key = line_keys[0]
 
-    for src in normalized[1:]:
+    for k, src in enumerate(normalized[1:], start=1):
         nxt = [src[0], src[1]]
-        next_line_key = range_line_key(nxt, map_a)
+        next_line_key = line_keys[k]
 
         can_merge = False
         if current_line_key is not None and next_line_key is not None and current_line_key == next_line_key:
@@ -250,34 +1377,248 @@ def bridge_deleted_ranges(
     return bridged, merges
 
 
-def map_entries_for_indices(
+def iter_range_entries(
     token_map: list[Any],
-    indices: list[int],
+    ranges: list[list[int]],
     stats: dict[str, int],
     missing_key: str,
     prefer_token_bbox: bool = False,
-) -> list[dict[str, Any]]:
-    out: list[dict[str, Any]] = []
-    for idx in indices:
-        if idx < 0 or idx >= len(token_map):
-            stats[missing_key] = stats.get(missing_key, 0) + 1
-            continue
-        item = token_map[idx]
-        if not item:
-            stats[missing_key] = stats.get(missing_key, 0) + 1
-            continue
-        bbox = item.get("bbox")
-        if prefer_token_bbox and item.get("token_bbox"):
-            bbox = item.get("token_bbox")
-        if not bbox:
-            stats[missing_key] = stats.get(missing_key, 0) + 1
-            continue
-        copied = dict(item)
-        copied["bbox"] = bbox
-        out.append(copied)
-    return out
+) -> Iterator[dict[str, Any]]:
+    # 範囲を token index に展開せず、token_map の該当区間だけを順に読む
+    size = len(token_map)
+    for start, end in iter_range_pairs(ranges):
+        lo = max(0, start)
+        hi = min(size - 1, end)
+        outside = (end - start + 1) - max(0, hi - lo + 1)
+        if outside:
+            stats[missing_key] = stats.get(missing_key, 0) + outside
+        for idx in range(lo, hi + 1):
+            item = token_map[idx]
+            if not item:
+                stats[missing_key] = stats.get(missing_key, 0) + 1
+                continue
+            bbox = item.get("bbox")
+            if prefer_token_bbox and item.get("token_bbox"):
+                bbox = item.get("token_bbox")
+            if not bbox:
+                stats[missing_key] = stats.get(missing_key, 0) + 1
+                continue
+            copied = dict(item)
+            copied["bbox"] = bbox
+            yield copied
+
+
+class PdfReaderCache:
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max(1, int(max_entries))
+        self.entries: OrderedDict[tuple[str, int, int], PdfReader] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path: Path) -> PdfReader:
+        st = path.stat()
+        key = (str(path.resolve()), st.st_size, st.st_mtime_ns)
+        reader = self.entries.get(key)
+        if reader is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return reader
+        self.misses += 1
+        reader = PdfReader(str(path))
+        self.entries[key] = reader
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return reader
+
+
+# worker (--phase serve) 実行中と annotate 1回の処理中だけ有効。それ以外では毎回PdfReaderを生成する
+_reader_cache: PdfReaderCache | None = None
+
+
+def open_pdf_reader(path: Path) -> PdfReader:
+    if _reader_cache is None:
+        return PdfReader(str(path))
+    return _reader_cache.get(path)
+
+
+@contextmanager
+def annotate_executor(jobs: int) -> Iterator[Executor | None]:
+    if jobs <= 1:
+        yield None
+        return
+    # fork（Linux の既定）の子は親で開いたReaderを引き継ぐ。spawn（macOS の既定）の子は引き継げないので、
+    # 子ごとのキャッシュで元PDFの解析を子1つにつき1回にする
+    with ProcessPoolExecutor(max_workers=jobs, initializer=install_child_reader_cache) as executor:
+        yield executor
+
+
+def install_child_reader_cache() -> None:
+    global _reader_cache
+    if _reader_cache is None:
+        _reader_cache = PdfReaderCache(2)
+
+
+@contextmanager
+def shared_pdf_readers() -> Iterator[None]:
+    # 1回の注釈処理の間は、同じ元PDFを使う出力どうしで解析済みReaderを共有する
+    global _reader_cache
+    if _reader_cache is not None:
+        yield
+        return
+    _reader_cache = PdfReaderCache(2)
+    try:
+        yield
+    finally:
+        _reader_cache = None
+
+
+def peak_rss_mb() -> float:
+    # プロセス開始からの最大値（常駐workerでは過去のジョブも含む）
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / RSS_UNITS_PER_MB, 1)
+
+
+class StepTimings:
+    # 処理段階ごとの経過時間・CPU時間と、段階終了時点の最大RSS。
+    # 段階の中で始めた段階は "外側/内側" の名前で記録し、外側の時間からは差し引く。
+    # tracemalloc が有効（--trace-memory）なら段階中の Python 割り当ての最大値も記録する
+    def __init__(self) -> None:
+        self.steps: dict[str, dict[str, float]] = {}
+        # 実行中の段階ごとに [名前, 内側の経過秒, 内側のCPU秒, 内側の割り当て最大]
+        self.stack: list[list[Any]] = []
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    @contextmanager
+    def step(self, name: str) -> Iterator[None]:
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            if self.stack:
+                parent = self.stack[-1]
+                parent[3] = max(parent[3], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        full_name = f"{self.stack[-1][0]}/{name}" if self.stack else name
+        frame: list[Any] = [full_name, 0.0, 0.0, 0]
+        # 外側の段階が内側より先に並ぶよう、開始時に枠を作っておく
+        entry = self.steps.setdefault(full_name, {"wall_ms": 0.0, "cpu_ms": 0.0})
+        self.stack.append(frame)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            self.stack.pop()
+            entry["wall_ms"] = round(entry["wall_ms"] + (wall - frame[1]) * 1000.0, 1)
+            entry["cpu_ms"] = round(entry["cpu_ms"] + (cpu - frame[2]) * 1000.0, 1)
+            entry["rss_peak_mb"] = peak_rss_mb()
+            if tracing:
+                traced_peak = max(frame[3], tracemalloc.get_traced_memory()[1])
+                entry["traced_peak_mb"] = max(entry.get("traced_peak_mb", 0.0), round(traced_peak / (1 << 20), 1))
+                if self.stack:
+                    self.stack[-1][3] = max(self.stack[-1][3], traced_peak)
+                tracemalloc.reset_peak()
+            if self.stack:
+                self.stack[-1][1] += wall
+                self.stack[-1][2] += cpu
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "wall_ms": round((time.perf_counter() - self.wall_start) * 1000.0, 1),
+            "cpu_ms": round((time.process_time() - self.cpu_start) * 1000.0, 1),
+            "rss_peak_mb": peak_rss_mb(),
+            "steps": self.steps,
+        }
+
+
+# 実行中の annotate / pipeline の段階別計測（入れ子で呼ばれたときは外側のものを使う）
+_step_timings: StepTimings | None = None
+
+
+@contextmanager
+def collect_step_timings() -> Iterator[StepTimings]:
+    global _step_timings
+    if _step_timings is not None:
+        yield _step_timings
+        return
+    _step_timings = StepTimings()
+    try:
+        yield _step_timings
+    finally:
+        _step_timings = None
+
+
+@contextmanager
+def timed_step(name: str) -> Iterator[None]:
+    if _step_timings is None:
+        yield
+        return
+    with _step_timings.step(name):
+        yield
+
+
+class ByteCounter:
+    # 書き出さずに大きさだけを数える（--profile で最適化前の大きさを測る）
+    def __init__(self) -> None:
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.size
 
+    def flush(self) -> None:
+        pass
 
+
+class OutputSizes:
+    # --optimize-output での出力ごとのバイト数。出力名は annotate_payload が切り替える。
+    # after_bytes は実際に書き出したファイルの大きさ（窓ごとの部分PDFはつないだ後の大きさで置き換える）。
+    # before_bytes（最適化前、窓では部分PDFの合計）は書き出しをもう1回行って数えるため、measure_before のときだけ測る
+    def __init__(self, measure_before: bool) -> None:
+        self.measure_before = measure_before
+        self.outputs: dict[str, dict[str, int]] = {}
+        self.current = ""
+
+    def entry(self) -> dict[str, int]:
+        return self.outputs.setdefault(self.current, {"before_bytes": 0, "after_bytes": 0} if self.measure_before else {"after_bytes": 0})
+
+    def add_before(self, size: int) -> None:
+        if self.measure_before:
+            self.entry()["before_bytes"] += size
+
+    def set_after(self, size: int) -> None:
+        self.entry()["after_bytes"] = size
+
+    def summary(self) -> dict[str, Any]:
+        totals = {"after_bytes": sum(entry["after_bytes"] for entry in self.outputs.values())}
+        if self.measure_before:
+            totals = {"before_bytes": sum(entry["before_bytes"] for entry in self.outputs.values()), **totals}
+        return {**totals, "outputs": self.outputs}
+
+
+# 実行中の annotate で出力を最適化するときだけ有効
+_output_sizes: OutputSizes | None = None
+# --profile の実行中だけ True。最適化前の大きさも測る
+_measure_unoptimized = False
+
+
+@contextmanager
+def optimized_outputs(enabled: bool) -> Iterator[OutputSizes | None]:
+    global _output_sizes
+    if not enabled:
+        yield None
+        return
+    _output_sizes = OutputSizes(_measure_unoptimized)
+    try:
+        yield _output_sizes
+    finally:
+        _output_sizes = None
+
+
+@lru_cache(maxsize=None)
 def ensure_fonts() -> tuple[str, str]:
     regular = "HeiseiKakuGo-W5"
     bold = "HeiseiKakuGo-W5"
@@ -319,28 +1660,74 @@ def iter_font_sizes(start: float, minimum: float, step: float) -> list[float]:
     return out
 
 
+@lru_cache(maxsize=None)
+def glyph_widths(font_name: str) -> dict[str, int] | None:
+    # UnicodeCIDFont は字幅を1/1000 em の整数表で持ち、stringWidth も
+    # size * 0.001 * sum(字幅) で求めるので、整数を足し込めば同じ値になる
+    return getattr(pdfmetrics.getFont(font_name), "unicodeWidths", None)
+
+
 def wrap_text_by_width(text: str, font_name: str, font_size: float, max_width: float) -> list[str]:
     if not text:
         return [""]
+    widths = glyph_widths(font_name)
     parts = text.replace("\r", "").split("\n")
     lines: list[str] = []
     for part in parts:
         if part == "":
             lines.append("")
             continue
-        cur = ""
-        for ch in part:
-            candidate = cur + ch
-            if cur and pdfmetrics.stringWidth(candidate, font_name, font_size) > max_width:
+        if widths is None:
+            cur = ""
+            for ch in part:
+                candidate = cur + ch
+                if cur and pdfmetrics.stringWidth(candidate, font_name, font_size) > max_width:
+                    lines.append(cur)
+                    cur = ch
+                else:
+                    cur = candidate
+            if cur:
                 lines.append(cur)
-                cur = ch
+            continue
+        start = 0
+        units = 0
+        for k, ch in enumerate(part):
+            w = widths.get(ch, 1000)
+            if k > start and font_size * 0.001 * (units + w) > max_width:
+                lines.append(part[start:k])
+                start = k
+                units = w
             else:
-                cur = candidate
-        if cur:
-            lines.append(cur)
+                units += w
+        lines.append(part[start:])
     return lines or [""]
 
 
+def text_width_units(text: str, font_name: str) -> list[tuple[int, int]] | None:
+    # 改行で区切った段落ごとの字幅合計と最大字幅（1/1000 em）。フォントサイズに依存しない
+    widths = glyph_widths(font_name)
+    if widths is None:
+        return None
+    out: list[tuple[int, int]] = []
+    for part in text.replace("\r", "").split("\n"):
+        units = [widths.get(ch, 1000) for ch in part]
+        out.append((sum(units), max(units, default=0)))
+    return out
+
+
+def min_wrapped_line_count(part_units: list[tuple[int, int]], font_size: float, max_width: float) -> int:
+    # wrap_text_by_width の各行は1文字で幅を超える場合を除いて max_width 以下なので、
+    # 段落の行数は 合計幅 / max_width 以上になる
+    scale = font_size * 0.001
+    count = 0
+    for total, widest in part_units:
+        if total == 0 or widest * scale > max_width:
+            count += 1
+        else:
+            count += max(1, math.ceil(total * scale / max_width - 1e-9))
+    return count
+
+
 def get_font_metrics(font_name: str, font_size: float) -> tuple[float, float, float, float]:
     ascent = float(pdfmetrics.getAscent(font_name, font_size))
     descent = abs(float(pdfmetrics.getDescent(font_name, font_size)))
@@ -375,20 +1762,63 @@ def collect_comment_text_from_map(map_b: list[Any], start_idx: int, end_idx: int
     return collect_text_from_map(map_b, start_idx, end_idx)
 
 
-def build_deleted_group_lookup(deleted_ranges: list[list[int]], map_size: int) -> list[int]:
-    lookup = [-1] * max(0, map_size)
-    for gid, pair in enumerate(normalize_ranges(deleted_ranges)):
-        start, end = int(pair[0]), int(pair[1])
-        if end < 0 or start >= map_size:
-            continue
-        lo = max(0, start)
-        hi = min(map_size - 1, end)
-        for idx in range(lo, hi + 1):
-            lookup[idx] = gid
-    return lookup
-
-
-def resolve_deleted_group_id(op: dict[str, Any], deleted_lookup: list[int]) -> int | None:
+class DeletedGroupLookup:
+    # token index -> 赤線グループ番号（ブリッジ後の削除範囲の通し番号）。
+    # 範囲の始点を二分探索して引くので、メモリは変更文字数ではなく範囲数に比例する。
+    # 範囲が重なる場合は番号の大きい範囲を優先する（index ごとの表を後から上書きしていたときと同じ）
+    def __init__(self, deleted_ranges: list[list[int]], map_size: int) -> None:
+        self.map_size = max(0, map_size)
+        self.starts: list[int] = []
+        self.ends: list[int] = []
+        self.gids: list[int] = []
+        self.max_ends: list[int] = []
+        self.disjoint = True
+        for gid, pair in enumerate(normalize_ranges(deleted_ranges)):
+            start, end = int(pair[0]), int(pair[1])
+            if end < 0 or start >= self.map_size:
+                continue
+            lo = max(0, start)
+            hi = min(self.map_size - 1, end)
+            if self.max_ends and lo <= self.max_ends[-1]:
+                self.disjoint = False
+            self.starts.append(lo)
+            self.ends.append(hi)
+            self.gids.append(gid)
+            self.max_ends.append(max(hi, self.max_ends[-1]) if self.max_ends else hi)
+
+    def __len__(self) -> int:
+        return self.map_size
+
+    def get(self, idx: int) -> int:
+        if idx < 0 or idx >= self.map_size:
+            return -1
+        i = bisect_right(self.starts, idx) - 1
+        while i >= 0 and self.max_ends[i] >= idx:
+            if self.ends[i] >= idx:
+                return self.gids[i]
+            i -= 1
+        return -1
+
+    def groups_between(self, lo: int, hi: int) -> set[int]:
+        lo = max(0, lo)
+        hi = min(self.map_size - 1, hi)
+        groups: set[int] = set()
+        if hi < lo:
+            return groups
+        if not self.disjoint:
+            for idx in range(lo, hi + 1):
+                gid = self.get(idx)
+                if gid >= 0:
+                    groups.add(gid)
+            return groups
+        i = bisect_right(self.starts, hi) - 1
+        while i >= 0 and self.ends[i] >= lo:
+            groups.add(self.gids[i])
+            i -= 1
+        return groups
+
+
+def resolve_deleted_group_id(op: dict[str, Any], deleted_lookup: DeletedGroupLookup) -> int | None:
     if not deleted_lookup:
         return None
     typ = op.get("type")
@@ -398,23 +1828,18 @@ def resolve_deleted_group_id(op: dict[str, Any], deleted_lookup: list[int]) -> i
     except (TypeError, ValueError):
         return None
 
-    candidate_indices: list[int] = []
+    groups: set[int] = set()
     if typ == "c":
         if a_start >= 0 and a_end >= a_start:
-            candidate_indices.extend(range(a_start, a_end + 1))
+            groups = deleted_lookup.groups_between(a_start, a_end)
     elif typ == "a":
-        candidate_indices.extend([a_start, a_end, a_start - 1, a_end + 1])
+        for idx in (a_start, a_end, a_start - 1, a_end + 1):
+            gid = deleted_lookup.get(idx)
+            if gid >= 0:
+                groups.add(gid)
     else:
         return None
 
-    groups: set[int] = set()
-    for idx in candidate_indices:
-        if idx < 0 or idx >= len(deleted_lookup):
-            continue
-        gid = deleted_lookup[idx]
-        if gid >= 0:
-            groups.add(gid)
-
     if len(groups) == 1:
         return next(iter(groups))
     return None
@@ -427,9 +1852,11 @@ def build_comment_annotations(
     bridged_deleted_ranges: list[list[int]],
     stats: dict[str, int],
     allowed_deleted_group_ids: set[int] | None = None,
+    deleted_lookup: DeletedGroupLookup | None = None,
 ) -> list[dict[str, Any]]:
     annotations: list[dict[str, Any]] = []
-    deleted_lookup = build_deleted_group_lookup(bridged_deleted_ranges, len(map_a))
+    if deleted_lookup is None:
+        deleted_lookup = DeletedGroupLookup(bridged_deleted_ranges, len(map_a))
 
     def anchor_from_item(item: dict[str, Any]) -> dict[str, Any]:
         anchor = dict(item)
@@ -659,28 +2086,180 @@ def merge_nearby_comment_annotations(
             {
                 "anchor": g["anchor"],
                 "text": text,
+                "b_start": int(g.get("b_start", -1)),
+                "b_end": int(g.get("b_end", -1)),
                 "deleted_group_id": g.get("deleted_group_id"),
             }
         )
     return result
 
 
-def merge_overlay(
+def optimize_pdf_writer(writer: PdfWriter) -> None:
+    # merge_page で合成したページ内容は復号したまま書かれるので、未圧縮のものを Flate で圧縮する
+    for page in writer.pages:
+        if "/Contents" not in page:
+            continue
+        contents = page["/Contents"]
+        streams = contents if isinstance(contents, list) else [contents]
+        if any("/Filter" not in stream.get_object() for stream in streams):
+            page.compress_content_streams()
+    # ページごとの reportlab キャンバス由来で複製された同じフォント（CIDフォント含む）・透明度等を1つにまとめ、
+    # 合成で置き換えられて参照されなくなった元の内容ストリームを捨てる
+    writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+
+
+def write_pdf(writer: PdfWriter, out_pdf: PdfOutput) -> None:
+    if _output_sizes is not None:
+        with timed_step("optimize"):
+            if _output_sizes.measure_before:
+                counter = ByteCounter()
+                writer.write(counter)
+                _output_sizes.add_before(counter.size)
+            optimize_pdf_writer(writer)
+    with timed_step("write"):
+        if isinstance(out_pdf, Path):
+            with out_pdf.open("wb") as f:
+                writer.write(f)
+                after = f.tell()
+        else:
+            start = out_pdf.tell()
+            writer.write(out_pdf)
+            after = out_pdf.tell() - start
+    if _output_sizes is not None:
+        _output_sizes.set_after(after)
+
+
+def page_chunks(page_count: int, jobs: int) -> list[tuple[int, int]]:
+    if jobs <= 1 or page_count < PARALLEL_MIN_PAGES:
+        return []
+    count = min(jobs, page_count // PARALLEL_MIN_CHUNK_PAGES)
+    if count < 2:
+        return []
+    bounds = [page_count * k // count for k in range(count + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+
+def resource_category_shared(pages: Any, category: str) -> bool:
+    # merge_page は既存のリソース辞書へ追記するため、複数ページで共有された辞書があると
+    # 前のページの合成結果で名前の振り替えが変わる。その場合はチャンク分割しない
+    seen: set[tuple[str, int]] = set()
+    for i, page in enumerate(pages):
+        if "/Resources" not in page:
+            return True
+        res_ref = page.raw_get("/Resources")
+        key = ("res", res_ref.idnum) if isinstance(res_ref, IndirectObject) else ("page", i)
+        res = res_ref.get_object()
+        if category in res:
+            cat_ref = res.raw_get(category)
+            if isinstance(cat_ref, IndirectObject):
+                key = ("cat", cat_ref.idnum)
+        if key in seen:
+            return True
+        seen.add(key)
+    return False
+
+
+def submit_page_chunks(
+    executor: Executor,
+    chunk_fn: Any,
     base_pdf: Path,
-    out_pdf: Path,
     draw_plan: dict[int, dict[str, Any]],
-    regular_font: str,
-    bold_font: str,
-) -> None:
-    del regular_font, bold_font
-    base_reader = PdfReader(str(base_pdf))
+    chunks: list[tuple[int, int]],
+) -> list[Future]:
+    return [
+        executor.submit(
+            chunk_fn,
+            base_pdf,
+            {page_num: draw_plan[page_num] for page_num in range(start + 1, end + 1) if page_num in draw_plan},
+            start,
+            end,
+        )
+        for start, end in chunks
+    ]
+
+
+def write_pdf_bytes(data: bytes, out_pdf: PdfOutput, optimizable: bool = True) -> None:
+    # 書き出し済みのPDFは読み直して最適化し、小さくなったときだけ置き換える
+    # （native は元のページ内容のままで縮まないことが多い。増分更新は元PDFのバイト列を保つのでそのまま）
+    if _output_sizes is not None:
+        before = len(data)
+        if optimizable:
+            with timed_step("optimize"):
+                writer = PdfWriter(clone_from=PdfReader(BytesIO(data)))
+                optimize_pdf_writer(writer)
+                buf = BytesIO()
+                writer.write(buf)
+                if buf.tell() < before:
+                    data = buf.getvalue()
+        _output_sizes.add_before(before)
+        _output_sizes.set_after(len(data))
+    with timed_step("write"):
+        if isinstance(out_pdf, Path):
+            out_pdf.write_bytes(data)
+        else:
+            out_pdf.write(data)
+
+
+def graft_merged_page(writer: PdfWriter, out_page: Any, merged_page: Any, base_page: Any | None) -> None:
+    # 子プロセスで合成済みのページから内容とリソースを移す。元PDF由来のリソースは
+    # 元Readerから複製し、チャンクごとにフォント等が重複しないようにする
+    contents = merged_page.get_object().get("/Contents")
+    if contents is not None:
+        contents = contents.get_object()
+        if isinstance(contents, ArrayObject):
+            contents = ArrayObject(c.get_object() for c in contents)
+        out_page.replace_contents(contents)
+
+    if "/Resources" not in merged_page:
+        return
+    merged_res = merged_page["/Resources"]
+    base_res = base_page["/Resources"] if base_page is not None and "/Resources" in base_page else DictionaryObject()
+    if "/Resources" not in out_page:
+        out_page[NameObject("/Resources")] = DictionaryObject()
+    out_res = out_page["/Resources"]
+
+    for category in MERGE_RESOURCE_CATEGORIES:
+        if category not in merged_res:
+            continue
+        if category not in out_res:
+            out_res[NameObject(category)] = DictionaryObject()
+        out_cat = out_res[category]
+        merged_cat = merged_res[category]
+        base_cat = base_res[category] if category in base_res else DictionaryObject()
+        added = False
+        for name in merged_cat:
+            if name in out_cat:
+                continue
+            source = base_cat if name in base_cat else merged_cat
+            value = source.raw_get(name).clone(writer)
+            if getattr(value, "indirect_reference", None) is not None:
+                value = value.indirect_reference
+            out_cat[NameObject(name)] = value
+            added = True
+        if added:
+            items = sorted(out_cat.items())
+            out_cat.clear()
+            out_cat.update(items)
+
+    if "/ProcSet" in merged_res:
+        if "/ProcSet" not in out_res:
+            out_res[NameObject("/ProcSet")] = ArrayObject()
+        procset = out_res["/ProcSet"]
+        for x in merged_res["/ProcSet"]:
+            if x not in procset:
+                procset.append(x)
+        procset.sort()
+
+
+def render_overlay_pages(pages: Any, draw_plan: dict[int, dict[str, Any]], indices: list[int]) -> PdfReader:
     buf = BytesIO()
 
-    first_w = float(base_reader.pages[0].mediabox.width)
-    first_h = float(base_reader.pages[0].mediabox.height)
+    first_w = float(pages[indices[0]].mediabox.width)
+    first_h = float(pages[indices[0]].mediabox.height)
     c = canvas.Canvas(buf, pagesize=(first_w, first_h))
 
-    for i, page in enumerate(base_reader.pages):
+    for i in indices:
+        page = pages[i]
         page_num = i + 1
         w = float(page.mediabox.width)
         h = float(page.mediabox.height)
@@ -704,16 +2283,253 @@ def merge_overlay(
 
     c.save()
     buf.seek(0)
-    overlay_reader = PdfReader(buf)
+    return PdfReader(buf)
+
+
+def merge_overlay_pages(
+    base_reader: PdfReader,
+    writer: PdfWriter,
+    draw_plan: dict[int, dict[str, Any]],
+    start: int,
+    end: int,
+) -> None:
+    overlay_reader = render_overlay_pages(base_reader.pages, draw_plan, list(range(start, end)))
+
+    for k, i in enumerate(range(start, end)):
+        # キャッシュ済みReaderのページを汚さないよう、writer側の複製へ合成する
+        out_page = writer.add_page(base_reader.pages[i])
+        if k < len(overlay_reader.pages):
+            out_page.merge_page(overlay_reader.pages[k])
+
+
+def merge_overlay_incremental(base_pdf: Path, draw_plan: dict[int, dict[str, Any]]) -> bytes:
+    # 描画のあるページだけを合成し、元PDFのバイト列の後ろに増分更新として追記する。
+    # 増分用writerは読み込んだオブジェクトを直接書き換えるので、キャッシュ済みReaderは使わない
+    if not any(plan.get("strike") or plan.get("mark") for plan in draw_plan.values()):
+        return base_pdf.read_bytes()
+    writer = PdfWriter(str(base_pdf), incremental=True)
+    indices = [
+        i
+        for i in range(len(writer.pages))
+        if draw_plan.get(i + 1, {}).get("strike") or draw_plan.get(i + 1, {}).get("mark")
+    ]
+    if indices:
+        overlay_reader = render_overlay_pages(writer.pages, draw_plan, indices)
+        for k, i in enumerate(indices):
+            writer.pages[i].merge_page(overlay_reader.pages[k])
+    buf = BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+
+def pdf_floats(values: Any) -> ArrayObject:
+    return ArrayObject(FloatObject(round(v, 4)) for v in values)
+
+
+def native_annotation(subtype: str, rect: tuple[float, float, float, float], color: Color, opacity: float) -> DictionaryObject:
+    return DictionaryObject(
+        {
+            NameObject("/Type"): NameObject("/Annot"),
+            NameObject("/Subtype"): NameObject(subtype),
+            NameObject("/Rect"): pdf_floats(rect),
+            NameObject("/C"): pdf_floats((color.red, color.green, color.blue)),
+            NameObject("/CA"): FloatObject(opacity),
+            NameObject("/F"): NumberObject(ANNOT_FLAG_PRINT),
+        }
+    )
+
+
+def build_native_annotations(plan: dict[str, Any], page_w: float, page_h: float) -> list[DictionaryObject]:
+    # 重ね描きと同じ色・座標で、ページ内容には触れない注釈辞書を作る（外観はビューア側で生成される）
+    annots: list[DictionaryObject] = []
+    for entry in plan.get("strike", []):
+        x0, y0, x1, y1 = bbox_to_pdf_coords(page_h, entry["bbox"])
+        annot = native_annotation("/StrikeOut", (x0, y0, x1, y1), Color(0.86, 0.10, 0.10), 0.9)
+        annot[NameObject("/QuadPoints")] = pdf_floats((x0, y1, x1, y1, x0, y0, x1, y0))
+        annots.append(annot)
+
+    for entry in plan.get("mark", []):
+        x0, y0, x1, y1 = bbox_to_pdf_coords(page_h, entry["bbox"])
+        # Square の枠線は Rect の内側に描かれるので、重ね描きの線幅の半分だけ外へ広げる
+        half = 0.4
+        rect = (x0 - half, y0 - half, x0 + max(0.8, x1 - x0) + half, y0 + max(0.8, y1 - y0) + half)
+        annot = native_annotation("/Square", rect, Color(0.12, 0.45, 0.12), 0.95)
+        annot[NameObject("/BS")] = DictionaryObject({NameObject("/W"): FloatObject(0.8)})
+        annots.append(annot)
+
+    comments = sort_comments_by_anchor(plan.get("comment", []), page_h)
+    for marker_id, ann in enumerate(comments, start=1):
+        x0, _, x1, y1 = bbox_to_pdf_coords(page_h, ann["anchor"]["bbox"])
+        icon_x = max(0.0, min(page_w - NOTE_ICON_SIZE, (x0 + x1) / 2.0 - NOTE_ICON_SIZE / 2.0))
+        icon_y = max(0.0, min(page_h - NOTE_ICON_SIZE, y1))
+        rect = (icon_x, icon_y, icon_x + NOTE_ICON_SIZE, icon_y + NOTE_ICON_SIZE)
+        annot = native_annotation("/Text", rect, Color(0.08, 0.24, 0.80), 0.9)
+        annot[NameObject("/F")] = NumberObject(ANNOT_FLAG_PRINT | ANNOT_FLAG_NO_ZOOM | ANNOT_FLAG_NO_ROTATE)
+        annot[NameObject("/Name")] = NameObject("/Comment")
+        annot[NameObject("/T")] = create_string_object(str(marker_id))
+        annot[NameObject("/Contents")] = create_string_object(str(ann["text"]))
+        annots.append(annot)
+    return annots
+
+
+def write_native_annotations(base_pdf: Path, draw_plan: dict[int, dict[str, Any]], output_mode: str) -> bytes:
+    has_annots = any(plan.get("strike") or plan.get("mark") or plan.get("comment") for plan in draw_plan.values())
+    if output_mode == "incremental":
+        if not has_annots:
+            return base_pdf.read_bytes()
+        writer = PdfWriter(str(base_pdf), incremental=True)
+    else:
+        writer = PdfWriter()
+        for page in open_pdf_reader(base_pdf).pages:
+            writer.add_page(page)
+
+    for i, page in enumerate(writer.pages):
+        add_native_annotations(writer, page, draw_plan.get(i + 1))
+
+    buf = BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
 
+
+def add_native_annotations(writer: PdfWriter, page: Any, plan: dict[str, Any] | None) -> None:
+    if not plan:
+        return
+    for annot in build_native_annotations(plan, float(page.mediabox.width), float(page.mediabox.height)):
+        writer.add_annotation(page, annot)
+
+
+def add_native_pages(
+    base_reader: PdfReader,
+    writer: PdfWriter,
+    draw_plan: dict[int, dict[str, Any]],
+    start: int,
+    end: int,
+) -> None:
+    for i in range(start, end):
+        add_native_annotations(writer, writer.add_page(base_reader.pages[i]), draw_plan.get(i + 1))
+
+
+def merge_overlay_chunk(base_pdf: Path, draw_plan: dict[int, dict[str, Any]], start: int, end: int) -> bytes:
     writer = PdfWriter()
-    for i, page in enumerate(base_reader.pages):
-        if i < len(overlay_reader.pages):
-            page.merge_page(overlay_reader.pages[i])
-        writer.add_page(page)
+    merge_overlay_pages(open_pdf_reader(base_pdf), writer, draw_plan, start, end)
+    buf = BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+
+def page_windows(page_count: int, page_window: int) -> list[tuple[int, int]]:
+    return [(start, min(page_count, start + page_window)) for start in range(0, page_count, page_window)]
 
-    with out_pdf.open("wb") as f:
-        writer.write(f)
+
+def write_page_windows(
+    base_pdf: Path,
+    out_pdf: PdfOutput,
+    draw_plan: dict[int, dict[str, Any]],
+    page_count: int,
+    page_window: int,
+    render: Callable[[PdfReader, PdfWriter, dict[int, dict[str, Any]], int, int], Any],
+) -> list[Any]:
+    # page_window ページずつ部分PDFへ書き出してはページを手放し、最後に部分PDFをつなぐ。
+    # Readerは読んだページの内容やリソースを保持し続けるので、共有Readerは使わずに専用のものを開き、
+    # 窓ごとに解析済みオブジェクトを捨てる（開き直すと毎回ページツリー全体を展開し直すことになる）
+    results: list[Any] = []
+    reader = PdfReader(str(base_pdf))
+    with tempfile.TemporaryDirectory(prefix="difff-window-") as tmp:
+        parts: list[Path] = []
+        for start, end in page_windows(page_count, page_window):
+            writer = PdfWriter()
+            results.append(render(reader, writer, draw_plan, start, end))
+            part = Path(tmp) / f"part-{len(parts):05d}.pdf"
+            write_pdf(writer, part)
+            parts.append(part)
+            del writer
+            reader.resolved_objects.clear()
+        with timed_step("concat"):
+            if isinstance(out_pdf, Path):
+                with out_pdf.open("wb") as f:
+                    concat_pdf_parts(parts, f)
+                    size = f.tell()
+            else:
+                start = out_pdf.tell()
+                concat_pdf_parts(parts, out_pdf)
+                size = out_pdf.tell() - start
+        if _output_sizes is not None:
+            # 部分PDFごとの大きさではなく、つないだ後のファイルの大きさにする
+            _output_sizes.set_after(size)
+    return results
+
+
+def start_overlay(
+    base_pdf: Path,
+    out_pdf: PdfOutput,
+    draw_plan: dict[int, dict[str, Any]],
+    jobs: int = 1,
+    executor: Executor | None = None,
+    output_mode: str = "full",
+    annotation_style: str = "overlay",
+    page_window: int = 0,
+) -> Callable[[], None]:
+    base_reader = open_pdf_reader(base_pdf)
+
+    # pypdf の増分更新は暗号化PDFに対応していないので全体を書き直す
+    if output_mode == "incremental" and base_reader.is_encrypted:
+        output_mode = "full"
+
+    # 窓ごとの部分PDFは子プロセスへ分けず、1窓ずつ順に作る（増分更新は変更ページしか持たないので窓にしない）
+    windowed = page_window > 0 and output_mode == "full"
+
+    if annotation_style == "native":
+        if windowed:
+            page_count = len(base_reader.pages)
+            return lambda: write_page_windows(base_pdf, out_pdf, draw_plan, page_count, page_window, add_native_pages)
+        if executor is None:
+            return lambda: write_pdf_bytes(
+                write_native_annotations(base_pdf, draw_plan, output_mode), out_pdf, output_mode == "full"
+            )
+        native = executor.submit(write_native_annotations, base_pdf, dict(draw_plan), output_mode)
+        return lambda: write_pdf_bytes(native.result(), out_pdf, output_mode == "full")
+
+    if output_mode == "incremental":
+        if executor is None:
+            return lambda: write_pdf_bytes(merge_overlay_incremental(base_pdf, draw_plan), out_pdf, False)
+        incremental = executor.submit(merge_overlay_incremental, base_pdf, dict(draw_plan))
+        return lambda: write_pdf_bytes(incremental.result(), out_pdf, False)
+
+    page_count = len(base_reader.pages)
+    if windowed:
+        return lambda: write_page_windows(base_pdf, out_pdf, draw_plan, page_count, page_window, merge_overlay_pages)
+
+    # 重ね描きの内容が参照するリソース（reportlab既定フォントと透明度）が共有されていなければ分割できる
+    chunks = page_chunks(page_count, jobs) if executor is not None else []
+    if chunks and any(resource_category_shared(base_reader.pages, cat) for cat in OVERLAY_RESOURCE_CATEGORIES):
+        chunks = []
+
+    if executor is None:
+        def finish_serial() -> None:
+            writer = PdfWriter()
+            merge_overlay_pages(base_reader, writer, draw_plan, 0, page_count)
+            write_pdf(writer, out_pdf)
+
+        return finish_serial
+
+    if not chunks:
+        # 分割できない文書も子プロセスで丸ごと作り、他の出力と並行させる
+        whole = submit_page_chunks(executor, merge_overlay_chunk, base_pdf, draw_plan, [(0, page_count)])[0]
+        return lambda: write_pdf_bytes(whole.result(), out_pdf)
+
+    futures = submit_page_chunks(executor, merge_overlay_chunk, base_pdf, draw_plan, chunks)
+
+    def finish_chunks() -> None:
+        writer = PdfWriter()
+        for (start, end), future in zip(chunks, futures):
+            chunk_reader = PdfReader(BytesIO(future.result()))
+            for k, i in enumerate(range(start, end)):
+                base_page = base_reader.pages[i]
+                out_page = writer.add_page(base_page)
+                graft_merged_page(writer, out_page, chunk_reader.pages[k], base_page)
+        write_pdf(writer, out_pdf)
+
+    return finish_chunks
 
 
 def comment_anchor_center_y(anchor: dict[str, Any], page_h: float) -> float:
@@ -725,25 +2541,28 @@ def sort_comments_by_anchor(comments: list[dict[str, Any]], page_h: float) -> li
     return sorted(comments, key=lambda ann: comment_anchor_center_y(ann["anchor"], page_h), reverse=True)
 
 
+def comment_wrap_text(ann: dict[str, Any]) -> str:
+    marker_id = int(ann.get("marker_id", 0) or 0)
+    label = f"[{marker_id}] " if marker_id > 0 else ""
+    return f"{label}{ann['text']}"
+
+
 def build_comment_queue(
     comments: list[dict[str, Any]],
     page_h: float,
     text_w: float,
     font_name: str,
     font_size: float,
-) -> list[dict[str, Any]]:
-    queue: list[dict[str, Any]] = []
+) -> deque[dict[str, Any]]:
+    queue: deque[dict[str, Any]] = deque()
     for ann in sort_comments_by_anchor(comments, page_h):
-        marker_id = int(ann.get("marker_id", 0) or 0)
-        label = f"[{marker_id}] " if marker_id > 0 else ""
-        text_for_wrap = f"{label}{ann['text']}"
-        lines = wrap_text_by_width(text_for_wrap, font_name, font_size, text_w)
+        lines = wrap_text_by_width(comment_wrap_text(ann), font_name, font_size, text_w)
         queue.append(
             {
                 "anchor": ann["anchor"],
                 "text": ann["text"],
                 "lines": lines,
-                "marker_id": marker_id,
+                "marker_id": int(ann.get("marker_id", 0) or 0),
                 "continued": False,
                 "anchor_y": comment_anchor_center_y(ann["anchor"], page_h),
             }
@@ -751,27 +2570,48 @@ def build_comment_queue(
     return queue
 
 
+def comment_stack_min_height(
+    unit_table: list[list[tuple[int, int]] | None],
+    font_name: str,
+    font_size: float,
+    text_w: float,
+) -> float:
+    # 全ボックスを隙間なく上から積んだ高さの下限。アンカー位置に合わせるとボックスは下へずれるだけなので、
+    # これが余白の高さを超えるフォントサイズは折り返しも配置も試さずに収まらないと分かる
+    if not unit_table or any(units is None for units in unit_table):
+        return 0.0
+    _, _, glyph_h, line_step = get_font_metrics(font_name, font_size)
+    total_lines = sum(min_wrapped_line_count(units, font_size, text_w) for units in unit_table if units is not None)
+    count = len(unit_table)
+    return (
+        count * (2.0 * COMMENT_BOX_PAD_Y + glyph_h)
+        + line_step * (total_lines - count)
+        + COMMENT_BOX_GAP * (count - 1)
+    )
+
+
 def place_comment_queue_on_page(
-    queue: list[dict[str, Any]],
+    queue: deque[dict[str, Any]],
     page_h: float,
     box_x: float,
     box_w: float,
     font_name: str,
     font_size: float,
     anchor_mode: bool,
-) -> tuple[list[dict[str, Any]], list[dict[str, Any]]]:
+) -> tuple[list[dict[str, Any]], deque[dict[str, Any]]]:
+    # queue は先頭から取り出して消費し、載らなかった残りとしてそのまま返す
     ascent, descent, glyph_h, line_step = get_font_metrics(font_name, font_size)
     top_limit = page_h - COMMENT_MARGIN_PAD_Y
     bottom_limit = COMMENT_MARGIN_PAD_Y
     cursor_top = top_limit
     placements: list[dict[str, Any]] = []
-    pending = [dict(item) for item in queue]
+    pending = queue
 
     while pending:
         item = pending[0]
         lines = list(item.get("lines") or [])
         if not lines:
-            pending.pop(0)
+            pending.popleft()
             continue
 
         min_box_h = 2.0 * COMMENT_BOX_PAD_Y + glyph_h
@@ -816,13 +2656,13 @@ def place_comment_queue_on_page(
                     "continued": bool(item.get("continued", False) or bool(rest_lines)),
                 }
             )
-            pending.pop(0)
+            pending.popleft()
             if rest_lines:
                 remained = dict(item)
                 remained["lines"] = rest_lines
                 remained["continued"] = True
                 remained["anchor_y"] = None
-                pending.insert(0, remained)
+                pending.appendleft(remained)
             cursor_top = part_y - COMMENT_BOX_GAP
             continue
 
@@ -842,7 +2682,7 @@ def place_comment_queue_on_page(
                 "continued": bool(item.get("continued", False)),
             }
         )
-        pending.pop(0)
+        pending.popleft()
         cursor_top = box_y - COMMENT_BOX_GAP
 
     return placements, pending
@@ -858,15 +2698,23 @@ def build_comment_layout_pages(
     text_w = inner_w - (2.0 * COMMENT_BOX_PAD_X)
     box_x = COMMENT_MARGIN_PAD_X
     box_w = inner_w
+    usable_h = page_h - 2.0 * COMMENT_MARGIN_PAD_Y
 
+    min_size = COMMENT_FONT_MIN
+    ordered = sort_comments_by_anchor(comments, page_h)
+    unit_table = [text_width_units(comment_wrap_text(ann), font_name) for ann in ordered]
+    queues: dict[float, deque[dict[str, Any]]] = {}
     for size in iter_font_sizes(COMMENT_FONT_START, COMMENT_FONT_MIN, COMMENT_FONT_STEP):
-        queue = build_comment_queue(comments, page_h, text_w, font_name, size)
-        placements, remaining = place_comment_queue_on_page(queue, page_h, box_x, box_w, font_name, size, True)
+        if size != min_size and comment_stack_min_height(unit_table, font_name, size, text_w) > usable_h + 1e-6:
+            continue
+        queue = build_comment_queue(ordered, page_h, text_w, font_name, size)
+        queues[size] = queue
+        placements, remaining = place_comment_queue_on_page(deque(queue), page_h, box_x, box_w, font_name, size, True)
         if not remaining:
             return ([{"placements": placements, "font_size": size, "continuation": False}], size)
 
-    min_size = COMMENT_FONT_MIN
-    queue = build_comment_queue(comments, page_h, text_w, font_name, min_size)
+    # 最小サイズの折り返し結果は上のループで作ったものを使い回す
+    queue = queues.get(min_size) or build_comment_queue(ordered, page_h, text_w, font_name, min_size)
     layouts: list[dict[str, Any]] = []
 
     first_placements, queue = place_comment_queue_on_page(queue, page_h, box_x, box_w, font_name, min_size, True)
@@ -879,7 +2727,7 @@ def build_comment_layout_pages(
             item = dict(queue[0])
             lines = list(item.get("lines") or [])
             if not lines:
-                queue = queue[1:]
+                queue.popleft()
                 continue
             item["lines"] = [lines[0]]
             queue[0] = item
@@ -1005,21 +2853,22 @@ def build_comment_overlay_page(
     return PdfReader(buf).pages[0]
 
 
-def merge_comment_overlay_with_margin(
-    base_pdf: Path,
-    out_pdf: Path,
+def merge_comment_pages(
+    base_reader: PdfReader,
+    writer: PdfWriter,
     draw_plan: dict[int, dict[str, Any]],
     regular_font: str,
     bold_font: str,
-    stats: dict[str, Any],
-) -> None:
-    base_reader = PdfReader(str(base_pdf))
-    writer = PdfWriter()
-
+    start: int,
+    end: int,
+) -> tuple[float | None, int, list[int]]:
     min_font_used: float | None = None
     continuation_pages = 0
+    # 出力した各ページがどの元ページに対応するか（継続ページも同じ元ページ番号）
+    sources: list[int] = []
 
-    for i, base_page in enumerate(base_reader.pages):
+    for i in range(start, end):
+        base_page = base_reader.pages[i]
         page_num = i + 1
         base_w = float(base_page.mediabox.width)
         base_h = float(base_page.mediabox.height)
@@ -1059,6 +2908,7 @@ def merge_comment_overlay_with_margin(
             None,
         )
         out_page.merge_page(main_overlay)
+        sources.append(i)
 
         for cont_idx, layout in enumerate(layouts[1:], start=1):
             continuation_pages += 1
@@ -1076,20 +2926,389 @@ def merge_comment_overlay_with_margin(
                 label,
             )
             cont_page.merge_page(cont_overlay)
+            sources.append(i)
 
-    with out_pdf.open("wb") as f:
-        writer.write(f)
+    return min_font_used, continuation_pages, sources
 
-    stats["comment_pages_extended"] = len(base_reader.pages)
-    stats["comment_min_font_used"] = float(min_font_used if min_font_used is not None else COMMENT_FONT_START)
-    stats["comment_continuation_pages"] = continuation_pages
 
+def merge_comment_chunk(
+    base_pdf: Path,
+    draw_plan: dict[int, dict[str, Any]],
+    start: int,
+    end: int,
+) -> tuple[bytes, float | None, int, list[int]]:
+    regular_font, bold_font = ensure_fonts()
+    writer = PdfWriter()
+    min_font_used, continuation_pages, sources = merge_comment_pages(
+        open_pdf_reader(base_pdf),
+        writer,
+        draw_plan,
+        regular_font,
+        bold_font,
+        start,
+        end,
+    )
+    buf = BytesIO()
+    writer.write(buf)
+    return buf.getvalue(), min_font_used, continuation_pages, sources
 
-def annotate(args: argparse.Namespace) -> dict[str, Any]:
-    payload = json.loads(Path(args.input_json).read_text(encoding="utf-8"))
 
+def start_comment_overlay(
+    base_pdf: Path,
+    out_pdf: PdfOutput,
+    draw_plan: dict[int, dict[str, Any]],
+    regular_font: str,
+    bold_font: str,
+    stats: dict[str, Any],
+    jobs: int = 1,
+    executor: Executor | None = None,
+    output_mode: str = "full",
+    annotation_style: str = "overlay",
+    page_window: int = 0,
+) -> Callable[[], None]:
+    base_reader = open_pdf_reader(base_pdf)
+
+    if annotation_style == "native":
+        # 余白を付けず、元ページに取り消し線とコメント注釈（/Text）を付けるだけにする
+        if output_mode == "incremental" and base_reader.is_encrypted:
+            output_mode = "full"
+        stats["comment_pages_extended"] = 0
+        stats["comment_min_font_used"] = COMMENT_FONT_START
+        stats["comment_continuation_pages"] = 0
+        if page_window > 0 and output_mode == "full":
+            page_count = len(base_reader.pages)
+            return lambda: write_page_windows(base_pdf, out_pdf, draw_plan, page_count, page_window, add_native_pages)
+        if executor is None:
+            return lambda: write_pdf_bytes(
+                write_native_annotations(base_pdf, draw_plan, output_mode), out_pdf, output_mode == "full"
+            )
+        native = executor.submit(write_native_annotations, base_pdf, dict(draw_plan), output_mode)
+        return lambda: write_pdf_bytes(native.result(), out_pdf, output_mode == "full")
+
+    page_count = len(base_reader.pages)
+
+    # 元ページの注釈は merge_page 時に複製されるので、注釈を持つPDFは分割しない
+    chunks = page_chunks(page_count, jobs) if executor is not None else []
+    if chunks and any("/Annots" in page for page in base_reader.pages):
+        chunks = []
+
+    def record_stats(min_font_used: float | None, continuation_pages: int) -> None:
+        stats["comment_pages_extended"] = page_count
+        stats["comment_min_font_used"] = float(min_font_used if min_font_used is not None else COMMENT_FONT_START)
+        stats["comment_continuation_pages"] = continuation_pages
+
+    if page_window > 0:
+        def render_window(
+            reader: PdfReader,
+            writer: PdfWriter,
+            plan: dict[int, dict[str, Any]],
+            start: int,
+            end: int,
+        ) -> tuple[float | None, int, list[int]]:
+            return merge_comment_pages(reader, writer, plan, regular_font, bold_font, start, end)
+
+        def finish_windows() -> None:
+            results = write_page_windows(base_pdf, out_pdf, draw_plan, page_count, page_window, render_window)
+            fonts = [font for font, _, _ in results if font is not None]
+            record_stats(min(fonts) if fonts else None, sum(count for _, count, _ in results))
+
+        return finish_windows
+
+    if executor is None:
+        def finish_serial() -> None:
+            writer = PdfWriter()
+            min_font_used, continuation_pages, _ = merge_comment_pages(
+                base_reader,
+                writer,
+                draw_plan,
+                regular_font,
+                bold_font,
+                0,
+                page_count,
+            )
+            write_pdf(writer, out_pdf)
+            record_stats(min_font_used, continuation_pages)
+
+        return finish_serial
+
+    if not chunks:
+        whole = submit_page_chunks(executor, merge_comment_chunk, base_pdf, draw_plan, [(0, page_count)])[0]
+
+        def finish_whole() -> None:
+            data, min_font_used, continuation_pages, _ = whole.result()
+            write_pdf_bytes(data, out_pdf)
+            record_stats(min_font_used, continuation_pages)
+
+        return finish_whole
+
+    futures = submit_page_chunks(executor, merge_comment_chunk, base_pdf, draw_plan, chunks)
+
+    def finish_chunks() -> None:
+        writer = PdfWriter()
+        min_font_used: float | None = None
+        continuation_pages = 0
+        for future in futures:
+            data, chunk_min_font, chunk_continuation_pages, sources = future.result()
+            chunk_reader = PdfReader(BytesIO(data))
+            prev_source = -1
+            for chunk_page, source in zip(chunk_reader.pages, sources):
+                base_page = base_reader.pages[source]
+                out_page = writer.add_blank_page(
+                    width=float(base_page.mediabox.width) + COMMENT_MARGIN_WIDTH,
+                    height=float(base_page.mediabox.height),
+                )
+                # 継続ページは元ページを合成していないので、リソースはすべて子プロセス側から取る
+                graft_merged_page(writer, out_page, chunk_page, base_page if source != prev_source else None)
+                prev_source = source
+            if chunk_min_font is not None:
+                min_font_used = chunk_min_font if min_font_used is None else min(min_font_used, chunk_min_font)
+            continuation_pages += chunk_continuation_pages
+        write_pdf(writer, out_pdf)
+        record_stats(min_font_used, continuation_pages)
+
+    return finish_chunks
+
+
+def annotate(args: argparse.Namespace, outputs: dict[str, Path]) -> dict[str, Any]:
+    with collect_step_timings():
+        if args.input_annotate:
+            # DAI1 は mmap して、token_map は読まれた token の分だけ dict にする
+            with timed_step("load_input"):
+                payload = read_annotate_input(Path(args.input_annotate))
+        else:
+            with timed_step("load_json"):
+                payload = json.loads(Path(args.input_json).read_text(encoding="utf-8"))
+        if args.save_annotate_input:
+            with timed_step("save_annotate_input"):
+                write_annotate_input(Path(args.save_annotate_input), payload)
+        return annotate_payload(
+            payload,
+            Path(args.source_a),
+            Path(args.source_b),
+            outputs.get("ann_a"),
+            outputs.get("ann_b"),
+            outputs.get("ann_comment"),
+            jobs=max(1, args.jobs),
+            ann_output_mode=args.ann_output_mode,
+            annotation_style=args.annotation_style,
+            page_window=max(0, args.page_window),
+            optimize_output=args.optimize_output,
+            save_plans=Path(args.save_plans) if args.save_plans else None,
+            changes_index=Path(args.changes_index) if args.changes_index else None,
+        )
+
+
+def render(args: argparse.Namespace, outputs: dict[str, Path]) -> dict[str, Any]:
+    # --save-plans で保存した描画計画から、選んだ注釈PDFだけを作る（抽出・差分はやり直さない）
+    with collect_step_timings() as timings:
+        with timed_step("load_plans"):
+            plans = read_draw_plans(Path(args.input_plans))
+        stats: dict[str, Any] = {}
+        render_outputs(
+            Path(args.source_a) if args.source_a else Path(),
+            Path(args.source_b) if args.source_b else Path(),
+            plans,
+            outputs,
+            stats,
+            max(1, args.jobs),
+            args.ann_output_mode,
+            args.annotation_style,
+            max(0, args.page_window),
+            args.optimize_output,
+        )
+        stats["timings"] = timings.summary()
+    return stats
+
+
+def write_draw_plans(path: Path, plans: dict[str, dict[int, dict[str, Any]]]) -> None:
+    # 出力ごと・ページごとの赤線・枠・コメント。後から --phase render で注釈PDFを作るのに使う
+    data = {
+        "version": DRAW_PLANS_VERSION,
+        "plans": {name: {str(page): plan[page] for page in sorted(plan)} for name, plan in plans.items()},
+    }
+    path.write_text(json.dumps(data, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+
+
+def read_draw_plans(path: Path) -> dict[str, dict[int, dict[str, Any]]]:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError) as exc:
+        raise PipelineError(f"cannot read draw plans ({path.name}): {exc}") from exc
+    if not isinstance(data, dict) or data.get("version") != DRAW_PLANS_VERSION:
+        raise PipelineError(f"unsupported draw plans ({path.name})")
+    return {name: {int(page): plan for page, plan in pages.items()} for name, pages in data["plans"].items()}
+
+
+def bbox_union(boxes: Iterable[dict[str, float] | None]) -> dict[str, float] | None:
+    union: dict[str, float] | None = None
+    for bbox in boxes:
+        if not bbox:
+            continue
+        if union is None:
+            union = {k: float(bbox[k]) for k in ("x_min", "y_min", "x_max", "y_max")}
+            continue
+        union["x_min"] = min(union["x_min"], float(bbox["x_min"]))
+        union["y_min"] = min(union["y_min"], float(bbox["y_min"]))
+        union["x_max"] = max(union["x_max"], float(bbox["x_max"]))
+        union["y_max"] = max(union["y_max"], float(bbox["y_max"]))
+    if union is None:
+        return None
+    return {k: round(v, 2) for k, v in union.items()}
+
+
+def token_range_pages(token_map: list[Any], start: int, end: int) -> list[int] | None:
+    # 範囲の先頭・末尾から最も近い bbox のある token のページ（token は文書順なのでページは昇順）。
+    # 相手側の範囲が空の op（start == end）は、その token の直後に挿入/削除された位置
+    size = len(token_map)
+    first = next((token_map[i] for i in range(max(0, start), min(end, size - 1) + 1) if token_map[i]), None)
+    if first is None:
+        first = next((token_map[i] for i in (start, start + 1) if 0 <= i < size and token_map[i]), None)
+        if first is None:
+            return None
+        page = int(first.get("page") or 0)
+        return [page, page]
+    last = next(token_map[i] for i in range(min(end, size - 1), max(0, start) - 1, -1) if token_map[i])
+    return [int(first.get("page") or 0), int(last.get("page") or 0)]
+
+
+def build_changes_index(
+    plans: dict[str, dict[int, dict[str, Any]]],
+    ops: list[dict[str, Any]],
+    map_a: list[Any],
+    map_b: list[Any],
+) -> dict[str, Any]:
+    # ページごとの変更件数・変更箇所の外接矩形・コメント番号と、diff の op がどのページにあたるか。
+    # 注釈PDFを開かずにページへ移動したり、必要なページだけを取り出したりするのに使う
+    ann_a = plans.get("ann_a", {})
+    ann_b = plans.get("ann_b", {})
+    ann_comment = plans.get("ann_comment", {})
+    pages_a: list[dict[str, Any]] = []
+    for page in sorted(set(ann_a) | set(ann_comment)):
+        strikes = (ann_a.get(page) or ann_comment[page])["strike"]
+        # コメント番号は注釈PDFと同じく、ページ内で上から順に 1 から振る（並びはページの高さによらない）
+        comments = sort_comments_by_anchor(ann_comment.get(page, {}).get("comment", []), 0.0)
+        if not strikes and not comments:
+            continue
+        pages_a.append(
+            {
+                "page": page,
+                "strike": len(strikes),
+                "comment": len(comments),
+                "bbox": bbox_union([e.get("bbox") for e in strikes] + [ann["anchor"].get("bbox") for ann in comments]),
+                "markers": [
+                    {
+                        "id": marker_id,
+                        "bbox": bbox_union([ann["anchor"].get("bbox")]),
+                        "b_start": ann.get("b_start"),
+                        "b_end": ann.get("b_end"),
+                    }
+                    for marker_id, ann in enumerate(comments, start=1)
+                ],
+            }
+        )
+    pages_b = [
+        {"page": page, "mark": len(ann_b[page]["mark"]), "bbox": bbox_union(e.get("bbox") for e in ann_b[page]["mark"])}
+        for page in sorted(ann_b)
+        if ann_b[page]["mark"]
+    ]
+    index_ops = [
+        {
+            "type": op.get("type"),
+            "a_start": op.get("a_start"),
+            "a_end": op.get("a_end"),
+            "b_start": op.get("b_start"),
+            "b_end": op.get("b_end"),
+            "pages_a": token_range_pages(map_a, int(op.get("a_start", -1)), int(op.get("a_end", -1))),
+            "pages_b": token_range_pages(map_b, int(op.get("b_start", -1)), int(op.get("b_end", -1))),
+        }
+        for op in ops
+    ]
+    return {"version": CHANGES_INDEX_VERSION, "pages_a": pages_a, "pages_b": pages_b, "ops": index_ops}
+
+
+def write_changes_index(path: Path, index: dict[str, Any]) -> None:
+    path.write_text(json.dumps(index, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+
+
+def render_outputs(
+    source_a: Path,
+    source_b: Path,
+    plans: dict[str, dict[int, dict[str, Any]]],
+    outputs: dict[str, PdfOutput],
+    stats: dict[str, Any],
+    jobs: int = 1,
+    ann_output_mode: str = "full",
+    annotation_style: str = "overlay",
+    page_window: int = 0,
+    optimize_output: bool = False,
+) -> None:
+    # outputs にある出力（ann_a / ann_b / ann_comment）だけを作る
+    names = [name for name in OUTPUT_NAMES.values() if name in outputs]
+    stats["outputs"] = names
+    if not names:
+        return
+    regular_font, bold_font = ensure_fonts()
+    # jobs > 1 では選んだ出力の処理をすべて先に子プロセスへ投入し、出力順に受け取って組み立てる。
+    # 出力ごとの段階（ann_a など）は描画・合成の時間で、書き出しは "ann_a/write" に分けて記録する
+    with shared_pdf_readers(), optimized_outputs(optimize_output) as output_sizes:
+        with timed_step("open_sources"):
+            for source in {source_b if name == "ann_b" else source_a for name in names}:
+                open_pdf_reader(source)
+        # page_window では出力を窓ごとに順に作る（子プロセスごとにページを抱えない）
+        with annotate_executor(1 if page_window > 0 else jobs) as executor:
+            with timed_step("start_outputs"):
+                finishers = []
+                for name in names:
+                    if name == "ann_comment":
+                        finish = start_comment_overlay(
+                            source_a,
+                            outputs[name],
+                            plans[name],
+                            regular_font,
+                            bold_font,
+                            stats,
+                            jobs,
+                            executor,
+                            ann_output_mode,
+                            annotation_style,
+                            page_window,
+                        )
+                    else:
+                        source = source_a if name == "ann_a" else source_b
+                        finish = start_overlay(
+                            source, outputs[name], plans[name], jobs, executor, ann_output_mode, annotation_style, page_window
+                        )
+                    finishers.append(finish)
+            for name, finish in zip(names, finishers):
+                if output_sizes is not None:
+                    output_sizes.current = name
+                with timed_step(name):
+                    finish()
+        if output_sizes is not None:
+            stats["output_sizes"] = output_sizes.summary()
+
+
+def annotate_payload(
+    payload: dict[str, Any],
+    source_a: Path,
+    source_b: Path,
+    output_ann_a: PdfOutput | None,
+    output_ann_b: PdfOutput | None,
+    output_ann_comment: PdfOutput | None,
+    jobs: int = 1,
+    ann_output_mode: str = "full",
+    annotation_style: str = "overlay",
+    page_window: int = 0,
+    optimize_output: bool = False,
+    save_plans: Path | None = None,
+    changes_index: Path | None = None,
+) -> dict[str, Any]:
+    # 書き出し先が None の出力は作らない（save_plans に描画計画を残せば後から --phase render で作れる）
     map_a = payload.get("map_a", [])
     map_b = payload.get("map_b", [])
+    # pipeline では numpy があれば token_map と同じ内容の列配列も渡る（JSON入力の annotate では無し）
+    arrays_a: TokenMapArrays | None = payload.get("map_a_arrays")
+    arrays_b: TokenMapArrays | None = payload.get("map_b_arrays")
     deleted_ranges = payload.get("deleted_ranges", [])
     added_ranges = payload.get("added_ranges", [])
     ops = payload.get("ops", [])
@@ -1100,154 +3319,1006 @@ def annotate(args: argparse.Namespace) -> dict[str, Any]:
         deleted_bridge_chars = 2
     deleted_bridge_chars = max(0, deleted_bridge_chars)
 
-    stats: dict[str, Any] = {
-        "skipped_duplicates": 0,
-        "map_a_missing": 0,
-        "map_b_missing": 0,
-        "comment_merged_groups": 0,
-        "deleted_ranges_input": 0,
-        "deleted_ranges_output": 0,
-        "deleted_bridge_merges": 0,
-    }
+    with collect_step_timings() as timings:
+        stats: dict[str, Any] = {
+            "skipped_duplicates": 0,
+            "map_a_missing": 0,
+            "map_b_missing": 0,
+            "comment_merged_groups": 0,
+            "deleted_ranges_input": 0,
+            "deleted_ranges_output": 0,
+            "deleted_bridge_merges": 0,
+        }
 
-    normalized_deleted_ranges = normalize_ranges(deleted_ranges)
-    bridged_deleted_ranges, deleted_bridge_merges = bridge_deleted_ranges(
-        normalized_deleted_ranges,
-        map_a,
-        deleted_bridge_chars,
-    )
-    stats["deleted_ranges_input"] = len(normalized_deleted_ranges)
-    stats["deleted_ranges_output"] = len(bridged_deleted_ranges)
-    stats["deleted_bridge_merges"] = deleted_bridge_merges
-
-    deleted_indices = range_to_indices(bridged_deleted_ranges)
-    added_indices = range_to_indices(added_ranges)
-
-    deleted_entries = map_entries_for_indices(
-        map_a,
-        deleted_indices,
-        stats,
-        "map_a_missing",
-        prefer_token_bbox=True,
-    )
-    added_entries = map_entries_for_indices(map_b, added_indices, stats, "map_b_missing")
+        with timed_step("bridge"):
+            normalized_deleted_ranges = normalize_ranges(deleted_ranges)
+            bridged_deleted_ranges, deleted_bridge_merges = bridge_deleted_ranges(
+                normalized_deleted_ranges,
+                map_a,
+                deleted_bridge_chars,
+                arrays_a,
+            )
+        stats["deleted_ranges_input"] = len(normalized_deleted_ranges)
+        stats["deleted_ranges_output"] = len(bridged_deleted_ranges)
+        stats["deleted_bridge_merges"] = deleted_bridge_merges
+
+        with timed_step("entries"):
+            # 範囲は区間のまま token_map を読み、重複除去も読みながら行う（変更文字ごとのリストを作らない）
+            deleted_pages = None
+            if arrays_a is not None:
+                deleted_entries, deleted_pages = arrays_a.draw_entries(
+                    map_a, bridged_deleted_ranges, stats, "map_a_missing", "deleted", prefer_token_bbox=True
+                )
+            else:
+                deleted_entries = dedupe_draw_entries(
+                    iter_range_entries(map_a, bridged_deleted_ranges, stats, "map_a_missing", prefer_token_bbox=True),
+                    "deleted",
+                    stats,
+                )
+            added_pages = None
+            if arrays_b is not None:
+                added_entries, added_pages = arrays_b.draw_entries(map_b, added_ranges, stats, "map_b_missing", "added")
+            else:
+                added_entries = dedupe_draw_entries(
+                    iter_range_entries(map_b, added_ranges, stats, "map_b_missing"),
+                    "added",
+                    stats,
+                )
+
+            deleted_group_lookup = DeletedGroupLookup(bridged_deleted_ranges, len(map_a))
+            drawable_deleted_group_ids: set[int] = set()
+            for e in deleted_entries:
+                token_index = e.get("token_index")
+                try:
+                    idx = int(token_index)
+                except (TypeError, ValueError):
+                    continue
+                gid = deleted_group_lookup.get(idx)
+                if gid >= 0:
+                    drawable_deleted_group_ids.add(gid)
+
+        with timed_step("comments"):
+            comments = build_comment_annotations(
+                ops,
+                map_a,
+                map_b,
+                bridged_deleted_ranges,
+                stats,
+                allowed_deleted_group_ids=drawable_deleted_group_ids,
+                deleted_lookup=deleted_group_lookup,
+            )
 
-    deleted_entries = dedupe_draw_entries(deleted_entries, "deleted", stats)
-    added_entries = dedupe_draw_entries(added_entries, "added", stats)
+        with timed_step("plan"):
+            ann_a_plan: dict[int, dict[str, Any]] = defaultdict(lambda: {"strike": [], "mark": [], "comment": []})
+            ann_b_plan: dict[int, dict[str, Any]] = defaultdict(lambda: {"strike": [], "mark": [], "comment": []})
+            ann_comment_plan: dict[int, dict[str, Any]] = defaultdict(lambda: {"strike": [], "mark": [], "comment": []})
+
+            bucket_draw_entries([ann_a_plan, ann_comment_plan], "strike", deleted_entries, deleted_pages)
+            bucket_draw_entries([ann_b_plan], "mark", added_entries, added_pages)
+
+            for ann in comments:
+                page = int(ann["anchor"].get("page") or 0)
+                ann_comment_plan[page]["comment"].append(ann)
+            plans = {"ann_a": ann_a_plan, "ann_b": ann_b_plan, "ann_comment": ann_comment_plan}
+
+        if save_plans is not None:
+            with timed_step("save_plans"):
+                write_draw_plans(save_plans, plans)
+        if changes_index is not None:
+            with timed_step("changes_index"):
+                write_changes_index(changes_index, build_changes_index(plans, ops, map_a, map_b))
+
+        outputs = {
+            name: out_pdf
+            for name, out_pdf in zip(OUTPUT_NAMES.values(), (output_ann_a, output_ann_b, output_ann_comment))
+            if out_pdf is not None
+        }
+        render_outputs(
+            source_a,
+            source_b,
+            plans,
+            outputs,
+            stats,
+            jobs,
+            ann_output_mode,
+            annotation_style,
+            page_window,
+            optimize_output,
+        )
 
-    deleted_group_lookup = build_deleted_group_lookup(bridged_deleted_ranges, len(map_a))
-    drawable_deleted_group_ids: set[int] = set()
-    for e in deleted_entries:
-        token_index = e.get("token_index")
+        stats["input_deleted_tokens"] = count_range_indices(bridged_deleted_ranges)
+        stats["input_added_tokens"] = count_range_indices(added_ranges)
+        stats["unique_deleted_draw_units"] = len(deleted_entries)
+        stats["unique_added_draw_units"] = len(added_entries)
+        stats["comment_count"] = len(comments)
+        if page_window > 0:
+            stats["page_window"] = page_window
+        stats["timings"] = timings.summary()
+    return stats
+
+
+def reconstruct_words(
+    source_pdf: Path,
+    input_xhtml: Path | None,
+    pdftotext_cmd: str,
+    pdftotext_timeout: float,
+    extractor: str = "pdftotext",
+) -> WordStore:
+    if input_xhtml is not None:
+        return parse_bbox_layout_file(input_xhtml)
+    if extractor == "pypdf":
+        stats: dict[str, int] = {}
         try:
-            idx = int(token_index)
-        except (TypeError, ValueError):
-            continue
-        if idx < 0 or idx >= len(deleted_group_lookup):
-            continue
-        gid = deleted_group_lookup[idx]
-        if gid >= 0:
-            drawable_deleted_group_ids.add(gid)
-
-    comments = build_comment_annotations(
-        ops,
-        map_a,
-        map_b,
-        bridged_deleted_ranges,
-        stats,
-        allowed_deleted_group_ids=drawable_deleted_group_ids,
-    )
+            words = extract_words_pypdf(source_pdf, stats)
+        except Exception as exc:
+            raise PipelineError(f"pypdf extraction failed ({source_pdf.name}): {exc}") from exc
+        unmapped = stats.get("unmapped_glyphs", 0)
+        if not unmapped:
+            return words
+        # Unicode に戻せない文字（cidToUnicode の無い CIDフォント等）があると比較表・コメントが崩れるので、
+        # pdftotext が使えればそちらで抽出し直す
+        if shutil.which(pdftotext_cmd) is None:
+            print(
+                f"WARN : pypdf could not map {unmapped} glyphs to Unicode ({source_pdf.name}); "
+                "install poppler-data or set DIFFF_CID_TO_UNICODE_DIR",
+                file=sys.stderr,
+            )
+            return words
+        print(f"WARN : pypdf could not map {unmapped} glyphs to Unicode ({source_pdf.name}); using pdftotext", file=sys.stderr)
+    try:
+        return pdftotext_words(source_pdf, pdftotext_cmd, pdftotext_timeout)
+    except subprocess.TimeoutExpired as exc:
+        raise PipelineError(f"pdftotext timeout ({source_pdf.name})") from exc
 
-    regular_font, bold_font = ensure_fonts()
 
-    ann_a_plan: dict[int, dict[str, Any]] = defaultdict(lambda: {"strike": [], "mark": [], "comment": []})
-    ann_b_plan: dict[int, dict[str, Any]] = defaultdict(lambda: {"strike": [], "mark": [], "comment": []})
-    ann_comment_plan: dict[int, dict[str, Any]] = defaultdict(lambda: {"strike": [], "mark": [], "comment": []})
+def pack_extraction(words: WordStore, text: str) -> bytes:
+    encoded = text.encode("utf-8", errors="surrogatepass")
+    return EXTRACTION_HEADER.pack(EXTRACTION_MAGIC, len(encoded)) + encoded + words.to_bytes()
 
-    for e in deleted_entries:
-        page = int(e.get("page") or 0)
-        ann_a_plan[page]["strike"].append(e)
-        ann_comment_plan[page]["strike"].append(e)
 
-    for e in added_entries:
-        page = int(e.get("page") or 0)
-        ann_b_plan[page]["mark"].append(e)
-
-    for ann in comments:
-        page = int(ann["anchor"].get("page") or 0)
-        ann_comment_plan[page]["comment"].append(ann)
-
-    merge_overlay(Path(args.source_a), Path(args.output_ann_a), ann_a_plan, regular_font, bold_font)
-    merge_overlay(Path(args.source_b), Path(args.output_ann_b), ann_b_plan, regular_font, bold_font)
-    merge_comment_overlay_with_margin(
-        Path(args.source_a),
-        Path(args.output_ann_comment),
-        ann_comment_plan,
-        regular_font,
-        bold_font,
-        stats,
+def unpack_extraction(data: bytes) -> tuple[WordStore, str]:
+    magic, text_size = EXTRACTION_HEADER.unpack_from(data, 0)
+    if magic != EXTRACTION_MAGIC:
+        raise ValueError("not an extraction cache entry")
+    offset = EXTRACTION_HEADER.size
+    text = data[offset : offset + text_size].decode("utf-8", errors="surrogatepass")
+    return WordStore.from_bytes(data[offset + text_size :]), text
+
+
+@lru_cache(maxsize=1)
+def extraction_code_version() -> str:
+    # 単語化・再構成のコード（このファイルと pypdf_words.py）の内容。変更されたら古い抽出キャッシュを使わない
+    digest = hashlib.sha256()
+    for name in ("pdf_annotate_diff.py", "pypdf_words.py"):
+        digest.update(Path(__file__).with_name(name).read_bytes())
+    return digest.hexdigest()[:16]
+
+
+def extractor_version(extractor: str, pdftotext_cmd: str) -> str:
+    if extractor == "pypdf":
+        # 文字の対応表と、対応表が無いときに抽出し直す pdftotext の版も含める
+        return f"pypdf {PYPDF_VERSION} {cid_to_unicode_version()} {extractor_version('pdftotext', pdftotext_cmd)}"
+    # `pdftotext -v` を毎回起動せず、実行ファイルの実体・サイズ・更新時刻を版の代わりにする
+    resolved = shutil.which(pdftotext_cmd) or pdftotext_cmd
+    try:
+        real = os.path.realpath(resolved)
+        st = os.stat(real)
+    except OSError:
+        return f"pdftotext {pdftotext_cmd}"
+    return f"pdftotext {real} {st.st_size} {st.st_mtime_ns}"
+
+
+# --phase batch 実行中だけ有効。複数の組で共有する元PDFの抽出結果（解決済みパス -> (単語, 再構成テキスト)）
+_shared_extractions: dict[str, tuple[WordStore, str]] | None = None
+
+
+def load_extraction(
+    source_pdf: Path,
+    input_xhtml: Path | None,
+    pdftotext_cmd: str,
+    pdftotext_timeout: float,
+    extractor: str,
+    cache: ExtractCache | None,
+) -> tuple[WordStore, str, str]:
+    # (単語, 再構成テキスト, キャッシュ状態 hit/miss/off/shared)
+    if _shared_extractions is not None and input_xhtml is None:
+        shared = _shared_extractions.get(str(source_pdf.resolve()))
+        if shared is not None:
+            return shared[0], shared[1], "shared"
+    if cache is None or input_xhtml is not None:
+        words = reconstruct_words(source_pdf, input_xhtml, pdftotext_cmd, pdftotext_timeout, extractor)
+        return words, reconstruct_text_from_words(words), "off"
+    key = cache_key(
+        file_sha256(source_pdf),
+        EXTRACTION_MAGIC.decode("ascii"),
+        extractor,
+        extractor_version(extractor, pdftotext_cmd),
+        extraction_code_version(),
     )
+    data = cache.get(key)
+    if data is not None:
+        try:
+            words, text = unpack_extraction(data)
+        except (ValueError, struct.error, UnicodeDecodeError):
+            pass
+        else:
+            return words, text, "hit"
+    words = reconstruct_words(source_pdf, None, pdftotext_cmd, pdftotext_timeout, extractor)
+    text = reconstruct_text_from_words(words)
+    try:
+        cache.put(key, pack_extraction(words, text))
+    except OSError as exc:
+        # キャッシュに書けなくても比較自体は続ける
+        print(f"extract cache write failed: {exc}", file=sys.stderr)
+    return words, text, "miss"
+
+
+def identical_pipeline_result(
+    text_a: str,
+    text_b: str,
+    a_ids: array,
+    b_ids: array,
+    table: TokenTable,
+    with_table: bool,
+    cache_a: str,
+    cache_b: str,
+    timings: StepTimings,
+) -> dict[str, Any]:
+    # 差分が無いときは注釈PDFを作らない（出力先には何も書かない）
+    diff_table = None
+    if with_table:
+        with timed_step("diff_table"):
+            for ids in (a_ids, b_ids):
+                if not ids:
+                    ids.append(table.intern(""))
+            diff_table = build_diff_table(a_ids, b_ids, table.tokens, [])
+    summary: dict[str, Any] = {
+        "identical": True,
+        "seq_a_tokens": len(a_ids),
+        "seq_b_tokens": len(b_ids),
+        "extract_cache_a": cache_a,
+        "extract_cache_b": cache_b,
+        "timings": timings.summary(),
+    }
+    return {"summary": summary, "text_a": text_a, "text_b": text_b, "table": diff_table}
+
+
+def run_pipeline(
+    source_a: Path,
+    source_b: Path,
+    output_ann_a: PdfOutput | None,
+    output_ann_b: PdfOutput | None,
+    output_ann_comment: PdfOutput | None,
+    input_xhtml_a: Path | None = None,
+    input_xhtml_b: Path | None = None,
+    deleted_bridge_chars: int = 2,
+    pdftotext_cmd: str = DEFAULT_PDFTOTEXT_CMD,
+    pdftotext_timeout: float = 60.0,
+    diff_cmd: str = DEFAULT_DIFF_CMD,
+    max_chars: int | None = None,
+    extractor: str = "pdftotext",
+    diff_engine: str = "auto",
+    with_table: bool = False,
+    jobs: int = 1,
+    ann_output_mode: str = "full",
+    annotation_style: str = "overlay",
+    extract_cache: ExtractCache | None = None,
+    page_prefilter: bool = False,
+    page_window: int = 0,
+    optimize_output: bool = False,
+    save_plans: Path | None = None,
+    changes_index: Path | None = None,
+    save_annotate_input: Path | None = None,
+) -> dict[str, Any]:
+    with collect_step_timings() as timings:
+        with timed_step("extract_a"):
+            words_a, text_a, cache_a = load_extraction(
+                source_a, input_xhtml_a, pdftotext_cmd, pdftotext_timeout, extractor, extract_cache
+            )
+        with timed_step("extract_b"):
+            words_b, text_b, cache_b = load_extraction(
+                source_b, input_xhtml_b, pdftotext_cmd, pdftotext_timeout, extractor, extract_cache
+            )
+        if max_chars is not None:
+            for side, text in (("A", text_a), ("B", text_b)):
+                if len(text) > max_chars:
+                    raise TextTooLargeError(side, max_chars)
+
+        with timed_step("tokenize"):
+            # トークンは文字列のリストを作らず、整数IDの配列として保持する
+            table = TokenTable()
+            a_ids = split_text_ids(escape_char(text_a), table)
+            b_ids = split_text_ids(escape_char(text_b), table)
+        if page_prefilter and text_a == text_b:
+            # 全ページの指紋が一致する（= 再構成テキストが同じ）なら差分は無いので、token_map も作らずに終える
+            if changes_index is not None:
+                write_changes_index(changes_index, build_changes_index({}, [], [], []))
+            return identical_pipeline_result(text_a, text_b, a_ids, b_ids, table, with_table, cache_a, cache_b, timings)
+        with timed_step("token_map"):
+            if page_window > 0:
+                # 文書全体の token_map は作らず、描画・コメントで読まれた token だけ dict にする
+                word_index_a = token_word_index(words_a)
+                word_index_b = token_word_index(words_b)
+                token_counts = {
+                    "map_a_tokens": len(word_index_a),
+                    "seq_a_tokens": len(a_ids),
+                    "map_b_tokens": len(word_index_b),
+                    "seq_b_tokens": len(b_ids),
+                }
+                map_a = LazyTokenMap(words_a, word_index_a, len(a_ids))
+                map_b = LazyTokenMap(words_b, word_index_b, len(b_ids))
+            else:
+                word_index_a = array("i") if np is not None else None
+                word_index_b = array("i") if np is not None else None
+                map_a = build_token_bbox_map_from_words(words_a, word_index_a)
+                map_b = build_token_bbox_map_from_words(words_b, word_index_b)
+                token_counts = {
+                    "map_a_tokens": len(map_a),
+                    "seq_a_tokens": len(a_ids),
+                    "map_b_tokens": len(map_b),
+                    "seq_b_tokens": len(b_ids),
+                }
+                map_a = normalize_token_map_size(map_a, len(a_ids))
+                map_b = normalize_token_map_size(map_b, len(b_ids))
+            arrays_a = token_map_arrays(words_a, word_index_a, len(map_a))
+            arrays_b = token_map_arrays(words_b, word_index_b, len(map_b))
+
+        with timed_step("diff"):
+            # 空のテキストは `diff` へ空行1つとして渡っていたので、同じ入力に揃える
+            for ids in (a_ids, b_ids):
+                if not ids:
+                    ids.append(table.intern(""))
+            prefilter_stats = None
+            spans_a = page_token_spans(text_a, page_text_spans(words_a)) if page_prefilter else []
+            spans_b = page_token_spans(text_b, page_text_spans(words_b)) if page_prefilter else []
+            # ページ範囲が token 列全体と一致しない（空のテキスト等）ときは全体を差分する
+            if spans_a and spans_b and spans_a[-1][1] == len(a_ids) and spans_b[-1][1] == len(b_ids):
+                hunks, used_engine, prefilter_stats = prefiltered_hunks(
+                    a_ids, b_ids, spans_a, spans_b, table, diff_engine, diff_cmd
+                )
+            else:
+                hunks, used_engine = diff_token_ids(a_ids, b_ids, table, diff_engine, diff_cmd)
+            deleted_ranges, added_ranges, ops = ranges_from_hunks(hunks)
+        diff_table = None
+        if with_table:
+            with timed_step("diff_table"):
+                diff_table = build_diff_table(a_ids, b_ids, table.tokens, hunks)
+        payload = {
+            "map_a": map_a,
+            "map_b": map_b,
+            "map_a_arrays": arrays_a,
+            "map_b_arrays": arrays_b,
+            "deleted_ranges": deleted_ranges,
+            "added_ranges": added_ranges,
+            "deleted_bridge_chars": deleted_bridge_chars,
+            "ops": ops,
+        }
+        if save_annotate_input is not None:
+            # 抽出・差分をやり直さずに --phase annotate --input-annotate で注釈だけを作り直せる
+            with timed_step("save_annotate_input"):
+                write_annotate_input(save_annotate_input, payload)
+        summary = annotate_payload(
+            payload,
+            source_a,
+            source_b,
+            output_ann_a,
+            output_ann_b,
+            output_ann_comment,
+            jobs,
+            ann_output_mode,
+            annotation_style,
+            page_window,
+            optimize_output,
+            save_plans,
+            changes_index,
+        )
+        summary.update(token_counts)
+        summary["diff_engine"] = used_engine
+        summary["extract_cache_a"] = cache_a
+        summary["extract_cache_b"] = cache_b
+        summary["identical"] = False
+        if prefilter_stats is not None:
+            summary["page_prefilter"] = prefilter_stats
+        summary["timings"] = timings.summary()
+    return {"summary": summary, "text_a": text_a, "text_b": text_b, "table": diff_table}
+
+
+def read_batch_manifest(manifest_path: Path, output_dir: Path) -> list[dict[str, str]]:
+    # {"baseline": "A.pdf", "revisions": ["B1.pdf", ...]} または
+    # {"pairs": [{"a": "A.pdf", "b": "B1.pdf", "name": "任意"}, ...]}。相対パスはマニフェストの場所から解決する
+    manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    if not isinstance(manifest, dict):
+        raise PipelineError("batch manifest must be a JSON object")
+    base_dir = manifest_path.parent
+    raw_pairs: list[dict[str, Any]] = []
+    if manifest.get("baseline") is not None:
+        raw_pairs.extend({"a": manifest["baseline"], "b": rev} for rev in manifest.get("revisions") or [])
+    raw_pairs.extend(manifest.get("pairs") or [])
+    pairs: list[dict[str, str]] = []
+    for index, raw in enumerate(raw_pairs, start=1):
+        if not isinstance(raw, dict) or not raw.get("a") or not raw.get("b"):
+            raise PipelineError(f"batch manifest pair {index} needs a and b")
+        source_a = base_dir / str(raw["a"])
+        source_b = base_dir / str(raw["b"])
+        name = re.sub(r"[^\w.-]+", "_", str(raw.get("name") or source_b.stem))
+        pairs.append(
+            {
+                "name": f"{index:03d}-{name}",
+                "source_a": str(source_a),
+                "source_b": str(source_b),
+                "output_dir": str(output_dir / f"{index:03d}-{name}"),
+            }
+        )
+    return pairs
+
+
+def install_batch_state(packed: dict[str, bytes], reader_cache_size: int) -> None:
+    # batch の子プロセス初期化。fork で親の状態（抽出結果と解析済みReader）を引き継いだ子では何もしない。
+    # spawn の子は抽出結果を WordStore のバイト列で受け取り、Reader は子ごとに1回だけ解析する
+    global _reader_cache, _shared_extractions
+    if _shared_extractions is not None:
+        return
+    _reader_cache = PdfReaderCache(reader_cache_size)
+    _shared_extractions = {path: unpack_extraction(data) for path, data in packed.items()}
+
+
+def run_batch_pair(pair: dict[str, str], options: dict[str, Any]) -> dict[str, Any]:
+    started = time.perf_counter()
+    out_dir = Path(pair["output_dir"])
+    entry: dict[str, Any] = {
+        "name": pair["name"],
+        "source_a": pair["source_a"],
+        "source_b": pair["source_b"],
+        "output_dir": pair["output_dir"],
+    }
+    try:
+        out_dir.mkdir(parents=True, exist_ok=True)
+        result = run_pipeline(
+            Path(pair["source_a"]),
+            Path(pair["source_b"]),
+            out_dir / "annotatedA.pdf",
+            out_dir / "annotatedB.pdf",
+            out_dir / "annotatedComment.pdf",
+            changes_index=out_dir / "changes_index.json",
+            **options,
+        )
+        (out_dir / "summary.json").write_text(
+            json.dumps(result["summary"], ensure_ascii=False, separators=(",", ":")),
+            encoding="utf-8",
+        )
+        entry["identical"] = bool(result["summary"].get("identical"))
+    except PipelineError as exc:
+        entry.update({"status": "error", "error": str(exc)})
+    except Exception:
+        entry.update({"status": "error", "error": traceback.format_exc()})
+    else:
+        entry["status"] = "ok"
+    entry["seconds"] = round(time.perf_counter() - started, 3)
+    return entry
+
+
+def run_batch(
+    pairs: list[dict[str, str]],
+    options: dict[str, Any],
+    workers: int = 1,
+    extract_cache: ExtractCache | None = None,
+) -> dict[str, Any]:
+    global _reader_cache, _shared_extractions
+    started = time.perf_counter()
+    extractor = options.get("extractor", "pdftotext")
+    pdftotext_cmd = options.get("pdftotext_cmd", DEFAULT_PDFTOTEXT_CMD)
+    pdftotext_timeout = options.get("pdftotext_timeout", 60.0)
+
+    # 複数の組に現れる元PDF（基準PDFなど）は親で1回だけ抽出し、各組の処理へ渡す
+    uses: dict[str, int] = defaultdict(int)
+    for pair in pairs:
+        for key in ("source_a", "source_b"):
+            uses[str(Path(pair[key]).resolve())] += 1
+    packed: dict[str, bytes] = {}
+    extract_errors: dict[str, str] = {}
+    for path, count in uses.items():
+        if count < 2:
+            continue
+        try:
+            words, text, _ = load_extraction(Path(path), None, pdftotext_cmd, pdftotext_timeout, extractor, extract_cache)
+        except (PipelineError, OSError) as exc:
+            # 抽出に失敗したPDFは各組で改めて失敗させ、組ごとのエラーとして記録する
+            extract_errors[path] = str(exc)
+            continue
+        packed[path] = pack_extraction(words, text)
+    extract_seconds = time.perf_counter() - started
+
+    reader_cache_size = max(2, len(packed) + 2)
+    ensure_fonts()
+    entries: list[dict[str, Any]] = []
+    prev_cache, prev_shared = _reader_cache, _shared_extractions
+    _shared_extractions = None
+    try:
+        install_batch_state(packed, reader_cache_size)
+        for path in packed:
+            try:
+                open_pdf_reader(Path(path))
+            except Exception:
+                # 開けないPDFは各組の処理でエラーとして記録する
+                pass
+        if workers <= 1:
+            entries = [run_batch_pair(pair, options) for pair in pairs]
+        else:
+            # 子プロセスの中では注釈のページ並列をしない（プールの入れ子を避ける）
+            pair_options = dict(options, jobs=1)
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=install_batch_state,
+                initargs=(packed, reader_cache_size),
+            ) as executor:
+                futures = [executor.submit(run_batch_pair, pair, pair_options) for pair in pairs]
+                entries = [future.result() for future in futures]
+    finally:
+        _reader_cache, _shared_extractions = prev_cache, prev_shared
+
+    failed = [entry for entry in entries if entry["status"] != "ok"]
+    return {
+        "pairs": entries,
+        "pair_count": len(entries),
+        "ok_count": len(entries) - len(failed),
+        "failed_count": len(failed),
+        "shared_sources": sorted(packed),
+        "shared_extract_errors": extract_errors,
+        "workers": max(1, workers),
+        "extract_seconds": round(extract_seconds, 3),
+        "total_seconds": round(time.perf_counter() - started, 3),
+    }
 
-    stats["input_deleted_tokens"] = len(deleted_indices)
-    stats["input_added_tokens"] = len(added_indices)
-    stats["unique_deleted_draw_units"] = len(deleted_entries)
-    stats["unique_added_draw_units"] = len(added_entries)
-    stats["comment_count"] = len(comments)
-    return stats
 
+def parse_outputs(value: str) -> list[str]:
+    names = list(dict.fromkeys(name.strip() for name in value.split(",") if name.strip()))
+    unknown = [name for name in names if name not in OUTPUT_NAMES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown outputs: {','.join(unknown)} (choose from {','.join(OUTPUT_NAMES)})")
+    return names
 
-def parse_args() -> argparse.Namespace:
+
+def selected_outputs(args: argparse.Namespace) -> dict[str, Path] | None:
+    # --outputs で選んだ出力の書き出し先（出力名 → パス）。選んだ出力の書き出し先が無ければ None
+    paths = {"annA": args.output_ann_a, "annB": args.output_ann_b, "annComment": args.output_ann_comment}
+    if any(paths[name] is None for name in args.outputs):
+        return None
+    return {OUTPUT_NAMES[name]: Path(paths[name]) for name in args.outputs}
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
     p = argparse.ArgumentParser()
-    p.add_argument("--phase", choices=["reconstruct", "annotate"], required=True)
+    p.add_argument("--phase", choices=["reconstruct", "annotate", "pipeline", "render", "batch", "serve"], required=True)
 
     p.add_argument("--input-xhtml")
+    p.add_argument("--input-pdf")
     p.add_argument("--output-json")
+    p.add_argument("--output-words")
+    p.add_argument("--extractor", choices=EXTRACTORS, default="pdftotext")
 
     p.add_argument("--source-a")
     p.add_argument("--source-b")
     p.add_argument("--input-json")
+    p.add_argument("--input-annotate")
+    p.add_argument("--save-annotate-input")
     p.add_argument("--output-ann-a")
     p.add_argument("--output-ann-b")
     p.add_argument("--output-ann-comment")
+    p.add_argument("--outputs", type=parse_outputs, default=",".join(OUTPUT_NAMES))
+    p.add_argument("--save-plans")
+    p.add_argument("--input-plans")
+    p.add_argument("--changes-index")
     p.add_argument("--summary-json")
-    return p.parse_args()
 
+    p.add_argument("--input-xhtml-a")
+    p.add_argument("--input-xhtml-b")
+    p.add_argument("--output-text-a")
+    p.add_argument("--output-text-b")
+    p.add_argument("--pdftotext-cmd", default=DEFAULT_PDFTOTEXT_CMD)
+    p.add_argument("--pdftotext-timeout", type=float, default=60.0)
+    p.add_argument("--diff-cmd", default=DEFAULT_DIFF_CMD)
+    p.add_argument("--diff-engine", choices=DIFF_ENGINES, default="auto")
+    p.add_argument("--output-table")
+    p.add_argument("--deleted-bridge-chars", type=int, default=2)
+    p.add_argument("--max-chars", type=int)
+    p.add_argument("--jobs", type=int, default=1)
+    p.add_argument("--ann-output-mode", choices=ANN_OUTPUT_MODES, default="full")
+    p.add_argument("--annotation-style", choices=ANNOTATION_STYLES, default="overlay")
+    p.add_argument("--page-prefilter", action="store_true")
+    p.add_argument("--page-window", type=int, default=0)
+    p.add_argument("--optimize-output", action="store_true")
+    p.add_argument("--extract-cache-dir")
+    p.add_argument("--extract-cache-max-mb", type=int, default=EXTRACT_CACHE_MAX_MB)
+    p.add_argument("--profile", action="store_true")
+    p.add_argument("--trace-memory", action="store_true")
+
+    p.add_argument("--manifest")
+    p.add_argument("--output-dir")
+    p.add_argument("--batch-workers", type=int, default=1)
+
+    p.add_argument("--socket")
+    p.add_argument("--reader-cache-size", type=int, default=READER_CACHE_SIZE)
+    return p.parse_args(argv)
+
+
+def run_worker_job(job: Any) -> dict[str, Any]:
+    # ジョブ専用の子プロセス（run_job_with_deadline）で呼ぶ。作業ディレクトリと標準エラーはこのプロセスだけ切り替える。
+    # 標準エラーをジョブのログへ向けた後のエラーはログへ書き、応答の error は空にする
+    if not isinstance(job, dict):
+        return {"status": 2, "error": "invalid job"}
+    logged = False
+    try:
+        cwd = job.get("cwd")
+        if cwd:
+            os.chdir(str(cwd))
+        stderr_path = job.get("stderr")
+        if stderr_path:
+            fd = os.open(str(stderr_path), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            os.dup2(fd, sys.stderr.fileno())
+            os.close(fd)
+            logged = True
+        argv = job.get("argv")
+        if not isinstance(argv, list) or not all(isinstance(x, str) for x in argv):
+            return worker_error(2, "invalid job argv", logged)
+        args = parse_args(argv)
+        if args.phase == "serve":
+            return worker_error(2, "serve is not allowed as a job", logged)
+        return {"status": run_phase(args), "error": None}
+    except SystemExit as exc:
+        code = exc.code if isinstance(exc.code, int) else 2
+        return worker_error(code, "invalid job arguments", logged)
+    except Exception:
+        return worker_error(1, traceback.format_exc().rstrip("\n"), logged)
+    finally:
+        sys.stderr.flush()
+
+
+def worker_error(status: int, message: str, logged: bool) -> dict[str, Any]:
+    if logged:
+        print(message, file=sys.stderr)
+        return {"status": status, "error": None}
+    return {"status": status, "error": message}
+
+
+def run_job_with_deadline(job: Any) -> dict[str, Any]:
+    # ジョブは別プロセスグループの子で実行し、timeout 秒を過ぎたら --jobs の子プロセスごと止める
+    timeout = job.get("timeout") if isinstance(job, dict) else None
+    deadline = time.monotonic() + float(timeout) if isinstance(timeout, (int, float)) and timeout > 0 else None
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        os.setpgid(0, 0)
+        # worker本体の SIGTERM ハンドラ（sys.exit）は引き継がず、止められたらそのまま終わる
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        code = 1
+        try:
+            data = json.dumps(run_worker_job(job), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            with os.fdopen(write_fd, "wb") as out:
+                out.write(data)
+            code = 0
+        finally:
+            os._exit(code)
+    os.close(write_fd)
+    try:
+        os.setpgid(pid, pid)
+    except OSError:
+        pass
+
+    chunks: list[bytes] = []
+    timed_out = False
+    with os.fdopen(read_fd, "rb", buffering=0) as pipe:
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                timed_out = True
+                break
+            ready, _, _ = select.select([pipe], [], [], remaining)
+            if not ready:
+                continue
+            chunk = pipe.read(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
 
-def main() -> int:
-    args = parse_args()
+    if timed_out:
+        stop_process_group(pid)
+        return {"status": 1, "error": None, "timeout": True}
+    _, wait_status = os.waitpid(pid, 0)
+    try:
+        response = json.loads(b"".join(chunks).decode("utf-8"))
+    except (UnicodeDecodeError, ValueError):
+        return {"status": 1, "error": f"job process exited: {os.waitstatus_to_exitcode(wait_status)}"}
+    return response if isinstance(response, dict) else {"status": 1, "error": "invalid job response"}
+
+
+def stop_process_group(pid: int) -> None:
+    # run_command_timeout（difff.pl）と同じく TERM の後に KILL する
+    try:
+        os.killpg(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    end = time.monotonic() + 1.0
+    exited = False
+    while not exited and time.monotonic() < end:
+        exited = os.waitpid(pid, os.WNOHANG)[0] == pid
+        if not exited:
+            time.sleep(0.05)
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    if not exited:
+        os.waitpid(pid, 0)
+
+
+class AnnotateWorkerHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        # 受付の合図。workerが応答できない状態なら届かないので、クライアントは待たずに通常起動へ切り替えられる
+        try:
+            self.wfile.write(b"ready\n")
+        except OSError:
+            return
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            job = json.loads(line.decode("utf-8"))
+        except (UnicodeDecodeError, ValueError):
+            response: dict[str, Any] = {"status": 2, "error": "invalid job json"}
+        else:
+            response = run_job_with_deadline(job)
+        self.wfile.write(json.dumps(response, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n")
+
+
+class ForkingUnixStreamServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    # 接続ごとに fork して同時に受け付ける（Python 3.12 の socketserver.ForkingUnixStreamServer と同じ）
+    pass
+
+
+def worker_is_listening(socket_path: Path) -> bool:
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(str(socket_path))
+    except OSError:
+        return False
+    finally:
+        probe.close()
+    return True
+
+
+def serve(socket_path: Path, reader_cache_size: int) -> int:
+    global _reader_cache
+
+    if socket_path.exists():
+        if worker_is_listening(socket_path):
+            print(f"worker already running: {socket_path}", file=sys.stderr)
+            return 1
+        # 前回異常終了時に残ったソケットファイルは作り直す
+        socket_path.unlink()
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # ジョブの子プロセスはこの空のキャッシュを引き継いで1ジョブの中で使う（時間切れで止められるよう、ジョブの間では共有しない）
+    _reader_cache = PdfReaderCache(reader_cache_size)
+    ensure_fonts()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    with ForkingUnixStreamServer(str(socket_path), AnnotateWorkerHandler) as server:
+        os.chmod(socket_path, 0o600)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            socket_path.unlink(missing_ok=True)
+    return 0
+
+
+def extract_cache_from_args(args: argparse.Namespace) -> ExtractCache | None:
+    if not args.extract_cache_dir:
+        return None
+    return ExtractCache(Path(args.extract_cache_dir), max(0, args.extract_cache_max_mb) * 1024 * 1024)
+
+
+def profile_output_dir(args: argparse.Namespace) -> Path:
+    # 成果物と同じ場所に置く（summary の隣、batch は出力ディレクトリ）
+    if args.summary_json:
+        return Path(args.summary_json).parent
+    if args.output_dir:
+        return Path(args.output_dir)
+    return Path.cwd()
+
+
+def run_phase(args: argparse.Namespace) -> int:
+    global _measure_unoptimized
+
+    if not (args.profile or args.trace_memory) or args.phase == "serve":
+        return dispatch_phase(args)
+    # --profile: <phase>.prof（pstats で読める）、--trace-memory: <phase>.tracemalloc（tracemalloc.Snapshot.load で読める）。
+    # jobs / batch-workers の子プロセスでの処理は含まない
+    out_dir = profile_output_dir(args)
+    profiler = cProfile.Profile() if args.profile else None
+    started_tracing = args.trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    _measure_unoptimized = bool(args.profile)
+    try:
+        if profiler is not None:
+            profiler.enable()
+        try:
+            return dispatch_phase(args)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            out_dir.mkdir(parents=True, exist_ok=True)
+            if profiler is not None:
+                profiler.dump_stats(str(out_dir / f"{args.phase}.prof"))
+            if args.trace_memory:
+                tracemalloc.take_snapshot().dump(str(out_dir / f"{args.phase}.tracemalloc"))
+    finally:
+        _measure_unoptimized = False
+        if started_tracing:
+            tracemalloc.stop()
+
+
+def dispatch_phase(args: argparse.Namespace) -> int:
     if args.phase == "reconstruct":
-        if not args.input_xhtml or not args.output_json:
+        source = args.input_pdf if args.extractor == "pypdf" else args.input_xhtml
+        if not source or not (args.output_json or args.output_words):
             print("missing args for reconstruct", file=sys.stderr)
             return 2
-        payload = reconstruct_from_xhtml(Path(args.input_xhtml))
-        Path(args.output_json).write_text(
-            json.dumps(payload, ensure_ascii=False, separators=(",", ":")),
-            encoding="utf-8",
-        )
+        if args.extractor == "pypdf":
+            words = extract_words_pypdf(Path(source))
+        else:
+            words = parse_bbox_layout_file(Path(source))
+        if args.output_json:
+            with Path(args.output_json).open("w", encoding="utf-8") as fh:
+                write_reconstruct_json(words, fh)
+        if args.output_words:
+            Path(args.output_words).write_bytes(words.to_bytes())
         return 0
 
     if args.phase == "annotate":
-        required = [
-            args.source_a,
-            args.source_b,
-            args.input_json,
-            args.output_ann_a,
-            args.output_ann_b,
-            args.output_ann_comment,
-            args.summary_json,
-        ]
-        if any(x is None for x in required):
+        outputs = selected_outputs(args)
+        required = [args.source_a, args.source_b, args.input_json or args.input_annotate, args.summary_json]
+        if outputs is None or any(x is None for x in required):
             print("missing args for annotate", file=sys.stderr)
             return 2
-        summary = annotate(args)
+        try:
+            summary = annotate(args, outputs)
+        except PipelineError as exc:
+            print(str(exc), file=sys.stderr)
+            return 3
         Path(args.summary_json).write_text(
             json.dumps(summary, ensure_ascii=False, separators=(",", ":")),
             encoding="utf-8",
         )
         return 0
 
+    if args.phase == "render":
+        outputs = selected_outputs(args)
+        required = [args.input_plans]
+        if "ann_a" in (outputs or {}) or "ann_comment" in (outputs or {}):
+            required.append(args.source_a)
+        if "ann_b" in (outputs or {}):
+            required.append(args.source_b)
+        if outputs is None or any(x is None for x in required):
+            print("missing args for render", file=sys.stderr)
+            return 2
+        try:
+            summary = render(args, outputs)
+        except PipelineError as exc:
+            print(str(exc), file=sys.stderr)
+            return 3
+        if args.summary_json:
+            Path(args.summary_json).write_text(
+                json.dumps(summary, ensure_ascii=False, separators=(",", ":")),
+                encoding="utf-8",
+            )
+        return 0
+
+    if args.phase == "pipeline":
+        outputs = selected_outputs(args)
+        required = [args.source_a, args.source_b, args.summary_json]
+        if outputs is None or any(x is None for x in required):
+            print("missing args for pipeline", file=sys.stderr)
+            return 2
+        try:
+            result = run_pipeline(
+                Path(args.source_a),
+                Path(args.source_b),
+                outputs.get("ann_a"),
+                outputs.get("ann_b"),
+                outputs.get("ann_comment"),
+                input_xhtml_a=Path(args.input_xhtml_a) if args.input_xhtml_a else None,
+                input_xhtml_b=Path(args.input_xhtml_b) if args.input_xhtml_b else None,
+                deleted_bridge_chars=max(0, args.deleted_bridge_chars),
+                pdftotext_cmd=args.pdftotext_cmd,
+                pdftotext_timeout=args.pdftotext_timeout,
+                diff_cmd=args.diff_cmd,
+                max_chars=args.max_chars,
+                extractor=args.extractor,
+                diff_engine=args.diff_engine,
+                with_table=args.output_table is not None,
+                jobs=max(1, args.jobs),
+                ann_output_mode=args.ann_output_mode,
+                annotation_style=args.annotation_style,
+                extract_cache=extract_cache_from_args(args),
+                page_prefilter=args.page_prefilter,
+                page_window=max(0, args.page_window),
+                optimize_output=args.optimize_output,
+                save_plans=Path(args.save_plans) if args.save_plans else None,
+                changes_index=Path(args.changes_index) if args.changes_index else None,
+                save_annotate_input=Path(args.save_annotate_input) if args.save_annotate_input else None,
+            )
+        except PipelineError as exc:
+            print(str(exc), file=sys.stderr)
+            error: dict[str, Any] = {"error": str(exc)}
+            if isinstance(exc, TextTooLargeError):
+                error.update({"error_kind": "text_too_large", "side": exc.side, "limit": exc.limit})
+            Path(args.summary_json).write_text(
+                json.dumps(error, ensure_ascii=False, separators=(",", ":")),
+                encoding="utf-8",
+            )
+            return 3
+        for out_path, text in ((args.output_text_a, result["text_a"]), (args.output_text_b, result["text_b"])):
+            if out_path:
+                Path(out_path).write_text(text, encoding="utf-8")
+        if args.output_table:
+            Path(args.output_table).write_text(result["table"], encoding="utf-8")
+        Path(args.summary_json).write_text(
+            json.dumps(result["summary"], ensure_ascii=False, separators=(",", ":")),
+            encoding="utf-8",
+        )
+        return 0
+
+    if args.phase == "batch":
+        if not args.manifest or not args.output_dir:
+            print("missing args for batch", file=sys.stderr)
+            return 2
+        output_dir = Path(args.output_dir)
+        try:
+            pairs = read_batch_manifest(Path(args.manifest), output_dir)
+        except (PipelineError, OSError, ValueError) as exc:
+            print(f"invalid batch manifest: {exc}", file=sys.stderr)
+            return 2
+        extract_cache = extract_cache_from_args(args)
+        options = {
+            "deleted_bridge_chars": max(0, args.deleted_bridge_chars),
+            "pdftotext_cmd": args.pdftotext_cmd,
+            "pdftotext_timeout": args.pdftotext_timeout,
+            "diff_cmd": args.diff_cmd,
+            "max_chars": args.max_chars,
+            "extractor": args.extractor,
+            "diff_engine": args.diff_engine,
+            "jobs": max(1, args.jobs),
+            "ann_output_mode": args.ann_output_mode,
+            "annotation_style": args.annotation_style,
+            "extract_cache": extract_cache,
+            "page_prefilter": args.page_prefilter,
+            "page_window": max(0, args.page_window),
+            "optimize_output": args.optimize_output,
+        }
+        summary = run_batch(pairs, options, max(1, args.batch_workers), extract_cache)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        (output_dir / "batch_summary.json").write_text(
+            json.dumps(summary, ensure_ascii=False, separators=(",", ":")),
+            encoding="utf-8",
+        )
+        return 0 if summary["failed_count"] == 0 else 3
+
+    if args.phase == "serve":
+        if not args.socket:
+            print("missing args for serve", file=sys.stderr)
+            return 2
+        return serve(Path(args.socket), args.reader_cache_size)
+
     return 2
 
 
+def main() -> int:
+    return run_phase(parse_args())
+
+
 if __name__ == "__main__":
     raise SystemExit(main())
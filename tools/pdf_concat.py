@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+from io import BytesIO
+from pathlib import Path
+from typing import Any, BinaryIO
+
+from pypdf import PdfReader
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject
+
+
+# 窓ごとに書き出した部分PDFを、ページを PdfWriter に集めずに1つのPDFへつなぐ。
+#   部分PDF: PdfWriter が書いたもの（ページツリーは1段、暗号化なし）を前提にする
+#   連結    : 部分PDFを1つずつ開き、ページから辿れるオブジェクトを番号を振り直してそのまま書き出す
+#             （ストリームは復号・再圧縮しない）。部分PDFのページツリーと Catalog は捨て、
+#             全ページを Kids に並べたページツリーを最後に書く
+# 保持するのは開いている部分PDF 1つ分と、オブジェクトの位置表・全ページの参照だけ。
+
+PDF_BINARY_MARKER = b"%\xe2\xe3\xcf\xd3\n"
+
+
+def reachable_objects(page_refs: list[IndirectObject], tree_ids: set[int]) -> list[IndirectObject]:
+    # ページから参照を辿って書き出すオブジェクトを集める（ページツリーの節は辿らない）
+    found: list[IndirectObject] = []
+    seen = set(tree_ids)
+    stack = list(reversed(page_refs))
+    while stack:
+        ref = stack.pop()
+        if ref.idnum in seen:
+            continue
+        seen.add(ref.idnum)
+        found.append(ref)
+        children: list[IndirectObject] = []
+        collect_references(ref.get_object(), children)
+        stack.extend(reversed(children))
+    return found
+
+
+# pypdf のオブジェクト型は typing.Protocol を継承していて isinstance が遅いので、
+# 辞書・配列は組み込み型で、参照は型そのもので見分ける
+def collect_references(obj: Any, out: list[IndirectObject]) -> None:
+    if type(obj) is IndirectObject:
+        out.append(obj)
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            collect_references(value, out)
+    elif isinstance(obj, list):
+        for value in obj:
+            collect_references(value, out)
+
+
+def renumber_references(obj: Any, numbers: dict[int, int]) -> Any:
+    # 読み込んだオブジェクトをその場で書き換える（部分PDFのReaderは連結後に捨てる）
+    if type(obj) is IndirectObject:
+        return IndirectObject(numbers[obj.idnum], 0, None)
+    if isinstance(obj, dict):
+        for key, value in list(obj.items()):
+            dict.__setitem__(obj, key, renumber_references(value, numbers))
+    elif isinstance(obj, list):
+        for i, value in enumerate(obj):
+            list.__setitem__(obj, i, renumber_references(value, numbers))
+    return obj
+
+
+class ConcatWriter:
+    def __init__(self, out: BinaryIO, header: str) -> None:
+        self.out = out
+        self.position = 0
+        # 0番は空き、1番は Catalog、2番はページツリーの根（最後に書く）
+        self.offsets: list[int] = [0, 0, 0]
+        self.kids = ArrayObject()
+        self.info: IndirectObject | None = None
+        self.write_raw(header.encode("ascii") + b"\n" + PDF_BINARY_MARKER)
+
+    def write_raw(self, data: bytes) -> None:
+        self.out.write(data)
+        self.position += len(data)
+
+    def allocate(self) -> int:
+        self.offsets.append(0)
+        return len(self.offsets) - 1
+
+    def write_object(self, number: int, obj: Any) -> None:
+        buf = BytesIO()
+        obj.write_to_stream(buf)
+        self.offsets[number] = self.position
+        self.write_raw(b"%d 0 obj\n" % number + buf.getvalue() + b"\nendobj\n")
+
+    def add_part(self, path: Path) -> int:
+        reader = PdfReader(str(path))
+        tree_ids = {ref.idnum for ref in page_tree_refs(reader)}
+        page_refs = [page.indirect_reference for page in reader.pages]
+        objects = reachable_objects(page_refs, tree_ids)
+        numbers = {ref.idnum: self.allocate() for ref in objects}
+        for tree_id in tree_ids:
+            numbers[tree_id] = 2
+        info_ref = reader.trailer.raw_get("/Info") if "/Info" in reader.trailer else None
+        if self.info is None and isinstance(info_ref, IndirectObject) and info_ref.idnum not in numbers:
+            objects.append(info_ref)
+            numbers[info_ref.idnum] = self.allocate()
+            self.info = IndirectObject(numbers[info_ref.idnum], 0, None)
+        for ref in objects:
+            self.write_object(numbers[ref.idnum], renumber_references(ref.get_object(), numbers))
+        self.kids.extend(IndirectObject(numbers[ref.idnum], 0, None) for ref in page_refs)
+        return len(page_refs)
+
+    def finish(self) -> None:
+        pages = DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Pages"),
+                NameObject("/Kids"): self.kids,
+                NameObject("/Count"): NumberObject(len(self.kids)),
+            }
+        )
+        catalog = DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Catalog"),
+                NameObject("/Pages"): IndirectObject(2, 0, None),
+            }
+        )
+        self.write_object(2, pages)
+        self.write_object(1, catalog)
+        xref_position = self.position
+        size = len(self.offsets)
+        lines = [b"xref\n0 %d\n" % size, b"0000000000 65535 f \n"]
+        lines.extend(b"%010d 00000 n \n" % offset for offset in self.offsets[1:])
+        self.write_raw(b"".join(lines))
+        trailer = DictionaryObject(
+            {
+                NameObject("/Size"): NumberObject(size),
+                NameObject("/Root"): IndirectObject(1, 0, None),
+            }
+        )
+        if self.info is not None:
+            trailer[NameObject("/Info")] = self.info
+        buf = BytesIO()
+        trailer.write_to_stream(buf)
+        self.write_raw(b"trailer\n" + buf.getvalue() + b"\nstartxref\n%d\n%%%%EOF\n" % xref_position)
+
+
+def page_tree_refs(reader: PdfReader) -> list[IndirectObject]:
+    refs: list[IndirectObject] = []
+    stack = [reader.trailer["/Root"].raw_get("/Pages")]
+    while stack:
+        ref = stack.pop()
+        node = ref.get_object()
+        if node.get("/Type") != "/Pages":
+            continue
+        refs.append(ref)
+        stack.extend(node.raw_get("/Kids"))
+    return refs
+
+
+def pdf_header(paths: list[Path]) -> str:
+    # 部分PDFのうち最も新しい版を名乗る
+    best = "%PDF-1.3"
+    for path in paths:
+        with path.open("rb") as fh:
+            line = fh.readline(16).strip()
+        header = line.decode("ascii", "replace")
+        if header.startswith("%PDF-") and header[5:] > best[5:]:
+            best = header
+    return best
+
+
+def concat_pdf_parts(paths: list[Path], out: BinaryIO) -> int:
+    writer = ConcatWriter(out, pdf_header(paths))
+    page_count = 0
+    for path in paths:
+        page_count += writer.add_part(path)
+    writer.finish()
+    return page_count
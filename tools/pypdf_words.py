@@ -0,0 +1,580 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import os
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Iterator
+
+from pypdf import PdfReader, __version__ as PYPDF_VERSION
+from pypdf.generic import ContentStream, DictionaryObject, NameObject
+from reportlab.pdfbase import pdfmetrics
+
+# フォントの文字コード → Unicode 対応は pypdf の公開APIにないため、内部関数を使う。
+# 動作を確かめた版（tools/pyproject.toml で固定）以外では使わず、抽出時にエラーにする
+BUILD_CHAR_MAP_VERSIONS = ("5.",)
+if PYPDF_VERSION.startswith(BUILD_CHAR_MAP_VERSIONS):
+    from pypdf._cmap import build_char_map
+else:
+    build_char_map = None
+
+
+# pdftotext (TextOutputDev) の既定値に合わせた単語/行の区切り判定
+WORD_BREAK_SPACE = 0.1
+LINE_BASELINE_TOLERANCE = 0.5
+LINE_BACKTRACK = 0.5
+DEFAULT_ASCENT = 0.95
+DEFAULT_DESCENT = -0.35
+DEFAULT_GLYPH_WIDTH = 500.0
+MAX_FORM_DEPTH = 8
+
+# Adobe-Japan1/GB1/CNS1/Korea1 は共通で CID 1-95 が ASCII 0x20-0x7E に対応する
+ADOBE_CID_ORDERINGS = {"Japan1", "GB1", "CNS1", "Korea1"}
+# ToUnicode のない Adobe CIDフォントは poppler-data の cidToUnicode/<Registry>-<Ordering>（1行1CID、16進）で戻す。
+# DIFFF_CID_TO_UNICODE_DIR があれば先に探す
+CID_TO_UNICODE_DIRS = (
+    "/opt/homebrew/share/poppler/cidToUnicode",
+    "/usr/local/share/poppler/cidToUnicode",
+    "/usr/share/poppler/cidToUnicode",
+)
+# Unicode に戻せなかった文字。元の CID を文字として出さない
+UNMAPPED_CHAR = "\ufffd"
+
+STANDARD_14_FONTS = {
+    "Courier",
+    "Courier-Bold",
+    "Courier-BoldOblique",
+    "Courier-Oblique",
+    "Helvetica",
+    "Helvetica-Bold",
+    "Helvetica-BoldOblique",
+    "Helvetica-Oblique",
+    "Symbol",
+    "Times-Bold",
+    "Times-BoldItalic",
+    "Times-Italic",
+    "Times-Roman",
+    "ZapfDingbats",
+}
+
+Matrix = tuple[float, float, float, float, float, float]
+IDENTITY: Matrix = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+# (page, line_seq, word_seq, text, bbox) : pdf_annotate_diff.Word と同じ並び
+WordTuple = tuple[int, int, int, str, "dict[str, float] | None"]
+
+
+def mat_mul(m1: Matrix, m2: Matrix) -> Matrix:
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (
+        a1 * a2 + b1 * c2,
+        a1 * b2 + b1 * d2,
+        c1 * a2 + d1 * c2,
+        c1 * b2 + d1 * d2,
+        e1 * a2 + f1 * c2 + e2,
+        e1 * b2 + f1 * d2 + f2,
+    )
+
+
+def apply_matrix(m: Matrix, x: float, y: float) -> tuple[float, float]:
+    return (m[0] * x + m[2] * y + m[4], m[1] * x + m[3] * y + m[5])
+
+
+def to_matrix(values: Any) -> Matrix:
+    try:
+        nums = [float(v) for v in values]
+    except (TypeError, ValueError):
+        return IDENTITY
+    if len(nums) != 6:
+        return IDENTITY
+    return (nums[0], nums[1], nums[2], nums[3], nums[4], nums[5])
+
+
+def clean_glyph_text(text: str) -> str:
+    if len(text) == 1 and 0x20 <= ord(text) < 0x7F:
+        return text
+    out: list[str] = []
+    for ch in text:
+        cp = ord(ch)
+        if 0xD800 <= cp <= 0xDFFF:
+            out.append("�")
+        elif cp < 0x20 or cp == 0x7F:
+            continue
+        else:
+            out.append(ch)
+    return "".join(out)
+
+
+def cid_to_unicode_dirs() -> list[str]:
+    dirs = list(CID_TO_UNICODE_DIRS)
+    env_dir = os.environ.get("DIFFF_CID_TO_UNICODE_DIR", "")
+    if env_dir:
+        dirs.insert(0, env_dir)
+    return dirs
+
+
+def find_cid_to_unicode(collection: str) -> Path | None:
+    for base in cid_to_unicode_dirs():
+        path = Path(base) / collection
+        if path.is_file():
+            return path
+    return None
+
+
+def cid_to_unicode_version() -> str:
+    # 抽出キャッシュのキー用。使われる cidToUnicode の場所・サイズ・更新時刻
+    parts: list[str] = []
+    for ordering in sorted(ADOBE_CID_ORDERINGS):
+        path = find_cid_to_unicode(f"Adobe-{ordering}")
+        if path is None:
+            parts.append(f"{ordering}:-")
+            continue
+        st = path.stat()
+        parts.append(f"{ordering}:{path}:{st.st_size}:{st.st_mtime_ns}")
+    return ",".join(parts)
+
+
+@lru_cache(maxsize=None)
+def load_cid_to_unicode(collection: str) -> tuple[str, ...] | None:
+    # collection は "Adobe-Japan1" など。CID を添字にした文字の列（対応のない CID は空文字）
+    path = find_cid_to_unicode(collection)
+    if path is None:
+        return None
+    table: list[str] = []
+    for line in path.read_text(encoding="ascii", errors="replace").splitlines():
+        fields = line.split()
+        try:
+            code = int(fields[0], 16) if fields else 0
+        except ValueError:
+            code = 0
+        table.append(chr(code) if 0 < code < 0x110000 and not 0xD800 <= code <= 0xDFFF else "")
+    return tuple(table)
+
+
+@dataclass
+class FontInfo:
+    two_byte: bool
+    encoding: Any
+    unicode_map: dict[Any, Any]
+    widths: dict[int, float]
+    default_width: float
+    width_scale: float
+    ascent: float
+    descent: float
+    # ToUnicode のない Adobe CIDフォント（Identity-H/V）の CID → Unicode（cidToUnicode が無ければ空）
+    cid_unicode: tuple[str, ...] | None = None
+    # Uni*-UCS2-* / Uni*-UTF16-* の定義済みCMapは文字コードが UTF-16 のコード単位そのもの
+    unicode_codes: bool = False
+    unmapped: int = 0
+
+    def cid_text(self, code: int) -> str:
+        table = self.cid_unicode or ()
+        if code < len(table) and table[code]:
+            return table[code]
+        if 1 <= code <= 95:
+            return chr(0x1F + code)
+        self.unmapped += 1
+        return UNMAPPED_CHAR
+
+    def decode(self, raw: bytes) -> list[tuple[int, str]]:
+        glyphs: list[tuple[int, str]] = []
+        if self.two_byte:
+            for i in range(0, len(raw) - 1, 2):
+                code = (raw[i] << 8) | raw[i + 1]
+                if self.cid_unicode is not None:
+                    glyphs.append((code, self.cid_text(code)))
+                    continue
+                # 2バイトの文字コードをそのまま文字にすると無関係な文字になるので、対応が無ければ U+FFFD にする
+                text = self.unicode_map.get(chr(code))
+                if text is None and self.unicode_codes:
+                    text = chr(code)
+                if text is None:
+                    self.unmapped += 1
+                    text = UNMAPPED_CHAR
+                glyphs.append((code, str(text)))
+            return glyphs
+        for code in raw:
+            if isinstance(self.encoding, dict):
+                ch = str(self.encoding.get(code, chr(code)))
+            else:
+                ch = chr(code)
+            glyphs.append((code, str(self.unicode_map.get(ch, ch))))
+        return glyphs
+
+    def glyph_width(self, code: int) -> float:
+        return self.widths.get(code, self.default_width) * self.width_scale
+
+
+def parse_cid_widths(w_array: Any) -> dict[int, float]:
+    widths: dict[int, float] = {}
+    if w_array is None:
+        return widths
+    items = list(w_array.get_object())
+    i = 0
+    while i < len(items):
+        first = items[i]
+        nxt = items[i + 1].get_object() if i + 1 < len(items) else None
+        try:
+            if isinstance(nxt, list):
+                start = int(first)
+                for offset, w in enumerate(nxt):
+                    widths[start + offset] = float(w)
+                i += 2
+                continue
+            if i + 2 < len(items):
+                start = int(first)
+                end = int(items[i + 1])
+                w = float(items[i + 2])
+                for cid in range(start, end + 1):
+                    widths[cid] = w
+            i += 3
+        except (TypeError, ValueError):
+            i += 1
+    return widths
+
+
+def font_vertical_metrics(descriptor: Any) -> tuple[float, float]:
+    ascent = DEFAULT_ASCENT
+    descent = DEFAULT_DESCENT
+    if descriptor is None:
+        return ascent, descent
+    descriptor = descriptor.get_object()
+    try:
+        value = float(descriptor.get("/Ascent", 0)) / 1000.0
+        if 0.0 < value <= 3.0:
+            ascent = value
+    except (TypeError, ValueError):
+        pass
+    try:
+        value = float(descriptor.get("/Descent", 0)) / 1000.0
+        if -3.0 <= value < 0.0:
+            descent = value
+    except (TypeError, ValueError):
+        pass
+    return ascent, descent
+
+
+def load_font(resources: Any, font_key: str) -> FontInfo:
+    if build_char_map is None:
+        raise RuntimeError(f"pypdf extractor is not supported with pypdf {PYPDF_VERSION}")
+    holder = DictionaryObject()
+    holder[NameObject("/Resources")] = resources
+    try:
+        font_type, _, encoding, unicode_map, font_dict = build_char_map(font_key, 200.0, holder)
+    except Exception:
+        return FontInfo(False, "charmap", {}, {}, DEFAULT_GLYPH_WIDTH, 1.0, DEFAULT_ASCENT, DEFAULT_DESCENT)
+
+    font_dict = font_dict.get_object()
+    widths: dict[int, float] = {}
+    default_width = DEFAULT_GLYPH_WIDTH
+    width_scale = 1.0
+    descriptor = font_dict.get("/FontDescriptor")
+    two_byte = font_type == "/Type0" and encoding != "charmap"
+    cid_unicode: tuple[str, ...] | None = None
+    unicode_codes = False
+
+    if font_type == "/Type0":
+        descendants = font_dict.get("/DescendantFonts")
+        descendant = descendants.get_object()[0].get_object() if descendants else DictionaryObject()
+        widths = parse_cid_widths(descendant.get("/W"))
+        default_width = float(descendant.get("/DW", 1000))
+        descriptor = descendant.get("/FontDescriptor")
+        system_info = descendant.get("/CIDSystemInfo")
+        system_info = system_info.get_object() if system_info is not None else DictionaryObject()
+        if (
+            two_byte
+            and str(font_dict.get("/Encoding", "")) in ("/Identity-H", "/Identity-V")
+            and "/ToUnicode" not in font_dict
+            and str(system_info.get("/Registry", "")) == "Adobe"
+            and str(system_info.get("/Ordering", "")) in ADOBE_CID_ORDERINGS
+        ):
+            cid_unicode = load_cid_to_unicode(f"Adobe-{str(system_info['/Ordering'])}") or ()
+        cmap_name = str(font_dict.get("/Encoding", ""))
+        unicode_codes = two_byte and cmap_name.startswith("/Uni") and ("-UCS2-" in cmap_name or "-UTF16-" in cmap_name)
+    else:
+        first_char = int(font_dict.get("/FirstChar", 0) or 0)
+        for offset, w in enumerate(font_dict.get("/Widths", None) or []):
+            widths[first_char + offset] = float(w)
+        if descriptor is not None:
+            default_width = float(descriptor.get_object().get("/MissingWidth", 0) or 0) or DEFAULT_GLYPH_WIDTH
+        base_font = str(font_dict.get("/BaseFont", "")).lstrip("/").split("+")[-1]
+        if not widths and base_font in STANDARD_14_FONTS:
+            # 標準14フォントは /Widths を省略できるため reportlab のAFMから補う
+            for code in range(256):
+                widths[code] = pdfmetrics.stringWidth(chr(code), base_font, 1000)
+        if font_type == "/Type3":
+            width_scale = to_matrix(font_dict.get("/FontMatrix", [0.001, 0, 0, 0.001, 0, 0]))[0] * 1000.0
+
+    ascent, descent = font_vertical_metrics(descriptor)
+    return FontInfo(two_byte, encoding, dict(unicode_map), widths, default_width, width_scale, ascent, descent, cid_unicode, unicode_codes)
+
+
+@dataclass
+class TextState:
+    font: FontInfo | None = None
+    size: float = 0.0
+    char_space: float = 0.0
+    word_space: float = 0.0
+    h_scale: float = 1.0
+    leading: float = 0.0
+    rise: float = 0.0
+
+    def copy(self) -> TextState:
+        return TextState(
+            self.font,
+            self.size,
+            self.char_space,
+            self.word_space,
+            self.h_scale,
+            self.leading,
+            self.rise,
+        )
+
+
+@dataclass
+class Glyph:
+    text: str
+    x_min: float
+    y_min: float
+    x_max: float
+    y_max: float
+    origin_x: float
+    end_x: float
+    baseline: float
+    size: float
+
+
+@dataclass
+class WordGrouper:
+    page: int
+    words: list[WordTuple] = field(default_factory=list)
+    line_seq: int = -1
+    line_open: bool = False
+    line_baseline: float = 0.0
+    current: list[Glyph] = field(default_factory=list)
+    last: Glyph | None = None
+
+    def break_word(self) -> None:
+        if not self.current:
+            return
+        if not self.line_open:
+            self.line_seq += 1
+            self.line_open = True
+        text = "".join(g.text for g in self.current)
+        bbox = {
+            "x_min": min(g.x_min for g in self.current),
+            "y_min": min(g.y_min for g in self.current),
+            "x_max": max(g.x_max for g in self.current),
+            "y_max": max(g.y_max for g in self.current),
+        }
+        self.words.append((self.page, self.line_seq, len(self.words), text, bbox))
+        self.current = []
+
+    def break_line(self) -> None:
+        self.break_word()
+        self.line_open = False
+        self.last = None
+
+    def add_space(self) -> None:
+        self.break_word()
+
+    def add(self, glyph: Glyph) -> None:
+        last = self.last
+        if last is not None:
+            size = max(glyph.size, last.size, 1e-6)
+            if abs(glyph.baseline - self.line_baseline) > LINE_BASELINE_TOLERANCE * size:
+                self.break_line()
+            elif glyph.origin_x < last.end_x - LINE_BACKTRACK * size:
+                self.break_line()
+            elif glyph.origin_x - last.end_x > WORD_BREAK_SPACE * size:
+                self.break_word()
+        if self.last is None:
+            self.line_baseline = glyph.baseline
+        self.current.append(glyph)
+        self.last = glyph
+
+    def finish(self) -> list[WordTuple]:
+        self.break_line()
+        return self.words
+
+
+class PageWordExtractor:
+    def __init__(self, reader: PdfReader, page_index: int) -> None:
+        page = reader.pages[page_index]
+        self.reader = reader
+        self.page = page
+        self.grouper = WordGrouper(page=page_index + 1)
+        box = page.mediabox
+        self.left = float(box.left)
+        self.top = float(box.top)
+        self.fonts: dict[tuple[int, str], FontInfo] = {}
+
+    def font(self, resources: Any, key: str) -> FontInfo | None:
+        cache_key = (id(resources), key)
+        info = self.fonts.get(cache_key)
+        if info is None:
+            fonts = resources.get("/Font") if resources is not None else None
+            if fonts is None or key not in fonts.get_object():
+                return None
+            info = load_font(resources, key)
+            self.fonts[cache_key] = info
+        return info
+
+    def extract(self) -> list[WordTuple]:
+        contents = self.page.get_contents()
+        if contents is not None:
+            resources = self.page.get("/Resources")
+            self.run(contents, resources.get_object() if resources is not None else DictionaryObject(), IDENTITY, 0)
+        return self.grouper.finish()
+
+    def emit_string(self, raw: bytes, state: TextState, tm: Matrix, ctm: Matrix) -> Matrix:
+        font = state.font
+        if font is None or state.size == 0:
+            return tm
+        a, b, c, d, e, f = tm
+        size = state.size
+        low = state.rise + font.descent * size
+        high = state.rise + font.ascent * size
+        for code, text in font.decode(raw):
+            glyph_w = font.glyph_width(code) / 1000.0 * size
+            advance = glyph_w + state.char_space
+            if code == 32 and not font.two_byte:
+                advance += state.word_space
+            advance *= state.h_scale
+
+            text = clean_glyph_text(text)
+            if not text or text.isspace():
+                self.grouper.add_space()
+            else:
+                trm = mat_mul((a, b, c, d, e, f), ctm)
+                width = glyph_w * state.h_scale
+                corners = (
+                    apply_matrix(trm, 0.0, low),
+                    apply_matrix(trm, 0.0, high),
+                    apply_matrix(trm, width, low),
+                    apply_matrix(trm, width, high),
+                )
+                xs = [p[0] for p in corners]
+                ys = [p[1] for p in corners]
+                origin = apply_matrix(trm, 0.0, state.rise)
+                scale = (abs(trm[2]) + abs(trm[3])) or 1.0
+                self.grouper.add(
+                    Glyph(
+                        text=text,
+                        x_min=min(xs) - self.left,
+                        y_min=self.top - max(ys),
+                        x_max=max(xs) - self.left,
+                        y_max=self.top - min(ys),
+                        origin_x=origin[0],
+                        end_x=apply_matrix(trm, width, state.rise)[0],
+                        baseline=origin[1],
+                        size=abs(size) * scale,
+                    )
+                )
+            e += advance * a
+            f += advance * b
+        return (a, b, c, d, e, f)
+
+    def run(self, content: Any, resources: Any, ctm: Matrix, depth: int) -> None:
+        operations = ContentStream(content, self.reader).operations
+        state = TextState()
+        stack: list[tuple[Matrix, TextState]] = []
+        tm: Matrix = IDENTITY
+        tlm: Matrix = IDENTITY
+
+        for operands, op in operations:
+            if op == b"q":
+                stack.append((ctm, state.copy()))
+            elif op == b"Q":
+                if stack:
+                    ctm, state = stack.pop()
+            elif op == b"cm":
+                ctm = mat_mul(to_matrix(operands), ctm)
+            elif op == b"BT":
+                tm = tlm = IDENTITY
+            elif op == b"ET":
+                tm = tlm = IDENTITY
+            elif op == b"Tf" and len(operands) >= 2:
+                state.font = self.font(resources, str(operands[0]))
+                state.size = float(operands[1])
+            elif op == b"Tc" and operands:
+                state.char_space = float(operands[0])
+            elif op == b"Tw" and operands:
+                state.word_space = float(operands[0])
+            elif op == b"Tz" and operands:
+                state.h_scale = float(operands[0]) / 100.0
+            elif op == b"TL" and operands:
+                state.leading = float(operands[0])
+            elif op == b"Ts" and operands:
+                state.rise = float(operands[0])
+            elif op in (b"Td", b"TD") and len(operands) >= 2:
+                tx, ty = float(operands[0]), float(operands[1])
+                if op == b"TD":
+                    state.leading = -ty
+                tlm = mat_mul((1.0, 0.0, 0.0, 1.0, tx, ty), tlm)
+                tm = tlm
+            elif op == b"Tm" and len(operands) >= 6:
+                tlm = to_matrix(operands)
+                tm = tlm
+            elif op == b"T*":
+                tlm = mat_mul((1.0, 0.0, 0.0, 1.0, 0.0, -state.leading), tlm)
+                tm = tlm
+            elif op in (b"Tj", b"'", b'"'):
+                if op == b'"' and len(operands) >= 3:
+                    state.word_space = float(operands[0])
+                    state.char_space = float(operands[1])
+                if op in (b"'", b'"'):
+                    tlm = mat_mul((1.0, 0.0, 0.0, 1.0, 0.0, -state.leading), tlm)
+                    tm = tlm
+                if operands:
+                    tm = self.emit_string(raw_bytes(operands[-1]), state, tm, ctm)
+            elif op == b"TJ" and operands:
+                for item in operands[0]:
+                    if isinstance(item, (bytes, str)):
+                        tm = self.emit_string(raw_bytes(item), state, tm, ctm)
+                        continue
+                    try:
+                        shift = -float(item) / 1000.0 * state.size * state.h_scale
+                    except (TypeError, ValueError):
+                        continue
+                    if state.font is not None and shift > WORD_BREAK_SPACE * abs(state.size):
+                        self.grouper.add_space()
+                    tm = mat_mul((1.0, 0.0, 0.0, 1.0, shift, 0.0), tm)
+            elif op == b"Do" and operands and depth < MAX_FORM_DEPTH:
+                self.run_form(resources, str(operands[0]), ctm, depth)
+
+    def run_form(self, resources: Any, name: str, ctm: Matrix, depth: int) -> None:
+        xobjects = resources.get("/XObject") if resources is not None else None
+        if xobjects is None:
+            return
+        xobjects = xobjects.get_object()
+        if name not in xobjects:
+            return
+        xobj = xobjects[name].get_object()
+        if xobj.get("/Subtype") != "/Form":
+            return
+        form_ctm = mat_mul(to_matrix(xobj.get("/Matrix", IDENTITY)), ctm)
+        form_resources = xobj.get("/Resources")
+        form_resources = form_resources.get_object() if form_resources is not None else resources
+        self.run(xobj, form_resources, form_ctm, depth + 1)
+
+
+def raw_bytes(value: Any) -> bytes:
+    if isinstance(value, bytes):
+        return bytes(value)
+    original = getattr(value, "original_bytes", None)
+    if original is not None:
+        return bytes(original)
+    return str(value).encode("latin-1", errors="replace")
+
+
+def iter_pdf_words(source: PdfReader | Path, stats: dict[str, int] | None = None) -> Iterator[WordTuple]:
+    # stats を渡すと、Unicode に戻せず U+FFFD にした文字数を "unmapped_glyphs" に足す
+    reader = source if isinstance(source, PdfReader) else PdfReader(str(source))
+    for page_index in range(len(reader.pages)):
+        extractor = PageWordExtractor(reader, page_index)
+        yield from extractor.extract()
+        if stats is not None:
+            stats["unmapped_glyphs"] = stats.get("unmapped_glyphs", 0) + sum(f.unmapped for f in extractor.fonts.values())
@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import re
+from array import array
+from typing import Iterable, Sequence
+
+
+# GNU diffutils の `diff -d` と同じ手順でトークン列の差分を取る:
+#   共通の先頭/末尾行を除外 → 中央スネーク分割 (compareseq/diag, 最小差分)
+#   → shift_boundaries で変更ブロックを寄せる → build_script で hunk 化
+# 行（トークン）は TokenTable で整数IDに置き換えてから比較する。
+
+SNAKE_CHUNK = 64
+SNAKE_CHUNK_MAX = 1 << 16
+DIAG_INITIAL_CAP = 16
+BACKWARD_FILL = 1 << 62
+
+EM_REGION_RE = re.compile(r"<em>(?:[^<>]|<\$>)*</em>")
+EM_TRAILING_SPACE_RE = re.compile(r" +</em>")
+
+# (type, a_start, a_end, b_start, b_end): `diff` の normal 形式ヘッダと同じ 1-based 行番号
+Hunk = tuple[str, int, int, int, int]
+
+
+class DiffTooExpensiveError(Exception):
+    pass
+
+
+class StepBudget:
+    # diag で調べる対角線の延べ数に上限を設ける（変更量 D に対して O(D^2) で増える）
+    def __init__(self, max_steps: int) -> None:
+        self.remaining = max_steps
+
+    def spend(self, steps: int) -> None:
+        self.remaining -= steps
+        if self.remaining < 0:
+            raise DiffTooExpensiveError("diff step budget exceeded")
+
+
+class TokenTable:
+    def __init__(self) -> None:
+        self.ids: dict[str, int] = {}
+        self.tokens: list[str] = []
+
+    def intern(self, token: str) -> int:
+        tid = self.ids.get(token)
+        if tid is None:
+            tid = len(self.tokens)
+            self.ids[token] = tid
+            self.tokens.append(token)
+        return tid
+
+    def intern_all(self, tokens: Sequence[str], out: array | None = None) -> array:
+        if out is None:
+            out = array("i")
+        ids = self.ids
+        for token in dict.fromkeys(tokens):
+            if token not in ids:
+                self.intern(token)
+        out.extend(map(ids.__getitem__, tokens))
+        return out
+
+
+def snake_forward(xv: Sequence[int], yv: Sequence[int], x: int, y: int, xlim: int, ylim: int) -> int:
+    if x >= xlim or y >= ylim or xv[x] != yv[y]:
+        return x
+    # 長い一致区間はスライス比較の幅を倍々に広げて進め、不一致になったら幅を半分ずつ戻す
+    step = SNAKE_CHUNK
+    growing = True
+    while step >= SNAKE_CHUNK:
+        if x + step <= xlim and y + step <= ylim and xv[x : x + step] == yv[y : y + step]:
+            x += step
+            y += step
+            if growing and step < SNAKE_CHUNK_MAX:
+                step *= 2
+        else:
+            growing = False
+            step //= 2
+    while x < xlim and y < ylim and xv[x] == yv[y]:
+        x += 1
+        y += 1
+    return x
+
+
+def snake_backward(xv: Sequence[int], yv: Sequence[int], x: int, y: int, xoff: int, yoff: int) -> int:
+    if x <= xoff or y <= yoff or xv[x - 1] != yv[y - 1]:
+        return x
+    step = SNAKE_CHUNK
+    growing = True
+    while step >= SNAKE_CHUNK:
+        if x - step >= xoff and y - step >= yoff and xv[x - step : x] == yv[y - step : y]:
+            x -= step
+            y -= step
+            if growing and step < SNAKE_CHUNK_MAX:
+                step *= 2
+        else:
+            growing = False
+            step //= 2
+    while xoff < x and yoff < y and xv[x - 1] == yv[y - 1]:
+        x -= 1
+        y -= 1
+    return x
+
+
+class DiagonalVector:
+    # 対角線番号 d で引く配列。コスト c の探索で触る範囲 (中心±c+1) に合わせて倍々で広げる
+    def __init__(self, center: int, fill: int) -> None:
+        self.center = center
+        self.fill = fill
+        self.cap = DIAG_INITIAL_CAP
+        self.base = center - self.cap - 1
+        self.values = [fill] * (2 * self.cap + 3)
+
+    def ensure(self, cost: int) -> None:
+        if cost <= self.cap:
+            return
+        cap = self.cap
+        while cost > cap:
+            cap *= 2
+        base = self.center - cap - 1
+        values = [self.fill] * (2 * cap + 3)
+        shift = self.base - base
+        values[shift : shift + len(self.values)] = self.values
+        self.cap = cap
+        self.base = base
+        self.values = values
+
+
+def diag(
+    xv: Sequence[int],
+    yv: Sequence[int],
+    xoff: int,
+    xlim: int,
+    yoff: int,
+    ylim: int,
+    budget: StepBudget | None = None,
+) -> tuple[int, int]:
+    dmin = xoff - ylim
+    dmax = xlim - yoff
+    fmid = xoff - yoff
+    bmid = xlim - ylim
+    fmin = fmax = fmid
+    bmin = bmax = bmid
+    odd = (fmid - bmid) & 1
+    fvec = DiagonalVector(fmid, -1)
+    bvec = DiagonalVector(bmid, BACKWARD_FILL)
+    fvec.values[fmid - fvec.base] = xoff
+    bvec.values[bmid - bvec.base] = xlim
+
+    c = 0
+    while True:
+        c += 1
+        fvec.ensure(c)
+        bvec.ensure(c)
+        if budget is not None:
+            budget.spend(2 * c)
+        fd = fvec.values
+        fb = fvec.base
+        bd = bvec.values
+        bb = bvec.base
+
+        if fmin > dmin:
+            fmin -= 1
+            fd[fmin - 1 - fb] = -1
+        else:
+            fmin += 1
+        if fmax < dmax:
+            fmax += 1
+            fd[fmax + 1 - fb] = -1
+        else:
+            fmax -= 1
+        for d in range(fmax, fmin - 1, -2):
+            k = d - fb
+            tlo = fd[k - 1]
+            thi = fd[k + 1]
+            x = thi if tlo < thi else tlo + 1
+            y = x - d
+            # ほとんどの対角線は1要素目で不一致になるので、関数呼び出しの前に判定する
+            if x < xlim and y < ylim and xv[x] == yv[y]:
+                x = snake_forward(xv, yv, x + 1, y + 1, xlim, ylim)
+            fd[k] = x
+            if odd and bmin <= d <= bmax and bd[d - bb] <= x:
+                return x, x - d
+
+        if bmin > dmin:
+            bmin -= 1
+            bd[bmin - 1 - bb] = BACKWARD_FILL
+        else:
+            bmin += 1
+        if bmax < dmax:
+            bmax += 1
+            bd[bmax + 1 - bb] = BACKWARD_FILL
+        else:
+            bmax -= 1
+        for d in range(bmax, bmin - 1, -2):
+            k = d - bb
+            tlo = bd[k - 1]
+            thi = bd[k + 1]
+            x = tlo if tlo < thi else thi - 1
+            y = x - d
+            if xoff < x and yoff < y and xv[x - 1] == yv[y - 1]:
+                x = snake_backward(xv, yv, x - 1, y - 1, xoff, yoff)
+            bd[k] = x
+            if not odd and fmin <= d <= fmax and x <= fd[d - fb]:
+                return x, x - d
+
+
+def compareseq(
+    xv: Sequence[int],
+    yv: Sequence[int],
+    xoff: int,
+    xlim: int,
+    yoff: int,
+    ylim: int,
+    changed_x: bytearray,
+    changed_y: bytearray,
+    budget: StepBudget | None = None,
+) -> None:
+    # changed_x[i - xoff + 1] が xv[i] の変更フラグ（先頭と末尾は番兵）
+    xbase = xoff - 1
+    ybase = yoff - 1
+    stack = [(xoff, xlim, yoff, ylim)]
+    while stack:
+        xoff, xlim, yoff, ylim = stack.pop()
+        if xoff < xlim and yoff < ylim:
+            x = snake_forward(xv, yv, xoff, yoff, xlim, ylim)
+            yoff += x - xoff
+            xoff = x
+        if xoff < xlim and yoff < ylim:
+            x = snake_backward(xv, yv, xlim, ylim, xoff, yoff)
+            ylim -= xlim - x
+            xlim = x
+        if xoff == xlim:
+            changed_y[yoff - ybase : ylim - ybase] = b"\x01" * (ylim - yoff)
+        elif yoff == ylim:
+            changed_x[xoff - xbase : xlim - xbase] = b"\x01" * (xlim - xoff)
+        else:
+            xmid, ymid = diag(xv, yv, xoff, xlim, yoff, ylim, budget)
+            stack.append((xmid, xlim, ymid, ylim))
+            stack.append((xoff, xmid, yoff, ymid))
+
+
+def skip_unchanged(changed: bytearray, other_changed: bytearray, i: int, j: int) -> tuple[int, int]:
+    # 変更されていない行を次の変更ブロックまで読み飛ばし、相手側の対応位置 j も同じ行数だけ進める
+    k = changed.find(1, i + 1)
+    target = len(changed) - 2 if k < 0 else k - 1
+    remain = target - i
+    while remain > 0:
+        j = other_changed.find(0, j + 1) - 1
+        k = other_changed.find(1, j + 1)
+        run = (len(other_changed) - 2 if k < 0 else k - 1) - j
+        step = run if run < remain else remain
+        j += step
+        remain -= step
+    return target, j
+
+
+def shift_boundaries(equivs: Sequence[int], base: int, changed: bytearray, other_changed: bytearray) -> None:
+    # changed[i + 1] が equivs[base + i] の変更フラグ。変更ブロックを同じ行の並びに沿って後ろへ寄せ、
+    # 可能なら相手側の変更ブロックと位置を揃える（analyze.c の shift_boundaries と同じ規則）
+    i_end = len(changed) - 2
+    i = 0
+    j = 0
+    while True:
+        i, j = skip_unchanged(changed, other_changed, i, j)
+        if i == i_end:
+            break
+        start = i
+        i = changed.find(0, i + 2) - 1
+        j = other_changed.find(0, j + 1) - 1
+
+        while True:
+            runlength = i - start
+            while start and equivs[base + start - 1] == equivs[base + i - 1]:
+                start -= 1
+                changed[start + 1] = 1
+                i -= 1
+                changed[i + 1] = 0
+                start = changed.rfind(0, 0, start + 1)
+                j = other_changed.rfind(0, 0, j + 1) - 1
+
+            corresponding = i if other_changed[j] else i_end
+
+            while i != i_end and equivs[base + start] == equivs[base + i]:
+                changed[start + 1] = 0
+                start += 1
+                changed[i + 1] = 1
+                i = changed.find(0, i + 2) - 1
+                k = other_changed.find(0, j + 2) - 1
+                if k > j + 1:
+                    corresponding = i
+                j = k
+            if runlength == i - start:
+                break
+
+        while corresponding < i:
+            start -= 1
+            changed[start + 1] = 1
+            i -= 1
+            changed[i + 1] = 0
+            j = other_changed.rfind(0, 0, j + 1) - 1
+
+
+def build_hunks(changed_x: bytearray, changed_y: bytearray, prefix: int) -> list[Hunk]:
+    hunks: list[Hunk] = []
+    len_x = len(changed_x) - 2
+    len_y = len(changed_y) - 2
+    i0 = 0
+    i1 = 0
+    while i0 < len_x or i1 < len_y:
+        # 変更のない区間は両側で同じ行数なので、次の変更位置までまとめて進める
+        k0 = changed_x.find(1, i0 + 1)
+        k1 = changed_y.find(1, i1 + 1)
+        step = min((len_x if k0 < 0 else k0 - 1) - i0, (len_y if k1 < 0 else k1 - 1) - i1)
+        i0 += step
+        i1 += step
+        if i0 >= len_x and i1 >= len_y:
+            break
+        line0 = i0
+        line1 = i1
+        i0 = changed_x.find(0, i0 + 1) - 1
+        i1 = changed_y.find(0, i1 + 1) - 1
+        deleted = i0 - line0
+        inserted = i1 - line1
+        a_first = prefix + line0 + 1
+        b_first = prefix + line1 + 1
+        if deleted and inserted:
+            hunks.append(("c", a_first, a_first + deleted - 1, b_first, b_first + inserted - 1))
+        elif deleted:
+            hunks.append(("d", a_first, a_first + deleted - 1, b_first - 1, b_first - 1))
+        else:
+            hunks.append(("a", a_first - 1, a_first - 1, b_first, b_first + inserted - 1))
+        i0 += 1
+        i1 += 1
+    return hunks
+
+
+def diff_sequences(
+    a: Sequence[int],
+    b: Sequence[int],
+    max_steps: int | None = None,
+    budget: StepBudget | None = None,
+) -> list[Hunk]:
+    # budget を渡すと複数回の呼び出しで上限を共有する（max_steps より優先）
+    # 共通の先頭/末尾は計算対象から外す（末尾は先頭と重ならない範囲まで）
+    prefix = snake_forward(a, b, 0, 0, len(a), len(b))
+    a_end = snake_backward(a, b, len(a), len(b), prefix, prefix)
+    b_end = len(b) - (len(a) - a_end)
+    changed_a = bytearray(a_end - prefix + 2)
+    changed_b = bytearray(b_end - prefix + 2)
+    if budget is None and max_steps is not None:
+        budget = StepBudget(max_steps)
+    compareseq(a, b, prefix, a_end, prefix, b_end, changed_a, changed_b, budget)
+    shift_boundaries(a, prefix, changed_a, changed_b)
+    shift_boundaries(b, prefix, changed_b, changed_a)
+    return build_hunks(changed_a, changed_b, prefix)
+
+
+def double_next_break(split: list[str], start: int) -> None:
+    i = start
+    while i < len(split):
+        if "<$>" in split[i]:
+            split[i] = split[i].replace("<$>", "<$><$>", 1)
+            return
+        i += 1
+
+
+def split_em_rows(joined: str) -> list[str]:
+    joined = EM_REGION_RE.sub(lambda m: m.group(0).replace("<$>", "</em><$><em>"), joined)
+    rows = joined.split("<$>")
+    while rows and rows[-1] == "":
+        rows.pop()
+    return rows
+
+
+def escape_em_spaces(m: re.Match[str]) -> str:
+    return m.group(0).replace(" ", "&nbsp;")
+
+
+def build_diff_table(a_ids: Sequence[int], b_ids: Sequence[int], tokens: Sequence[str], hunks: Iterable[Hunk]) -> str:
+    # difff.pl の build_diff_context が `diff -d` の出力から組み立てる比較表と同じHTMLを返す
+    a_split = [tokens[t] for t in a_ids]
+    b_split = [tokens[t] for t in b_ids]
+    for typ, a_start, a_end, b_start, b_end in hunks:
+        if typ in ("c", "d"):
+            a_split[a_start - 1] = "<em>" + a_split[a_start - 1]
+            a_split[a_end - 1] += "</em>"
+        if typ in ("c", "a"):
+            b_split[b_start - 1] = "<em>" + b_split[b_start - 1]
+            b_split[b_end - 1] += "</em>"
+        # 削除/追加された改行トークンごとに、相手側の次の改行を1つ増やして行位置を揃える
+        if typ in ("c", "d"):
+            for k in range(a_start - 1, a_end):
+                if tokens[a_ids[k]] == "<$>":
+                    double_next_break(b_split, b_start - 2 if b_start > 1 else 0)
+        if typ in ("c", "a"):
+            for k in range(b_start - 1, b_end):
+                if tokens[b_ids[k]] == "<$>":
+                    double_next_break(a_split, a_start - 2 if a_start > 1 else 0)
+
+    a_rows = split_em_rows("".join(a_split))
+    del a_split
+    b_rows = split_em_rows("".join(b_split))
+    del b_split
+    parts: list[str] = []
+    for k in range(max(len(a_rows), len(b_rows))):
+        a_row = a_rows[k] if k < len(a_rows) else ""
+        b_row = b_rows[k] if k < len(b_rows) else ""
+        a_row = EM_TRAILING_SPACE_RE.sub(escape_em_spaces, a_row)
+        b_row = EM_TRAILING_SPACE_RE.sub(escape_em_spaces, b_row)
+        parts.append(f"<tr>\n\t<td>{a_row}</td>\n\t<td>{b_row}</td>\n</tr>\n")
+    return "".join(parts)